@@ -123,6 +123,63 @@ def inverse_logistic(x, a0=0, beta=0):
     return (np.log(x/(1-x)) - a0) / np.exp(beta)
 
 
+def empiric_derivatives(x, a0=None, beta=0):
+    """ Get the empiric function value and its first and second derivatives with respect to beta.
+
+    With :math:`p = x^{e^\\beta}`,
+    :math:`\\frac{dp}{d\\beta} = p \\log p` and
+    :math:`\\frac{d^2p}{d\\beta^2} = p \\log p (\\log p + 1)`
+
+    :param x: x-variable
+    :type x: float
+    :param a0: intercept parameter. This param is ignored here but exists to match similar call signatures.
+    :type a0: float
+    :param beta: slope parameter
+    :type beta: float
+    :return: 3-tuple, (function value, first derivative, second derivative)
+    :rtype: tuple
+
+    >>> import math
+    >>> p, dp, d2p = empiric_derivatives(0.5, beta=0)
+    >>> p, round(dp, 6), round(d2p, 6)
+    (0.5, -0.346574, -0.106347)
+
+    """
+
+    log_p = np.exp(beta) * np.log(x)
+    p = np.exp(log_p)
+    dp = p * log_p
+    return p, dp, dp * (log_p + 1)
+
+
+def logistic_derivatives(x, a0=0, beta=0):
+    """ Get the logistic function value and its first and second derivatives with respect to beta.
+
+    With :math:`p = \\frac{1}{1 + e^{-a_0 - u}}` and :math:`u = e^\\beta x`,
+    :math:`\\frac{dp}{d\\beta} = p (1-p) u` and
+    :math:`\\frac{d^2p}{d\\beta^2} = p (1-p) u ((1 - 2p) u + 1)`
+
+    :param x: x-variable
+    :type x: float
+    :param a0: intercept parameter.
+    :type a0: float
+    :param beta: slope parameter
+    :type beta: float
+    :return: 3-tuple, (function value, first derivative, second derivative)
+    :rtype: tuple
+
+    >>> p, dp, d2p = logistic_derivatives(0.25, -1, 1)
+    >>> round(p, 6), round(dp, 6), round(d2p, 6)
+    (0.420571, 0.165605, 0.183483)
+
+    """
+
+    u = np.exp(beta) * x
+    p = 1 / (1 + np.exp(-a0 - u))
+    dp = p * (1 - p) * u
+    return p, dp, dp * ((1 - 2 * p) * u + 1)
+
+
 def hyperbolic_tan(x, a0=0, beta=0):
     return ((np.tanh(x) + 1) / 2) ** np.exp(beta)
 
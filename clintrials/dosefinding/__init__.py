@@ -2,20 +2,117 @@ __author__ = 'Kristian Brock'
 __contact__ = 'kristian.brock@gmail.com'
 
 
-__all__ = ["crm", "efftox", "efficacytoxicity", "wagestait", "watu"]
+__all__ = ["crm", "decisiontable", "efftox", "efficacytoxicity", "interval", "wagestait", "watu"]
 
 
 import abc
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 import copy
+import csv
 from itertools import product, combinations_with_replacement
 import logging
+import random
+import zlib
 import numpy as np
-from scipy.stats import uniform
+from scipy.stats import binom, uniform
 
 from clintrials.util import (atomic_to_json, iterable_to_json,
                              correlated_binary_outcomes_from_uniforms, to_1d_list)
-from clintrials.simulation import filter_sims
+from clintrials.simulation import filter_sims, index_sims, SimulationResults, _hashable, _take_sims
+
+
+class _CaseHistory(object):
+    """ Growable numpy buffer of cases, with running counts of patients and events at each dose.
+
+    Each case is a row of ints, (dose, event_1, ..., event_k), e.g. (dose, toxicity) or (dose, toxicity, efficacy).
+    Appending cases costs time in proportion to the number of cases appended, not the number already held, so the
+    per-dose counts are available in O(1) without passing over the whole history.
+
+    e.g. general usage
+    >>> history = _CaseHistory(num_doses=3, num_events=1)
+    >>> history.append([(1, 0), (2, 1), (2, 0)])
+    >>> len(history), history.num_treated.tolist(), history.num_events[0].tolist()
+    (3, [1, 2, 0], [0, 1, 0])
+
+    """
+
+    def __init__(self, num_doses, num_events, capacity=16):
+        """
+
+        Params:
+        :param num_doses: number of dose levels. Cases at other dose levels are stored but not counted.
+        :type num_doses: int
+        :param num_events: number of binary events recorded for each case
+        :type num_events: int
+        :param capacity: initial number of cases the buffer can hold before it must grow
+        :type capacity: int
+
+        """
+
+        self.num_doses = num_doses
+        self._buffer = np.zeros((capacity, 1 + num_events), dtype=int)
+        self._size = 0
+        self.num_treated = np.zeros(num_doses, dtype=int)
+        self.num_events = np.zeros((num_events, num_doses), dtype=int)
+        self.min_dose, self.max_dose = None, None
+
+    def __len__(self):
+        return self._size
+
+    def column(self, j):
+        """ Get a read-only view of column j, i.e. 0 for doses, 1 for the first event, etc. """
+        view = self._buffer[:self._size, j]
+        view.flags.writeable = False
+        return view
+
+    def append(self, cases):
+        """ Append cases.
+
+        :param cases: iterable of tuples, or (n x (1 + num_events)) numpy.array, each a case like (dose, event_1, ...)
+        :type cases: list or numpy.array
+
+        """
+
+        if not isinstance(cases, np.ndarray):
+            cases = list(cases)
+        if len(cases) == 0:
+            return
+        width = self._buffer.shape[1]
+        cases = np.asarray(cases, dtype=int)
+        if cases.ndim != 2 or cases.shape[1] != width:
+            raise ValueError('Cases should be %s-tuples or an (n x %s) array.' % (width, width))
+        n = len(cases)
+        if self._size + n > len(self._buffer):
+            buffer = np.zeros((max(2 * len(self._buffer), self._size + n), width), dtype=int)
+            buffer[:self._size] = self._buffer[:self._size]
+            self._buffer = buffer
+        self._buffer[self._size:self._size+n] = cases
+        self._size += n
+
+        doses = cases[:, 0]
+        self.min_dose = int(doses.min()) if self.min_dose is None else min(self.min_dose, int(doses.min()))
+        self.max_dose = int(doses.max()) if self.max_dose is None else max(self.max_dose, int(doses.max()))
+        counted = (doses >= 1) & (doses <= self.num_doses)
+        dose_indices = doses[counted] - 1
+        self.num_treated += np.bincount(dose_indices, minlength=self.num_doses)
+        for k in range(len(self.num_events)):
+            self.num_events[k] += np.bincount(dose_indices, weights=cases[counted, k+1],
+                                              minlength=self.num_doses).astype(int)
+
+    def count(self, dose, j=0):
+        """ Get the number of patients treated at dose if j=0, else the number with event j at dose. """
+        if 1 <= dose <= self.num_doses:
+            return int(self.num_treated[dose-1] if j == 0 else self.num_events[j-1, dose-1])
+        at_dose = self.column(0) == dose
+        return int(np.sum(at_dose) if j == 0 else np.sum(self.column(j)[at_dose]))
+
+    def copy(self):
+        """ Get an independent copy of the history. """
+        clone = copy.copy(self)
+        clone._buffer = self._buffer[:max(self._size, 1)].copy()
+        clone.num_treated = self.num_treated.copy()
+        clone.num_events = self.num_events.copy()
+        return clone
 
 
 class DoseFindingTrial(object):
@@ -24,6 +121,9 @@ class DoseFindingTrial(object):
     The interface for such a class is:
     status()
     reset()
+    snapshot()
+    restore(state)
+    fork()
     number_of_doses()
     first_dose()
     size()
@@ -46,6 +146,8 @@ class DoseFindingTrial(object):
     Further internal interface is provided by:
     __reset()
     __calculate_next_dose() # Subclasses should override this method, set _status and return value for _next_dose.
+    __snapshot() # Subclasses that cache state beyond the cases should return it in a dict
+    __restore(state) # and restore it from that dict.
 
     Class uses the internal variable _status to signify the current status of the trial. At the start of each
     trial, the status is 0, signifying that the trial has not started. It is proposed that trial statuses
@@ -83,21 +185,74 @@ class DoseFindingTrial(object):
         self.num_doses = num_doses
         self._max_size = max_size
         # Reset
-        self._doses = []
-        self._toxicities = []
+        self._history = _CaseHistory(num_doses, 1)
         self._next_dose = self._first_dose
         self._status = 0
 
+    @property
+    def _doses(self):
+        """ Read-only numpy view of the doses given. """
+        return self._history.column(0)
+
+    @property
+    def _toxicities(self):
+        """ Read-only numpy view of the toxicities observed. """
+        return self._history.column(1)
+
     def status(self):
         return self._status
 
     def reset(self):
-        self._doses = []
-        self._toxicities = []
+        self._history = _CaseHistory(self.num_doses, 1)
         self._next_dose = self._first_dose
         self._status = 0
         self.__reset()
 
+    def snapshot(self):
+        """ Get the state of the trial, i.e. the cases observed, the next dose and status, and any posterior
+        quantities cached by the design. Restore it later with restore(state) rather than reset and replay all cases.
+
+        :return: state of trial
+        :rtype: dict
+
+        """
+
+        state = {
+            'history': self._history.copy(),
+            'next_dose': self._next_dose,
+            'status': self._status,
+        }
+        state.update(self.__snapshot())
+        return state
+
+    def restore(self, state):
+        """ Restore the state of the trial from a snapshot. The same snapshot can be restored many times.
+
+        :param state: state of trial, as returned by snapshot()
+        :type state: dict
+
+        """
+
+        self._history = state['history'].copy()
+        self._next_dose = state['next_dose']
+        self._status = state['status']
+        self.__restore(state)
+
+    def fork(self):
+        """ Get an independent copy of the trial in its current state.
+
+        The design parameters are shared and the state is copied, so that the fork can be updated with further cases,
+        in this or another thread, without affecting this trial or recalculating the posterior for past cases.
+
+        :return: copy of trial
+        :rtype: DoseFindingTrial
+
+        """
+
+        clone = copy.copy(self)
+        clone.restore(self.snapshot())
+        return clone
+
     def number_of_doses(self):
         """ How many dose-levels are under investigation?"""
         return self.num_doses
@@ -116,46 +271,38 @@ class DoseFindingTrial(object):
 
     def size(self):
         """ How many patients have been treated? """
-        return len(self._doses)
+        return len(self._history)
 
     def max_size(self):
         """ Maximum number of trial patients. """
         return self._max_size
 
     def doses(self):
-        return self._doses
+        return self._doses.tolist()
 
     def toxicities(self):
-        return self._toxicities
+        return self._toxicities.tolist()
 
     def treated_at_dose(self, dose):
         """ Number of patients treated at a dose level. """
-        return sum(np.array(self._doses) == dose)
+        return self._history.count(dose)
 
     def toxicities_at_dose(self, dose):
         """ Number of toxicities at (1-based) dose level. """
-        return sum([t for d, t in zip(self.doses(), self.toxicities()) if d == dose])
+        return self._history.count(dose, 1)
 
     def maximum_dose_given(self):
-        if len(self._doses) > 0:
-            return max(self._doses)
-        else:
-            return None
+        return self._history.max_dose
 
     def minimum_dose_given(self):
-        if len(self._doses) > 0:
-            return min(self._doses)
-        else:
-            return None
+        return self._history.min_dose
 
     def tabulate(self):
         import pandas as pd
         tab_data = OrderedDict()
-        treated_at_dose = [self.treated_at_dose(d) for d in self.dose_levels()]
-        tox_at_dose = [self.toxicities_at_dose(d) for d in self.dose_levels()]
         tab_data['Dose'] = self.dose_levels()
-        tab_data['N'] = treated_at_dose
-        tab_data['Toxicities'] = tox_at_dose
+        tab_data['N'] = self._history.num_treated
+        tab_data['Toxicities'] = self._history.num_events[0]
         df = pd.DataFrame(tab_data)
         df['ToxRate'] = np.where(df.N > 0, df.Toxicities / df.N, np.nan)
         return df
@@ -174,29 +321,21 @@ class DoseFindingTrial(object):
         Params:
         cases, list of 2-tuples, (dose, toxicity), where dose is the given (1-based) dose level
                     and toxicity = 1 for a toxicity event; 0 for a tolerance event.
+                    Alternatively, an (n x 2) numpy.array with the same columns.
 
         Returns: next dose
 
         """
 
-        for (dose, tox) in cases:
-            self._doses.append(dose)
-            self._toxicities.append(tox)
-
+        self._history.append(cases)
         self._next_dose = self.__calculate_next_dose()
         return self._next_dose
 
     def observed_toxicity_rates(self):
         """ Get the observed rate of toxicity at all doses. """
-        tox_rates = []
-        for d in range(1, self.num_doses+1):
-            num_treated = self.treated_at_dose(d)
-            if num_treated:
-                num_toxes = self.toxicities_at_dose(d)
-                tox_rates.append(1. * num_toxes / num_treated)
-            else:
-                tox_rates.append(np.nan)
-        return np.array(tox_rates)
+        num_treated = self._history.num_treated
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(num_treated > 0, 1. * self._history.num_events[0] / num_treated, np.nan)
 
     def optimal_decision(self, prob_tox):
         """ Get the optimal dose choice for a given dose-toxicity curve.
@@ -282,6 +421,14 @@ class DoseFindingTrial(object):
         """ Subclasses should override this method and return the desired next dose. """
         return -1  # Default implementation
 
+    def __snapshot(self):
+        """ Opportunity to return implementation-specific state in a dict. """
+        return {}
+
+    def __restore(self, state):
+        """ Opportunity to restore implementation-specific state from a snapshot. """
+        return
+
 
 class SimpleToxicityCountingDoseEscalationTrial(DoseFindingTrial):
     """ Simple design to monotonically increase dose until a certain number of toxicities are observed in aggregate.
@@ -320,20 +467,26 @@ class SimpleToxicityCountingDoseEscalationTrial(DoseFindingTrial):
     def _DoseFindingTrial__reset(self):
         self.max_dose_given = -1
 
+    def _DoseFindingTrial__snapshot(self):
+        return {'max_dose_given': self.max_dose_given}
+
+    def _DoseFindingTrial__restore(self, state):
+        self.max_dose_given = state['max_dose_given']
+
     def _DoseFindingTrial__calculate_next_dose(self):
         if self.has_more():
             self._status = 1
-            if len(self.doses()) > 0:
-                return min(max(self.doses()) + 1, self.number_of_doses())
+            if self.size() > 0:
+                return min(self.maximum_dose_given() + 1, self.number_of_doses())
             else:
                 return self._first_dose
         else:
             self._status = 100
-            return max(self.doses())
+            return self.maximum_dose_given()
 
     def has_more(self):
-        return DoseFindingTrial.has_more(self) and (sum(self.toxicities()) < self.max_toxicities) \
-               and self.maximum_dose_given() < self.number_of_doses()
+        return DoseFindingTrial.has_more(self) and (int(self._toxicities.sum()) < self.max_toxicities) \
+               and (self.size() == 0 or self.maximum_dose_given() < self.number_of_doses())
 
 
 class ThreePlusThree(DoseFindingTrial):
@@ -396,10 +549,16 @@ class ThreePlusThree(DoseFindingTrial):
     def _DoseFindingTrial__reset(self):
         self._continue = True
 
+    def _DoseFindingTrial__snapshot(self):
+        return {'continue': self._continue}
+
+    def _DoseFindingTrial__restore(self, state):
+        self._continue = state['continue']
+
     def _DoseFindingTrial__calculate_next_dose(self):
-        dose_indices = np.array(self._doses) == self._next_dose
-        toxes_at_dose = sum(np.array(self._toxicities)[dose_indices])
-        if sum(dose_indices) == 3:
+        treated_at_dose = self.treated_at_dose(self._next_dose)
+        toxes_at_dose = self.toxicities_at_dose(self._next_dose)
+        if treated_at_dose == 3:
             if toxes_at_dose == 0:
                 if self._next_dose < self.num_doses:
                     # escalate
@@ -421,7 +580,7 @@ class ThreePlusThree(DoseFindingTrial):
                 else:
                     self._status = -1
                 self._continue = False
-        elif sum(dose_indices) == 6:
+        elif treated_at_dose == 6:
             if toxes_at_dose <= 1:
                 if self._next_dose < self.num_doses:
                     # escalate
@@ -556,7 +715,7 @@ def simulate_dose_finding_trials(design_map, true_toxicities, tolerances=None, c
 
     report = OrderedDict()
     report['TrueToxicities'] = iterable_to_json(true_toxicities)
-    for label, design in design_map.iteritems():
+    for label, design in design_map.items():
         design_sim = simulate_dose_finding_trial(design, true_toxicities, tolerances=tolerances,
                                                  cohort_size=cohort_size, conduct_trial=conduct_trial,
                                                  calculate_optimal_decision=calculate_optimal_decision)
@@ -564,6 +723,433 @@ def simulate_dose_finding_trials(design_map, true_toxicities, tolerances=None, c
     return report
 
 
+def fully_informed_toxicity_curves(tolerances, true_toxicities):
+    """ Get the fully-informed toxicity curve for each of many sets of patient tolerances, in one broadcast.
+
+    Each curve is the proportion of patients that would have a toxicity at each dose, as calculated in
+    simulate_dose_finding_trial.
+
+    :param tolerances: (num_sims x n_patients) array of uniforms, or (num_sims x n_patients x 3) array whose first
+                        slice in the last axis is used.
+    :type tolerances: numpy.array
+    :param true_toxicities: list of the true toxicity rates at the dose levels
+    :type true_toxicities: list
+    :return: (num_sims x num_doses) array of toxicity proportions
+    :rtype: numpy.array
+
+    >>> fully_informed_toxicity_curves(np.array([[0.1, 0.3], [0.5, 0.7]]), [0.2, 0.6]).tolist()
+    [[0.5, 1.0], [0.0, 0.5]]
+
+    """
+
+    tolerances = np.asarray(tolerances, dtype=float)
+    if tolerances.ndim == 3:
+        tolerances = tolerances[:, :, 0]
+    return (tolerances[:, :, np.newaxis] < np.asarray(true_toxicities, dtype=float)).mean(axis=1)
+
+
+def _simulate_design_batch(design, true_toxicities, tolerances, cohort_size=1, conduct_trial=1):
+    """ Simulate a design on each row of tolerances, without optimal decisions.
+
+    CRM designs that simulate_crm_trial_batch reproduces, i.e. those using MLE with an empiric or logistic link, or
+    Bayes with trapezium integration, are simulated together by it. Interval designs, like BOIN and MTPI2, are
+    simulated together by simulate_interval_trial_batch. Other designs are simulated trial by trial.
+
+    """
+
+    from clintrials.dosefinding.crm import CRM, simulate_crm_trial_batch, _link_derivatives
+    from clintrials.dosefinding.interval import IntervalDoseFindingTrial, simulate_interval_trial_batch
+    if conduct_trial and isinstance(design, CRM) and \
+            ((design.method == 'bayes' and design.integration_method == 'trapezium') or
+             (design.method == 'mle' and design.F_func in _link_derivatives)):
+        return simulate_crm_trial_batch(design, true_toxicities, len(tolerances), tolerances=tolerances,
+                                        cohort_size=cohort_size, calculate_optimal_decision=0)
+    elif conduct_trial and isinstance(design, IntervalDoseFindingTrial):
+        return simulate_interval_trial_batch(design, true_toxicities, len(tolerances), tolerances=tolerances,
+                                             cohort_size=cohort_size, calculate_optimal_decision=0)
+    else:
+        return [simulate_dose_finding_trial(design, true_toxicities, tolerances=x, cohort_size=cohort_size,
+                                            conduct_trial=conduct_trial, calculate_optimal_decision=0)
+                for x in tolerances]
+
+
+def simulate_dose_finding_trials_batch(design_map, true_toxicities, num_sims=None, tolerances=None, cohort_size=1,
+                                       conduct_trial=1, calculate_optimal_decision=1):
+    """ Simulate many sets of patients, each treated by multiple toxicity-driven dose finding designs.
+
+    This is the batch form of simulate_dose_finding_trials. Each design is given the same patients in each simulation
+    (common random numbers), so that comparisons between designs are paired. The fully-informed toxicity curves are
+    calculated for all simulations at once, and then each design is simulated across the whole batch.
+
+    :param design_map: dict, label -> instance of DoseFindingTrial
+    :type design_map: dict
+    :param true_toxicities: list of the true toxicity rates at the dose levels under investigation.
+    :type true_toxicities: list
+    :param num_sims: number of simulations. Only used when tolerances is None.
+    :type num_sims: int
+    :param tolerances: optional (num_sims x n_patients) array of uniforms used to infer toxicity events for patients,
+                        or a (num_sims x n_patients x 3) array like that used by efficacy-toxicity designs, in which
+                        case the first slice in the last axis is used. Leave None to get randomly sampled data.
+    :type tolerances: numpy.array
+    :param cohort_size: to add several patients at a dose at once
+    :type cohort_size: int
+    :param conduct_trial: True to conduct cohort-by-cohort dosing using the trial design; False to suppress
+    :type conduct_trial: bool
+    :param calculate_optimal_decision: True to calculate the optimal dose; False to suppress
+    :type calculate_optimal_decision: bool
+    :return: list of reports of the simulation outcomes, each like that returned by simulate_dose_finding_trials
+    :rtype: list
+
+    """
+
+    max_size = max([design.max_size() for design in design_map.values()])
+    if tolerances is None:
+        if num_sims is None:
+            raise ValueError('Provide num_sims or tolerances.')
+        tolerances = uniform().rvs((num_sims, max_size))
+    else:
+        tolerances = np.asarray(tolerances, dtype=float)
+        if tolerances.ndim == 3:
+            tolerances = tolerances[:, :, 0]
+        if tolerances.ndim != 2:
+            raise ValueError('tolerances should be a num_sims*n_patients or num_sims*n_patients*3 array')
+        if tolerances.shape[1] < max_size:
+            logging.warn('You have provided fewer tolerances than maximum number of patients on trial. Beware errors!')
+    num_sims = tolerances.shape[0]
+
+    if calculate_optimal_decision:
+        tox_hats = fully_informed_toxicity_curves(tolerances, true_toxicities)
+
+    reports = [OrderedDict() for i in range(num_sims)]
+    for report in reports:
+        report['TrueToxicities'] = iterable_to_json(true_toxicities)
+    for label, design in design_map.items():
+        design_sims = _simulate_design_batch(design, true_toxicities, tolerances, cohort_size=cohort_size,
+                                             conduct_trial=conduct_trial)
+        for report, design_sim, tox_hat in zip(reports, design_sims, tox_hats if calculate_optimal_decision
+                                               else [None] * num_sims):
+            if calculate_optimal_decision:
+                try:
+                    optimal_allocation = design.optimal_decision(tox_hat)
+                    design_sim['FullyInformedToxicityCurve'] = iterable_to_json(tox_hat)
+                    design_sim['OptimalAllocation'] = atomic_to_json(optimal_allocation)
+                except NotImplementedError:
+                    pass
+            report[label] = design_sim
+    return reports
+
+
+def _binomial_pmf(n, p):
+    """ Get Binomial(n, p) probabilities of 0..n events, for an array of p, in a new last axis. """
+    k = np.arange(n + 1)
+    return binom.pmf(k, n, np.asarray(p, dtype=float)[..., np.newaxis])
+
+
+def _three_plus_three_ocs(design, prob_tox):
+    """ Propagate probability mass through the 3+3 design, a dose at a time, for (num_scenarios x num_doses) prob_tox.
+
+    The trial reaches dose d only by escalating from d-1, so the mass at each dose is a scalar per scenario.
+
+    """
+
+    num_scenarios, num_doses = prob_tox.shape
+    rec = np.zeros((num_scenarios, num_doses + 1))
+    patients = np.zeros((num_scenarios, num_doses))
+    toxicities = np.zeros((num_scenarios, num_doses))
+    reach = np.ones(num_scenarios)
+    for d in range(num_doses):
+        p = prob_tox[:, d]
+        first = _binomial_pmf(3, p)
+        second_none = first[:, 1] * (1 - p) ** 3
+        patients[:, d] = reach * (3 + 3 * first[:, 1])
+        toxicities[:, d] = reach * (3 * p + first[:, 1] * 3 * p)
+        # Two or more toxicities in three or six patients de-escalates to d-1 and ends the trial
+        rec[:, d] += reach * (1 - first[:, 0] - second_none)
+        reach = reach * (first[:, 0] + second_none)
+    # Escalating beyond the top dose ends the trial at the top dose
+    rec[:, num_doses] += reach
+    statuses = OrderedDict([(100, 1 - rec[:, 0]), (-1, rec[:, 0])])
+    return rec, patients, toxicities, statuses
+
+
+def _toxicity_counting_ocs(design, prob_tox, cohort_size):
+    """ Propagate probability mass through SimpleToxicityCountingDoseEscalationTrial.
+
+    The design escalates after every cohort so the dose and number treated are fixed by the cohort number. The only
+    random component of the state is the running count of toxicities, held as a (num_scenarios x max_toxicities)
+    array of the probability that the trial continues with each count.
+
+    """
+
+    num_scenarios, num_doses = prob_tox.shape
+    max_size, max_toxicities = design.max_size(), design.max_toxicities
+    rec = np.zeros((num_scenarios, num_doses + 1))
+    patients = np.zeros((num_scenarios, num_doses))
+    toxicities = np.zeros((num_scenarios, num_doses))
+    dose, size = design.first_dose(), 0
+    if max_toxicities <= 0 or max_size <= 0:
+        # The trial stops before treating anyone
+        rec[:, dose] = 1
+        return rec, patients, toxicities, OrderedDict([(0, np.ones(num_scenarios))])
+    mass = np.zeros((num_scenarios, max_toxicities))
+    mass[:, 0] = 1
+    while size < max_size:
+        m = min(cohort_size, max_size - size)
+        p = prob_tox[:, dose - 1]
+        reach = mass.sum(axis=1)
+        patients[:, dose - 1] += reach * m
+        toxicities[:, dose - 1] += reach * m * p
+        pmf = _binomial_pmf(m, p)
+        new_mass = np.zeros_like(mass)
+        for k in range(m + 1):
+            new_mass[:, k:] += mass[:, :mass.shape[1] - k] * pmf[:, k:k + 1]
+        size += m
+        if size < max_size and dose < num_doses:
+            # Mass that has seen max_toxicities in aggregate stops here; the rest escalates.
+            rec[:, dose] += reach - new_mass.sum(axis=1)
+            mass = new_mass
+            dose += 1
+        else:
+            rec[:, dose] += reach
+            break
+    return rec, patients, toxicities, OrderedDict([(100, np.ones(num_scenarios))])
+
+
+class DoseFindingStateDAG(object):
+    """ The directed acyclic graph of states that a dose-finding design can reach, for exact operating characteristics.
+
+    A state is the number of patients treated and the number of toxicities at each dose, together with the next dose,
+    the trial status and whether the trial continues. Each cohort is given the next dose and any number of its patients
+    may have a toxicity, so each state leads to cohort_size + 1 successors. Many histories lead to the same state, so
+    the graph is much smaller than the tree of patient histories, and each distinct state is evaluated by the design
+    just once. The graph does not depend on the true toxicity curve, so it is built once and can then be weighted by
+    binomial transition probabilities under any number of scenarios.
+
+    The design must make decisions that depend on the cases only through the numbers of patients and toxicities at each
+    dose, and the dose just given, i.e. not the order of patients; and must make them deterministically.
+    CRM qualifies, unless it uses a principle_escalation_func. As in simulate_dose_finding_trial with default
+    tolerances, the last cohort is truncated so that no more than max_size patients are treated.
+
+    e.g. general usage
+    >>> dag = DoseFindingStateDAG(ThreePlusThree(2), cohort_size=3)
+    >>> dag.num_states()
+    25
+    >>> ocs = dag.operating_characteristics([0.5, 0.5])
+    >>> ocs['RecommendationProbability'].round(4).tolist()
+    [0.8281, 0.1423, 0.0295]
+
+    """
+
+    def __init__(self, design, cohort_size=1):
+        """
+
+        Params:
+        :param design: the design. It is reset and used to evaluate each state.
+        :type design: clintrials.dosefinding.DoseFindingTrial
+        :param cohort_size: number of patients to add at a dose at once
+        :type cohort_size: int
+
+        """
+
+        if getattr(design, 'principle_escalation_func', None) is not None:
+            raise TypeError('Decisions made by a principle_escalation_func may depend on the order of patients.')
+
+        self.design = design
+        self.cohort_size = cohort_size
+        self.num_doses = design.number_of_doses()
+        # One list per cohort of the states, as (next dose, status, has more); of the terminal states, as
+        # (index, recommended dose, status); and of the transitions, as (parent index, child index, dose,
+        # number of patients, number of toxicities). States are indexed within their cohort.
+        self.states = []
+        self.terminal = []
+        self.transitions = []
+        self._num_states = 0
+        self._build()
+
+    def _build(self):
+        design, max_size = self.design, self.design.max_size()
+        design.reset()
+        counts = ((0, 0),) * self.num_doses
+        frontier = [(counts, design.next_dose(), design.status(), design.has_more(), design.snapshot())]
+        size = 0
+        while frontier:
+            self._num_states += len(frontier)
+            self.states.append([(dose, status, has_more) for counts, dose, status, has_more, state in frontier])
+            terminal, transitions, children, decisions = [], [], OrderedDict(), {}
+            for i, (counts, dose, status, has_more, state) in enumerate(frontier):
+                if not has_more:
+                    terminal.append((i, dose, status))
+                    continue
+                if dose < 1 or dose > self.num_doses:
+                    raise ValueError('The design continues at dose %s, outside the doses under investigation.' % dose)
+                m = min(self.cohort_size, max_size - size)
+                for k in range(m + 1):
+                    n, t = counts[dose - 1]
+                    new_counts = counts[:dose - 1] + ((n + m, t + k),) + counts[dose:]
+                    key = (dose, new_counts)
+                    if key not in decisions:
+                        design.restore(state)
+                        design.update([(dose, 1)] * k + [(dose, 0)] * (m - k))
+                        child = (new_counts, design.next_dose(), design.status(), design.has_more())
+                        if child not in children:
+                            children[child] = (len(children), design.snapshot())
+                        decisions[key] = children[child][0]
+                    transitions.append((i, decisions[key], dose, m, k))
+            self.terminal.append(terminal)
+            self.transitions.append(transitions)
+            frontier = [child + (state,) for child, (j, state) in children.items()]
+            size = min(size + self.cohort_size, max_size)
+        design.reset()
+
+    def num_states(self):
+        """ Get the number of distinct states in the graph. """
+        return self._num_states
+
+    def operating_characteristics(self, true_toxicities):
+        """ Calculate the exact operating characteristics by propagating probability mass through the graph.
+
+        :param true_toxicities: the true toxicity rates at the dose levels, a list for a single scenario, or a
+                                (num_scenarios x num_doses) array for many
+        :type true_toxicities: list or numpy.array
+        :return: dict like that returned by exact_operating_characteristics
+        :rtype: collections.OrderedDict
+
+        """
+
+        prob_tox = np.asarray(true_toxicities, dtype=float)
+        single_scenario = prob_tox.ndim == 1
+        prob_tox = np.atleast_2d(prob_tox)
+        if prob_tox.shape[1] != self.num_doses:
+            raise ValueError('true_toxicities should have a column for each dose.')
+        num_scenarios = prob_tox.shape[0]
+        pmfs = dict((m, _binomial_pmf(m, prob_tox)) for m in range(self.cohort_size + 1))
+
+        rec = np.zeros((num_scenarios, self.num_doses + 1))
+        patients = np.zeros((num_scenarios, self.num_doses))
+        toxicities = np.zeros((num_scenarios, self.num_doses))
+        statuses = OrderedDict()
+        mass = np.ones((num_scenarios, 1))
+        for terminal, transitions in zip(self.terminal, self.transitions):
+            for i, dose, status in terminal:
+                rec[:, max(dose, 0)] += mass[:, i]
+                statuses[status] = statuses.get(status, 0) + mass[:, i]
+            if not transitions:
+                break
+            parent, child, dose, m, k = [np.array(x, dtype=int) for x in zip(*transitions)]
+            weights = np.empty((num_scenarios, len(transitions)))
+            for m_ in np.unique(m):
+                at = m == m_
+                weights[:, at] = pmfs[m_][:, dose[at] - 1, k[at]]
+            flow = mass[:, parent] * weights
+            # Every outcome of a cohort is a transition so flow from the k=0 edges gives the mass treated at each dose
+            treated = k == 0
+            np.add.at(patients.T, dose[treated] - 1, (mass[:, parent[treated]] * m[treated]).T)
+            np.add.at(toxicities.T, dose - 1, (flow * k).T)
+            mass = np.zeros((num_scenarios, child.max() + 1))
+            np.add.at(mass.T, child, flow.T)
+
+        return _operating_characteristics(rec, patients, toxicities, statuses, single_scenario)
+
+
+def _operating_characteristics(rec, patients, toxicities, statuses, single_scenario):
+    ocs = OrderedDict()
+    ocs['RecommendationProbability'] = rec
+    ocs['ExpectedPatients'] = patients
+    ocs['ExpectedToxicities'] = toxicities
+    ocs['ExpectedSampleSize'] = patients.sum(axis=1)
+    ocs['TrialStatusProbability'] = OrderedDict(sorted(statuses.items(), key=lambda x: -x[0]))
+    if single_scenario:
+        for key in ['RecommendationProbability', 'ExpectedPatients', 'ExpectedToxicities', 'ExpectedSampleSize']:
+            ocs[key] = ocs[key][0]
+        for status in ocs['TrialStatusProbability']:
+            ocs['TrialStatusProbability'][status] = float(ocs['TrialStatusProbability'][status][0])
+    return ocs
+
+
+def exact_operating_characteristics(design, true_toxicities, cohort_size=1):
+    """ Calculate the exact operating characteristics of a deterministic dose-finding design.
+
+    Rather than simulating many trials, probability mass is propagated through the states of the design, so the
+    results have no Monte Carlo error. The calculation is vectorised over scenarios.
+
+    Supported designs are ThreePlusThree, which always uses cohorts of three, SimpleToxicityCountingDoseEscalationTrial,
+    CRM and the interval designs BOIN and MTPI2. The first two have closed forms. The others are evaluated on a
+    DoseFindingStateDAG; build one directly to reuse it across calls. The operating characteristics are those of
+    simulate_dose_finding_trial with its default tolerances, i.e. the last cohort is truncated so that no more than
+    max_size patients are treated.
+
+    :param design: the design
+    :type design: clintrials.dosefinding.DoseFindingTrial
+    :param true_toxicities: the true toxicity rates at the dose levels, a list for a single scenario, or a
+                            (num_scenarios x num_doses) array for many
+    :type true_toxicities: list or numpy.array
+    :param cohort_size: number of patients to add at a dose at once. Ignored by ThreePlusThree.
+    :type cohort_size: int
+    :return: dict with keys:
+                RecommendationProbability, probabilities that each dose is recommended, with dose 0 in the first
+                                            column signifying that no dose is recommended;
+                ExpectedPatients, expected number of patients treated at each dose;
+                ExpectedToxicities, expected number of toxicities at each dose;
+                ExpectedSampleSize, expected number of patients in the trial;
+                TrialStatusProbability, dict of final trial status -> probability.
+             Each is a numpy.array with a leading axis of scenarios if true_toxicities is 2-dimensional.
+    :rtype: collections.OrderedDict
+
+    e.g.
+    >>> ocs = exact_operating_characteristics(ThreePlusThree(1), [0.5])
+    >>> ocs['RecommendationProbability'].tolist()
+    [0.828125, 0.171875]
+    >>> ocs['ExpectedSampleSize'].tolist()
+    4.125
+
+    """
+
+    from clintrials.dosefinding.crm import CRM
+    from clintrials.dosefinding.interval import IntervalDoseFindingTrial
+    if isinstance(design, (CRM, IntervalDoseFindingTrial)):
+        return DoseFindingStateDAG(design, cohort_size).operating_characteristics(true_toxicities)
+
+    prob_tox = np.asarray(true_toxicities, dtype=float)
+    single_scenario = prob_tox.ndim == 1
+    prob_tox = np.atleast_2d(prob_tox)
+    if prob_tox.shape[1] != design.number_of_doses():
+        raise ValueError('true_toxicities should have a column for each dose.')
+
+    if isinstance(design, ThreePlusThree):
+        rec, patients, toxicities, statuses = _three_plus_three_ocs(design, prob_tox)
+    elif isinstance(design, SimpleToxicityCountingDoseEscalationTrial):
+        rec, patients, toxicities, statuses = _toxicity_counting_ocs(design, prob_tox, cohort_size)
+    else:
+        raise TypeError('Exact operating characteristics are not available for %s.' % type(design).__name__)
+    return _operating_characteristics(rec, patients, toxicities, statuses, single_scenario)
+
+
+def summarise_operating_characteristics(ocs):
+    """ Summarise exact operating characteristics for a single scenario like summarise_dose_finding_sims.
+
+    :param ocs: operating characteristics for a single scenario, as returned by exact_operating_characteristics
+    :type ocs: dict
+    :return: 2-tuple, (doses DataFrame, outcomes DataFrame), with the columns of the first two items returned by
+                summarise_dose_finding_sims that do not count simulations, i.e. Rec%, Pat% and MeanPat; and %.
+    :rtype: tuple
+
+    """
+
+    import pandas as pd
+
+    rec = np.asarray(ocs['RecommendationProbability'])
+    patients = np.asarray(ocs['ExpectedPatients'])
+    if rec.ndim != 1:
+        raise ValueError('Summarise the operating characteristics of one scenario at a time.')
+    num_doses = len(patients)
+    df_doses = pd.DataFrame({'Rec%': np.concatenate([[0], rec])}, index=range(-1, num_doses+1))
+    df_doses['Pat%'] = np.concatenate([[0, 0], patients / patients.sum()])
+    df_doses['MeanPat'] = np.concatenate([[0, 0], patients])
+    statuses = ocs['TrialStatusProbability']
+    df_statuses = pd.DataFrame({'%': pd.Series(list(statuses.values()), index=list(statuses.keys()))})
+    return df_doses, df_statuses
+
+
 def find_mtd(toxicity_target, scenario, strictly_lte=False, verbose=False):
     """ Find the MTD in a list of toxicity probabilities and a target toxicity rate.
 
@@ -627,8 +1213,8 @@ def find_mtd(toxicity_target, scenario, strictly_lte=False, verbose=False):
 def summarise_dose_finding_sims(sims, label, num_doses, filter={}):
     """ Summarise a list of dose-finding simulations for doses recommended, doses given and trial outcome.
 
-    :param sims: list of JSON reps of dose-finding trial outcomes
-    :type sims: list
+    :param sims: list of JSON reps of dose-finding trial outcomes, or a SimulationResults
+    :type sims: list or clintrials.simulation.SimulationResults
     :param label: name of simulation at first level in each JSON object
     :type label: str
     :param num_doses: number of dose levels under study
@@ -649,22 +1235,28 @@ def summarise_dose_finding_sims(sims, label, num_doses, filter={}):
     if len(filter):
         sims = filter_sims(sims, filter)
 
+    if isinstance(sims, SimulationResults):
+        doses = sims[label]['RecommendedDose']
+        doses_given = sims[label]['Doses'].values
+        statuses = sims[label]['TrialStatus']
+    else:
+        doses = [x[label]['RecommendedDose'] for x in sims]
+        doses_given = to_1d_list([x[label]['Doses'] for x in sims])
+        statuses = [x[label]['TrialStatus'] for x in sims]
+
     # Recommended Doses
-    doses = [x[label]['RecommendedDose'] for x in sims]
     df_doses = pd.DataFrame({'RecN': pd.Series(doses).value_counts()}, index=range(-1, num_doses+1))
-    df_doses.RecN[np.isnan(df_doses.RecN)] = 0
+    df_doses['RecN'] = df_doses['RecN'].fillna(0)
     df_doses['Rec%'] = 1.0 * df_doses['RecN'] / df_doses['RecN'].sum()
     # Given Doses
-    doses_given = to_1d_list([x[label]['Doses'] for x in sims])
     df_doses = df_doses.join(pd.DataFrame({'PatN': pd.Series(doses_given).value_counts()}))
-    df_doses.PatN[np.isnan(df_doses.PatN)] = 0
+    df_doses['PatN'] = df_doses['PatN'].fillna(0)
     df_doses['Pat%'] = 1.0 * df_doses['PatN'] / df_doses['PatN'].sum()
     df_doses['MeanPat']= 1.0 * df_doses['PatN'] / len(sims)
     # Order
     df_doses = df_doses.loc[range(-1, num_doses+1)]
 
     # Trial Outcomes
-    statuses = [x[label]['TrialStatus'] for x in sims]
     df_statuses = pd.DataFrame({'N': pd.Series(statuses).value_counts()})
     df_statuses['%'] = 1.0 * df_statuses['N'] / df_statuses['N'].sum()
 
@@ -676,8 +1268,8 @@ def batch_summarise_dose_finding_sims(sims, label, num_doses, dimensions=None, f
 
     The dimensions along which to group and simmarise the simulations are determined via dimensions (see below)
 
-    :param sims: list of JSON reps of dose-finding trial outcomes
-    :type sims: list
+    :param sims: list of JSON reps of dose-finding trial outcomes, or a SimulationResults
+    :type sims: list or clintrials.simulation.SimulationResults
     :param label: name of simulation at first level in each JSON object
     :type label: str
     :param num_doses: number of dose levels under study
@@ -695,14 +1287,16 @@ def batch_summarise_dose_finding_sims(sims, label, num_doses, dimensions=None, f
     """
     if dimensions is not None:
         var_map, params = dimensions
-        z = [(k, params[v]) for k,v in var_map.iteritems()]
+        z = [(k, params[v]) for k,v in var_map.items()]
         labels, val_arrays = zip(*z)
         param_combinations = list(product(*val_arrays))
+        index = index_sims(sims, labels)
         for param_combo in param_combinations:
             for lab, vals in zip(labels, param_combo):
                 print('{}: {}'.format(lab, vals))
             these_params = dict(zip(labels, param_combo))
-            abc = summarise_dose_finding_sims(sims, label, num_doses, filter=these_params)
+            these_sims = _take_sims(sims, index.get(_hashable(param_combo), []))
+            abc = summarise_dose_finding_sims(these_sims, label, num_doses)
             if func1:
                 print(func1(abc[0], these_params))
                 print('\n')
@@ -721,10 +1315,155 @@ def batch_summarise_dose_finding_sims(sims, label, num_doses, dimensions=None, f
         print('\n')
 
 
+def _dtp_state(cases, next_dose):
+    """ Get a hashable key for the sufficient statistics of a dose decision in a DTP analysis.
+
+    A trial that is reset, told the next dose and then updated with cases reaches a decision that depends on the
+    cases only through the number of patients with each distinct outcome at each dose, for all designs in this
+    package that do not inspect the order of patients, e.g. CRM without a principle_escalation_func, EffTox, 3+3.
+
+    :param cases: list of cases, tuples with the dose first, like (dose, tox) or (dose, tox, eff)
+    :type cases: list
+    :param next_dose: the dose set on the trial before it is updated with cases
+    :type next_dose: int
+    :return: hashable state
+    :rtype: tuple
+
+    """
+
+    if next_dose is not None:
+        next_dose = int(next_dose)
+    return next_dose, tuple(sorted(Counter(tuple(int(y) for y in x) for x in cases).items()))
+
+
+def _dtp_memoizable(trial):
+    """ Check whether the DTP decisions of trial may be memoized on :func:`_dtp_state`, i.e. that they do not depend
+    on the order of patients, as they may with a principle_escalation_func. """
+    return getattr(trial, 'principle_escalation_func', None) is None
+
+
+def _dtp_seed(seed, state):
+    """ Get the seed for the random number generators at a DTP state, so that the decision is reproducible wherever
+    and in whatever order the state is evaluated. """
+    return [int(seed), zlib.crc32(repr(state).encode('utf-8')) & 0xffffffff]
+
+
+def _dtp_decision(trial, cases, next_dose, cache, custom_output_func=None, set_next_dose=True, verbose=False,
+                  seed=None, **kwargs):
+    """ Get the dose decision, and the extra output, after a trial is updated with cases.
+
+    Decisions are stored in cache, keyed by :func:`_dtp_state`, so that each distinct state is evaluated once, and
+    each call gets its own copy of the extra output. The cache is ignored for trials that fail :func:`_dtp_memoizable`.
+    The trial is reset and updated with all cases, rather than restored from a snapshot and updated with the latest
+    cohort. Designs like CRM evaluate their likelihood from the counts at each dose, so this costs no more, and the
+    decision is bit-for-bit the same whichever path first reaches the state.
+
+    :param trial: dose-finding trial, e.g. subclass of DoseFindingTrial or EfficacyToxicityDoseFindingTrial
+    :param cases: list of all cases observed, tuples with the dose first
+    :type cases: list
+    :param next_dose: the dose given to the latest cohort. Set on the trial before updating if set_next_dose is True
+    :type next_dose: int
+    :param cache: dict of decisions already made, or None to evaluate afresh
+    :type cache: dict
+    :param custom_output_func: func that takes trial as sole argument and returns dict of extra output.
+    :type custom_output_func: func
+    :param set_next_dose: True to set next_dose on the trial after reset and before update
+    :type set_next_dose: bool
+    :param verbose: True to print extra information to monitor progress
+    :type verbose: bool
+    :param seed: if not None, the numpy and random generators are seeded from seed and the state before the trial is
+                    reset, so that designs that use Monte Carlo methods give reproducible decisions. The state of the
+                    generators is restored afterwards, so the caller's random streams are unaffected.
+    :type seed: int
+    :param kwargs: extra keyword args to send to trial.update method
+    :type kwargs: dict
+    :return: 2-tuple, (recommended dose, dict of extra output)
+    :rtype: tuple
+
+    """
+
+    key = _dtp_state(cases, next_dose if set_next_dose else None)
+    if cache is not None and not _dtp_memoizable(trial):
+        cache = None
+    if cache is not None and key in cache:
+        dose, extra_output = cache[key]
+        return dose, copy.deepcopy(extra_output)
+
+    if verbose:
+        print('Running %s' % cases)
+    if seed is not None:
+        # Designs draw from the global generators, so seed those and then restore the caller's streams
+        np_state, random_state = np.random.get_state(), random.getstate()
+        seed_seq = _dtp_seed(seed, key)
+        np.random.seed(seed_seq)
+        random.seed(seed_seq[1] ^ seed_seq[0])
+    try:
+        trial.reset()
+        if set_next_dose:
+            trial.set_next_dose(next_dose)
+        dose = trial.update(cases, **kwargs)
+        extra_output = custom_output_func(trial) if custom_output_func else {}
+    finally:
+        if seed is not None:
+            np.random.set_state(np_state)
+            random.setstate(random_state)
+    if cache is not None:
+        cache[key] = (dose, copy.deepcopy(extra_output))
+    return dose, extra_output
+
+
+def _dtp_executor(n_jobs=None, executor=None):
+    """ Get the executor to which DTP subtrees are submitted.
+
+    :param n_jobs: number of worker processes, or None to compute serially unless executor is given
+    :type n_jobs: int
+    :param executor: a concurrent.futures.Executor to use rather than a process pool of n_jobs workers
+    :type executor: concurrent.futures.Executor
+    :return: 2-tuple, (executor or None, True if the executor was created here and should be shut down by the caller)
+    :rtype: tuple
+
+    """
+
+    if executor is not None:
+        return executor, False
+    elif n_jobs is not None and n_jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(max_workers=n_jobs), True
+    else:
+        return None, False
+
+
+def _resolve_dtp_futures(dtps):
+    """ Replace the futures of subtrees computed in parallel with their results, in place and in order. """
+    if dtps is None:
+        return None
+    for x in dtps:
+        if 'Next' in x:
+            if hasattr(x['Next'], 'result'):
+                further_paths = x['Next'].result()
+                if further_paths:
+                    x['Next'] = further_paths
+                else:
+                    del x['Next']
+            else:
+                _resolve_dtp_futures(x['Next'])
+    return dtps
+
+
 def dose_transition_pathways_to_json(trial, next_dose, cohort_sizes, cohort_number=1, cases_already_observed=[],
-                                     custom_output_func=None, verbose=False, **kwargs):
+                                     custom_output_func=None, verbose=False, memoize=True, n_jobs=None,
+                                     executor=None, parallel_depth=1, seed=None, _cache=None, _depth=0,
+                                     _executor=None, **kwargs):
     """ Calculate the dose-transition pathways of a DoseFindingTrial.
 
+    Paths that reach the same sufficient statistics, i.e. the same number of patients treated and toxicities seen
+    at each dose with the same current dose, reach the same decision. With memoize=True, each such state is
+    evaluated just once.
+
+    With n_jobs or executor, the subtrees below the first parallel_depth cohorts are computed in parallel, each on its
+    own deep copy of trial, and merged back in order. The result is identical to a serial run, provided that designs
+    that use Monte Carlo methods are given a seed.
+
     :param trial: subclass of DoseFindingTrial that will determine the dose path
     :type trial: clintrials.dosefinding.DoseFindingTrial
     :param next_dose: the dose that will be given to patients in the very next cohort to get things going.
@@ -742,6 +1481,20 @@ def dose_transition_pathways_to_json(trial, next_dose, cohort_sizes, cohort_numb
     :type custom_output_func: func
     :param verbose: True to print extra information to monitor progress
     :type verbose: bool
+    :param memoize: True to evaluate each distinct state once; False to replay the trial at every node.
+                    Designs whose decisions may depend on the order of patients, i.e. those with a
+                    principle_escalation_func, are always replayed.
+    :type memoize: bool
+    :param n_jobs: number of worker processes to compute subtrees in parallel; None to compute serially
+    :type n_jobs: int
+    :param executor: a concurrent.futures.Executor to compute subtrees in parallel, in preference to n_jobs.
+                        Trial, custom_output_func and kwargs must be picklable for a process pool.
+    :type executor: concurrent.futures.Executor
+    :param parallel_depth: number of cohorts to compute serially before subtrees are fanned out
+    :type parallel_depth: int
+    :param seed: if not None, the random number generators are seeded from seed and the sufficient-statistic state
+                    before each decision, so that Monte Carlo designs give reproducible DTPs
+    :type seed: int
     :param kwargs: extra keyword args to send to trial.update method
     :type kwargs: dict
 
@@ -754,6 +1507,22 @@ def dose_transition_pathways_to_json(trial, next_dose, cohort_sizes, cohort_numb
         return None
     else:
         cohort_size = cohort_sizes[0]
+        if memoize and _cache is None:
+            _cache = {}
+        if _depth == 0:
+            _executor, shutdown = _dtp_executor(n_jobs, executor)
+            if _executor is not None:
+                try:
+                    dtps = dose_transition_pathways_to_json(
+                        trial, next_dose, cohort_sizes, cohort_number=cohort_number,
+                        cases_already_observed=cases_already_observed, custom_output_func=custom_output_func,
+                        verbose=verbose, memoize=memoize, parallel_depth=parallel_depth, seed=seed, _cache=_cache,
+                        _depth=1, _executor=_executor, **kwargs)
+                    return _resolve_dtp_futures(dtps)
+                finally:
+                    if shutdown:
+                        _executor.shutdown()
+            _depth = 1
 
         path_outputs = []
         possible_dlts = range(0, cohort_size+1)
@@ -763,19 +1532,9 @@ def dose_transition_pathways_to_json(trial, next_dose, cohort_sizes, cohort_numb
             # Invoke dose-decision
             cohort_cases = [(next_dose, 1)] * num_dlts + [(next_dose, 0)] * (cohort_size - num_dlts)
             cases = cases_already_observed + cohort_cases
-            if verbose:
-                print('Running %s' % cases)
-            trial.reset()
-            # print 'next_dose is', trial.next_dose()
-            trial.set_next_dose(next_dose)
-            # print 'Now next_dose is', trial.next_dose()
-            mtd = trial.update(cases, **kwargs)
-            # print 'And now next_dose is', trial.next_dose()
-
-            # Or:
-            # mtd = trial.update(cases_already_observed, **kwargs)
-            # trial.set_next_dose(next_dose)
-            # mtd = trial.update(cohort_cases, **kwargs)
+            mtd, extra_output = _dtp_decision(trial, cases, next_dose, _cache if memoize else None,
+                                              custom_output_func=custom_output_func, set_next_dose=True,
+                                              verbose=verbose, seed=seed, **kwargs)
 
             # Collect output
             bag_o_tricks = OrderedDict([('Pat{}.{}'.format(cohort_number, j+1), 'Tox' if tox else 'No Tox')
@@ -787,14 +1546,20 @@ def dose_transition_pathways_to_json(trial, next_dose, cohort_sizes, cohort_numb
                         ('CohortSize', cohort_size),
                         ('NumTox', atomic_to_json(num_dlts)),
                     ]))
-            if custom_output_func:
-                bag_o_tricks.update(custom_output_func(trial))
+            bag_o_tricks.update(extra_output)
 
             # Recurse subsequent cohorts
-            further_paths = dose_transition_pathways_to_json(trial, next_dose=mtd, cohort_sizes=cohort_sizes[1:],
-                                                     cohort_number=cohort_number+1, cases_already_observed=cases,
-                                                     custom_output_func=custom_output_func, verbose=verbose,
-                                                     **kwargs)
+            if _executor is not None and _depth >= parallel_depth and len(cohort_sizes) > 1:
+                further_paths = _executor.submit(
+                    dose_transition_pathways_to_json, copy.deepcopy(trial), next_dose=mtd,
+                    cohort_sizes=cohort_sizes[1:], cohort_number=cohort_number+1, cases_already_observed=cases,
+                    custom_output_func=custom_output_func, verbose=verbose, memoize=memoize, seed=seed, **kwargs)
+            else:
+                further_paths = dose_transition_pathways_to_json(
+                    trial, next_dose=mtd, cohort_sizes=cohort_sizes[1:], cohort_number=cohort_number+1,
+                    cases_already_observed=cases, custom_output_func=custom_output_func, verbose=verbose,
+                    memoize=memoize, parallel_depth=parallel_depth, seed=seed, _cache=_cache, _depth=_depth+1,
+                    _executor=_executor, **kwargs)
             if further_paths:
                 bag_o_tricks['Next'] = further_paths
 
@@ -843,9 +1608,125 @@ def dtps_to_pandas(dtps, dose_label_func=None):
     rows = _dtps_to_rows(dtps, dose_label_func=dose_label_func)
     df = pd.DataFrame(rows)
     ncols = df.shape[1]
+    df.columns = dtp_columns(int(ncols / 2))
+
+    return df
+
+
+def dtp_columns(num_cohorts, outcome_label='DLTs'):
+    """ Get the column names of a flat table of DTPs, with one row per path.
+
+    :param num_cohorts: number of cohorts in each path
+    :type num_cohorts: int
+    :param outcome_label: label for the outcome of each cohort
+    :type outcome_label: str
+    :return: list of column names, alternating cohort outcome and the dose recommended for the next cohort
+    :rtype: list
+
+    >>> dtp_columns(2)
+    ['Cohort 1 DLTs', 'Cohort 2 Dose', 'Cohort 2 DLTs', 'Cohort 3 Dose']
+
+    """
+
     cols = []
-    for i in range(1, 1 + int(ncols / 2)):
-        cols.extend(['Cohort {} DLTs'.format(i), 'Cohort {} Dose'.format(i+1)])
-    df.columns = cols
+    for i in range(1, 1 + num_cohorts):
+        cols.extend(['Cohort {} {}'.format(i, outcome_label), 'Cohort {} Dose'.format(i+1)])
+    return cols
 
-    return df
\ No newline at end of file
+
+def dose_transition_pathway_rows(trial, next_dose, cohort_sizes, cases_already_observed=[], dose_label_func=None,
+                                 memoize=True, seed=None, _cache=None, _prefix=(), **kwargs):
+    """ Generate the dose-transition pathways of a DoseFindingTrial as flat rows, one per path.
+
+    Rows are yielded as the paths are calculated, so the nested structure returned by
+    :func:`dose_transition_pathways_to_json` is never held in memory. Rows appear in the same order and with the same
+    values as in :func:`dtps_to_pandas`, i.e. the number of DLTs in each cohort followed by the dose recommended.
+
+    :param trial: subclass of DoseFindingTrial that will determine the dose path
+    :type trial: clintrials.dosefinding.DoseFindingTrial
+    :param next_dose: the dose that will be given to patients in the very next cohort to get things going.
+    :type next_dose: int
+    :param cohort_sizes: list of ints, sizes of future cohorts that we want to calculate DTPs for.
+    :type cohort_size: list
+    :param cases_already_observed: list of (dose, tox=0/1) cases that have already been observed
+    :type cases_already_observed: list
+    :param dose_label_func: func to convert each recommended dose to its label in the row. None for str, as in
+                            dtps_to_pandas.
+    :type dose_label_func: func
+    :param memoize: True to evaluate each distinct state once; False to replay the trial at every node.
+                    Designs with a principle_escalation_func are always replayed.
+    :type memoize: bool
+    :param seed: if not None, the random number generators are seeded from seed and the sufficient-statistic state
+                    before each decision, so that Monte Carlo designs give reproducible DTPs
+    :type seed: int
+    :param kwargs: extra keyword args to send to trial.update method
+    :type kwargs: dict
+    :return: generator of lists, with columns given by dtp_columns(len(cohort_sizes))
+    :rtype: generator
+
+    """
+
+    if len(cohort_sizes) <= 0:
+        return
+    if dose_label_func is None:
+        dose_label_func = lambda x: str(x)
+    if memoize and _cache is None:
+        _cache = {}
+    cohort_size = cohort_sizes[0]
+    for num_dlts in range(0, cohort_size+1):
+        cohort_cases = [(next_dose, 1)] * num_dlts + [(next_dose, 0)] * (cohort_size - num_dlts)
+        cases = cases_already_observed + cohort_cases
+        mtd, _ = _dtp_decision(trial, cases, next_dose, _cache if memoize else None, set_next_dose=True, seed=seed,
+                               **kwargs)
+        row = _prefix + (num_dlts, dose_label_func(atomic_to_json(mtd)))
+        if len(cohort_sizes) > 1:
+            for further_row in dose_transition_pathway_rows(trial, mtd, cohort_sizes[1:], cases_already_observed=cases,
+                                                            dose_label_func=dose_label_func, memoize=memoize,
+                                                            seed=seed, _cache=_cache, _prefix=row, **kwargs):
+                yield further_row
+        else:
+            yield list(row)
+
+
+def dtp_rows_to_csv(rows, path_or_buf, columns=None):
+    """ Write rows of DTPs to CSV as they are generated.
+
+    :param rows: iterable of rows, e.g. from :func:`dose_transition_pathway_rows`
+    :type rows: iterable
+    :param path_or_buf: file path or open file-like object
+    :type path_or_buf: str or file
+    :param columns: optional list of column names to write as a header, e.g. from :func:`dtp_columns`
+    :type columns: list
+    :return: number of rows written
+    :rtype: int
+
+    """
+
+    if not hasattr(path_or_buf, 'write'):
+        with open(path_or_buf, 'w') as f:
+            return dtp_rows_to_csv(rows, f, columns=columns)
+
+    writer = csv.writer(path_or_buf, lineterminator='\n')
+    if columns is not None:
+        writer.writerow(columns)
+    num_rows = 0
+    for row in rows:
+        writer.writerow(row)
+        num_rows += 1
+    return num_rows
+
+
+def dtp_rows_to_pandas(rows, columns=None):
+    """ Collect rows of DTPs into a pandas.DataFrame.
+
+    :param rows: iterable of rows, e.g. from :func:`dose_transition_pathway_rows`
+    :type rows: iterable
+    :param columns: optional list of column names, e.g. from :func:`dtp_columns`
+    :type columns: list
+    :return: table of DTPs, one row per path
+    :rtype: pandas.DataFrame
+
+    """
+
+    import pandas as pd
+    return pd.DataFrame.from_records(list(rows), columns=columns)
@@ -2,18 +2,28 @@ __author__ = 'Kristian Brock'
 __contact__ = 'kristian.brock@gmail.com'
 
 from collections import OrderedDict
+import copy
 import logging
 import numpy as np
-from scipy.stats import norm
+from scipy.stats import norm, uniform
 from scipy.integrate import quad, trapz
-from scipy.optimize import minimize
-
-from clintrials.dosefinding import DoseFindingTrial
-from clintrials.common import empiric, logistic, inverse_empiric, inverse_logistic
+try:
+    from scipy.integrate import quad_vec
+except ImportError:
+    quad_vec = None  # scipy < 1.4
+from scipy.optimize import minimize, brentq
+
+from clintrials.dosefinding import DoseFindingTrial, _CaseHistory
+from clintrials.common import (empiric, logistic, inverse_empiric, inverse_logistic, empiric_derivatives,
+                               logistic_derivatives)
+from clintrials.quadrature import GaussHermitePosterior, integration_method as _integration_method
 from clintrials.util import atomic_to_json, iterable_to_json
 
 
 _min_beta, _max_beta = -10, 10
+_num_grid_points = 1001  # Resolution of the fixed beta grid used by CRM instances with use_quick_integration=True
+# Link functions with analytic derivatives in beta, used by the Newton-Raphson MLE
+_link_derivatives = {empiric: empiric_derivatives, logistic: logistic_derivatives}
 
 
 def _toxicity_likelihood(link_func, a0, beta, dose, tox, log=False):
@@ -41,6 +51,57 @@ def _toxicity_likelihood(link_func, a0, beta, dose, tox, log=False):
         return p ** tox * (1 - p) ** (1 - tox)
 
 
+def _toxicity_counts(doses, toxs):
+    """ Collapse many dose & tox pairs into the per-dose counts that are sufficient for the CRM likelihood.
+
+    Params:
+    doses, a list of the first parameters to link_func, the dose labels (often derived by backwards substitution!)
+    toxs, a list of toxicity markers. Use 1 if toxicity observed, 0 if not. Should be same length as doses.
+
+    Returns a 3-tuple of numpy arrays, (distinct dose labels, number treated at each, number of toxicities at each)
+
+    """
+
+    if len(doses) != len(toxs):
+        raise ValueError('doses and toxs should be same length.')
+
+    dose_labels, inverse = np.unique(np.asarray(doses, dtype=float), return_inverse=True)
+    num_treated = np.bincount(inverse, minlength=len(dose_labels))
+    num_toxes = np.bincount(inverse, weights=np.asarray(toxs, dtype=float), minlength=len(dose_labels))
+    return dose_labels, num_treated, num_toxes
+
+
+def _toxicity_log_likelihood_from_counts(link_func, a0, beta, dose_labels, num_treated, num_toxes):
+    """ Calculate the compound log likelihood of toxicity outcomes in CRM from per-dose counts.
+
+    The likelihood depends on the data only via the number treated and number of toxicities at each dose, so the
+    cost of this function is proportional to the number of distinct doses, not the number of patients.
+    The method is vectorised in beta, so a whole grid of beta values is evaluated in one expression.
+
+    Params:
+    link_func, link function like logistic or empiric, taking params (dose_label, intercept, slope), returning a probability
+    a0, the second parameter to link_func, the intercept
+    beta, the third parameter to link_func, the slope. Scalar or numpy array.
+    dose_labels, the first parameters to link_func, the distinct dose labels, e.g. from _toxicity_counts
+    num_treated, number of patients treated at each of dose_labels
+    num_toxes, number of toxicities observed at each of dose_labels
+
+    Returns the log of a probability, with the same shape as beta
+
+    """
+
+    beta = np.asarray(beta, dtype=float)
+    shape = (-1,) + (1,) * beta.ndim
+    x = np.reshape(dose_labels, shape)
+    n = np.reshape(num_treated, shape)
+    t = np.reshape(num_toxes, shape)
+    # Empty cells contribute nothing, even where p is exactly 0 or 1
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        p = link_func(x, a0, beta)
+        log_l = np.where(t > 0, t * np.log(p), 0) + np.where(n - t > 0, (n - t) * np.log(1 - p), 0)
+    return np.sum(log_l, axis=0)
+
+
 def _compound_toxicity_likelihood(link_func, a0, beta, doses, toxs, log=False):
     """ Calculate the compound likelihood of many toxicity outcomes in CRM given many dose & tox pairs.
 
@@ -56,23 +117,16 @@ def _compound_toxicity_likelihood(link_func, a0, beta, doses, toxs, log=False):
 
     """
 
-    if len(doses) != len(toxs):
-        raise ValueError('doses and toxs should be same length.')
-
+    dose_labels, num_treated, num_toxes = _toxicity_counts(doses, toxs)
+    l = _toxicity_log_likelihood_from_counts(link_func, a0, beta, dose_labels, num_treated, num_toxes)
     if log:
-        l = 0
-        for dose, tox in zip(doses, toxs):
-            l += _toxicity_likelihood(link_func, a0, beta, dose, tox, log=True)
         return l
     else:
-        l = 1
-        for dose, tox in zip(doses, toxs):
-            l *= _toxicity_likelihood(link_func, a0, beta, dose, tox, log=False)
-        return l
+        return np.exp(l)
 
 
 def _get_beta_hat_bayes(F, intercept, codified_doses_given, toxs, beta_pdf, use_quick_integration=False,
-                        estimate_var=False):
+                        estimate_var=False, integration_method=None):
     """ Get posterior estimate of beta parameter (and optionally its variance) in Bayesian CRM.
 
     :param F: link function like logistic or empiric, taking params (dose_label, intercept, slope), returns probability
@@ -90,37 +144,45 @@ def _get_beta_hat_bayes(F, intercept, codified_doses_given, toxs, beta_pdf, use_
     :type use_quick_integration: bool
     :param estimate_var: True to estimate beta variance. False by default for speed.
     :type estimate_var: bool
+    :param integration_method: one of 'quad', 'trapezium' or 'gauss_hermite'; None to choose between the first two
+                                using use_quick_integration. See clintrials.quadrature.
+    :type integration_method: str
     :return: a 2-tuple, (posterior mean, posterior variance)
     :rtype: tuple
 
     """
 
-    if use_quick_integration:
+    dose_labels, num_treated, num_toxes = _toxicity_counts(codified_doses_given, toxs)
+    log_lik = lambda t: _toxicity_log_likelihood_from_counts(F, intercept, t, dose_labels, num_treated, num_toxes)
+    lik = lambda t: np.exp(log_lik(t))
+    integration_method = _integration_method(use_quick_integration, integration_method)
+
+    if integration_method == 'gauss_hermite':
+        # Gauss-Hermite quadrature centred on the posterior mode. Accurate and fast.
+        post = GaussHermitePosterior(lambda t: log_lik(t) + np.log(beta_pdf(t)))
+        beta_hat = post.mean()
+        var = post.var() if estimate_var else None
+    elif integration_method == 'trapezium':
         # This method uses simple trapezium quadrature. It is quite accurate and pretty fast.
         n = 100 * max(np.log(len(codified_doses_given) + 1) / 2, 1)  # My own rule of thumb
-        z, dz = np.linspace(_min_beta, _max_beta, num=n, retstep=1)
-        num_y = z * _compound_toxicity_likelihood(F, intercept, z, codified_doses_given, toxs) * beta_pdf(z)
-        denom_y = _compound_toxicity_likelihood(F, intercept, z, codified_doses_given, toxs) * beta_pdf(z)
-        num = trapz(num_y, z, dz)
+        z, dz = np.linspace(_min_beta, _max_beta, num=int(n), retstep=1)
+        denom_y = lik(z) * beta_pdf(z)
+        num = trapz(z * denom_y, z, dz)
         denom = trapz(denom_y, z, dz)
         beta_hat = num / denom
         if estimate_var:
-            num2_y = z ** 2 * _compound_toxicity_likelihood(F, intercept, z, codified_doses_given, toxs) * beta_pdf(z)
-            num2 = trapz(num2_y, z, dz)
+            num2 = trapz(z ** 2 * denom_y, z, dz)
             exp_x2 = num2 / denom
             var = exp_x2 - beta_hat ** 2
         else:
             var = None
     else:
         # This method uses numpy's adaptive quadrature method. Superior accuracy but quite slow
-        num = quad(lambda t: t * _compound_toxicity_likelihood(F, intercept, t, codified_doses_given, toxs) * \
-                             beta_pdf(t), -np.inf, np.inf)
-        denom = quad(lambda t: _compound_toxicity_likelihood(F, intercept, t, codified_doses_given, toxs) * \
-                               beta_pdf(t), -np.inf, np.inf)
+        num = quad(lambda t: t * lik(t) * beta_pdf(t), -np.inf, np.inf)
+        denom = quad(lambda t: lik(t) * beta_pdf(t), -np.inf, np.inf)
         beta_hat = num[0] / denom[0]
         if estimate_var:
-            num2 = quad(lambda t: t ** 2 * _compound_toxicity_likelihood(F, intercept, t, codified_doses_given, toxs) *
-                                  beta_pdf(t), -np.inf, np.inf)
+            num2 = quad(lambda t: t ** 2 * lik(t) * beta_pdf(t), -np.inf, np.inf)
             exp_x2 = num2[0] / denom[0]
             var = exp_x2 - beta_hat ** 2
         else:
@@ -129,10 +191,91 @@ def _get_beta_hat_bayes(F, intercept, codified_doses_given, toxs, beta_pdf, use_
     return beta_hat, var
 
 
-def _get_beta_hat_mle(F, intercept, codified_doses_given, toxs, estimate_var=False):
+def _get_beta_hat_mle_batch(F, intercept, dose_labels, num_treated, num_toxes, beta0=None, tol=1e-10,
+                            max_iter=100):
+    """ Get maximum likelihood estimates of beta, and their variances, for a batch of datasets by Newton-Raphson.
+
+    The score and observed information are calculated analytically from the derivatives of the link function. Steps
+    are halved until they increase the log likelihood and estimates are confined to [_min_beta, _max_beta].
+    The variance is the inverse of the observed information at the estimate.
+
+    :param F: link function with analytic derivatives, i.e. empiric or logistic
+    :type F: func
+    :param intercept: the second parameter to F, the intercept
+    :type intercept: float
+    :param dose_labels: the distinct dose labels, on the codified scale, i.e. each a valid first parameter to F
+    :type dose_labels: list
+    :param num_treated: (datasets x doses) array of number of patients treated at each of dose_labels
+    :type num_treated: numpy.array
+    :param num_toxes: (datasets x doses) array of number of toxicities at each of dose_labels
+    :type num_toxes: numpy.array
+    :param beta0: starting values, e.g. previous estimates. Scalar or one per dataset. None to start at 0.
+    :type beta0: numpy.array
+    :param tol: convergence tolerance on the Newton step
+    :type tol: float
+    :param max_iter: maximum number of Newton iterations
+    :type max_iter: int
+    :return: 2-tuple of arrays, (beta hats, variances). Both are nan for datasets that lack heterogeneity in toxic
+                events, in which case the MLE does not exist.
+    :rtype: tuple
+
+    """
+
+    derivs = _link_derivatives[F]
+    x = np.asarray(dose_labels, dtype=float)
+    n = np.atleast_2d(np.asarray(num_treated, dtype=float))
+    t = np.atleast_2d(np.asarray(num_toxes, dtype=float))
+    num_datasets = n.shape[0]
+    beta = np.zeros(num_datasets) if beta0 is None else np.array(np.broadcast_to(beta0, (num_datasets,)), dtype=float)
+    beta[~np.isfinite(beta)] = 0
+    beta = np.clip(beta, _min_beta, _max_beta)
+
+    total_toxes, total_treated = t.sum(axis=1), n.sum(axis=1)
+    exists = (total_toxes > 0) & (total_toxes < total_treated)
+
+    def log_lik(b, n, t):
+        p = F(x, a0=intercept, beta=b[:, np.newaxis])
+        return np.sum(np.where(t > 0, t * np.log(p), 0) + np.where(n - t > 0, (n - t) * np.log(1 - p), 0), axis=1)
+
+    def score_and_info(b, n, t):
+        p, dp, d2p = derivs(x, a0=intercept, beta=b[:, np.newaxis])
+        r = np.where(t > 0, t / p, 0) - np.where(n - t > 0, (n - t) / (1 - p), 0)
+        r2 = np.where(t > 0, t / p ** 2, 0) + np.where(n - t > 0, (n - t) / (1 - p) ** 2, 0)
+        return np.sum(dp * r, axis=1), np.sum(dp ** 2 * r2 - d2p * r, axis=1)
+
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        active = np.flatnonzero(exists)
+        for i in range(max_iter):
+            if len(active) == 0:
+                break
+            b, n_a, t_a = beta[active], n[active], t[active]
+            score, info = score_and_info(b, n_a, t_a)
+            # Newton step where the log likelihood is locally concave, else a unit step uphill
+            step = np.where(info > 0, score / info, np.sign(score))
+            l0 = log_lik(b, n_a, t_a)
+            new_b = np.clip(b + step, _min_beta, _max_beta)
+            for halving in range(50):
+                worse = ~(log_lik(new_b, n_a, t_a) >= l0)
+                if not np.any(worse):
+                    break
+                step = np.where(worse, step / 2, step)
+                new_b = np.clip(b + step, _min_beta, _max_beta)
+            beta[active] = new_b
+            active = active[np.abs(new_b - b) > tol]
+
+        score, info = score_and_info(beta, n, t)
+    var = 1 / info
+    beta[~exists] = np.nan
+    var[~exists | ~(info > 0)] = np.nan
+    return beta, var
+
+
+def _get_beta_hat_mle(F, intercept, codified_doses_given, toxs, estimate_var=False, beta0=None):
     """ Get maximum likelihood estimate of beta parameter (and optionally its variance) in MLE CRM.
 
-    TODO: how is estimating variance possible?
+    For the empiric and logistic links, the estimate is found by Newton-Raphson using the analytic score and
+    information, and the variance is the inverse of the observed information.
+    Other links are maximised by the Nelder-Mead method, without variance.
 
     :param F: link function like logistic or empiric, taking params (dose_label, intercept, slope), returns probability
     :type F: func
@@ -142,28 +285,30 @@ def _get_beta_hat_mle(F, intercept, codified_doses_given, toxs, estimate_var=Fal
     :type codified_doses_given: list
     :param toxs: observed toxicity events. Use 1 if toxicity observed, else 0. Congruent to codified_doses_given.
     :type toxs: list
-    :param beta_pdf: PDF of beta's prior distribution
-    :type beta_pdf: func
-    :param use_quick_integration: True to use a faster but slightly less accurate estimate of the integrals;
-                                  False to use a slower but more accurate method.
-    :type use_quick_integration: bool
     :param estimate_var: True to estimate beta variance. False by default for speed.
     :type estimate_var: bool
-    :return: a 2-tuple, (posterior mean, posterior variance)
+    :param beta0: starting value for the search, e.g. the previous estimate. None to start at 0.
+    :type beta0: float
+    :return: a 2-tuple, (maximum likelihood estimate, variance)
     :rtype: tuple
 
     """
     if sum(np.array(toxs) == 1) == 0 or sum(np.array(toxs) == 0) == 0:
         msg = 'Need heterogeneity in toxic events (i.e. toxic and non-toxic outcomes must be observed) for MLE to ' \
               'exist. See Cheung p.23.'
-        logging.warn()
-        return np.nan, None
+        logging.warn(msg)
+        return np.nan, np.nan if estimate_var else None
+
+    dose_labels, num_treated, num_toxes = _toxicity_counts(codified_doses_given, toxs)
+    if F in _link_derivatives:
+        beta_hat, var = _get_beta_hat_mle_batch(F, intercept, dose_labels, num_treated, num_toxes, beta0=beta0)
+        return beta_hat[0], var[0] if estimate_var else None
 
-    f = lambda beta: -1 * _compound_toxicity_likelihood(F, intercept, beta, codified_doses_given, toxs, log=True)
-    res = minimize(f, x0=0, method='nelder-mead')
+    f = lambda beta: -1 * _toxicity_log_likelihood_from_counts(F, intercept, beta, dose_labels, num_treated,
+                                                               num_toxes)
+    res = minimize(f, x0=0 if beta0 is None or not np.isfinite(beta0) else beta0, method='nelder-mead')
     if estimate_var:
-        logging.warn('Variance estimation in MLE mode is not implemented because I do not think it makes sense. \
-        In dfcrm, Ken Cheung uses a method that I do not understand. It yields comparatively huge variances.')
+        logging.warn('Variance estimation in MLE mode is only implemented for the empiric and logistic links.')
     return res.x[0], None
 
 
@@ -187,7 +332,8 @@ def _estimate_prob_tox_from_param(F, intercept, beta_hat, dose_labels):
     return post_tox
 
 
-def _get_post_tox_bayes(F, intercept, dose_labels, codified_doses_given, toxs, beta_pdf, use_quick_integration=False):
+def _get_post_tox_bayes(F, intercept, dose_labels, codified_doses_given, toxs, beta_pdf, use_quick_integration=False,
+                        integration_method=None):
     """ Calculate the posterior probability of toxicity at doses using the Bayesian integral
 
     :param F: link function like logistic or empiric, taking params (dose_label, intercept, slope), returns probability
@@ -205,40 +351,152 @@ def _get_post_tox_bayes(F, intercept, dose_labels, codified_doses_given, toxs, b
     :param use_quick_integration: True to use a faster but slightly less accurate estimate of the integrals;
                                   False to use a slower but more accurate method.
     :type use_quick_integration: bool
+    :param integration_method: one of 'quad', 'trapezium' or 'gauss_hermite'; None to choose between the first two
+                                using use_quick_integration. See clintrials.quadrature.
+    :type integration_method: str
     :return: estimates of Pr(Tox) at each dose
     :rtype: list
 
     """
 
-    post_tox = []
-    if use_quick_integration:
+    dose_labels_given, num_treated, num_toxes = _toxicity_counts(codified_doses_given, toxs)
+    log_lik = lambda t: _toxicity_log_likelihood_from_counts(F, intercept, t, dose_labels_given, num_treated,
+                                                             num_toxes)
+    lik = lambda t: np.exp(log_lik(t))
+    integration_method = _integration_method(use_quick_integration, integration_method)
+
+    # The posterior weights are evaluated once per node and reduced against a (doses x nodes) matrix of F values
+    x = np.reshape(np.asarray(dose_labels, dtype=float), (-1, 1))
+    if integration_method == 'gauss_hermite':
+        # Gauss-Hermite quadrature centred on the posterior mode. Accurate and fast.
+        post = GaussHermitePosterior(lambda t: log_lik(t) + np.log(beta_pdf(t)))
+        post_tox = list(post.expect(lambda t: F(x, a0=intercept, beta=t)))
+    elif integration_method == 'trapezium':
         # This method uses simple trapezium quadrature. It is quite accurate and pretty fast.
         n = 100 * max(np.log(len(codified_doses_given) + 1) / 2, 1)  # My own rule of thumb
-        z, dz = np.linspace(_min_beta, _max_beta, num=n, retstep=1)
-        denom_y = _compound_toxicity_likelihood(F, intercept, z, codified_doses_given, toxs) * beta_pdf(z)
-        denom = trapz(denom_y, z, dz)
-        # num_scale = _compound_toxicity_likelihood(F, intercept, z, codified_doses_given, toxs) * beta_pdf(z)
-        for x in dose_labels:
-            num_y = F(x, a0=intercept, beta=z) * denom_y
-            num = trapz(num_y, z, dz)
-            post_tox.append(num / denom)
+        z = np.linspace(_min_beta, _max_beta, num=int(n))
+        denom_y = lik(z) * beta_pdf(z)
+        denom = trapz(denom_y, z)
+        num = trapz(F(x, a0=intercept, beta=z) * denom_y, z, axis=1)
+        post_tox = list(num / denom)
+    elif quad_vec is not None:
+        # Adaptive quadrature of the vector of integrands for all doses, and the normalising constant, at once
+        integrals = quad_vec(lambda t: beta_pdf(t) * lik(t) * np.append(1, F(x[:, 0], a0=intercept, beta=t)),
+                             -np.inf, np.inf)[0]
+        post_tox = list(integrals[1:] / integrals[0])
     else:
         # This method uses numpy's adaptive quadrature method. Superior accuracy but quite slow
-        denom = quad(lambda t: beta_pdf(t) * \
-                               _compound_toxicity_likelihood(F, intercept, t, codified_doses_given, toxs),
-                     -np.inf, np.inf)
-        for x in dose_labels:
-            num = quad(lambda t: F(x, a0=intercept, beta=t) * beta_pdf(t) * \
-                                 _compound_toxicity_likelihood(F, intercept, t, codified_doses_given, toxs),
-                       -np.inf, np.inf)
+        post_tox = []
+        denom = quad(lambda t: beta_pdf(t) * lik(t), -np.inf, np.inf)
+        for label in dose_labels:
+            num = quad(lambda t: F(label, a0=intercept, beta=t) * beta_pdf(t) * lik(t), -np.inf, np.inf)
             post_tox.append(num[0] / denom[0])
 
     return post_tox
 
 
+def _beta_grid(beta_dist, num=_num_grid_points):
+    """ Get a fixed grid for beta, with trapezium quadrature weights and the log prior density at each point.
+
+    :param beta_dist: prior distibution for beta parameter, assumes interface like scipy.stats.rv_continuous
+    :type beta_dist: scipy.stats.rv_continuous
+    :param num: number of grid points
+    :type num: int
+    :return: 3-tuple of numpy arrays, (grid points, quadrature weights, log prior density)
+    :rtype: tuple
+
+    """
+
+    z, dz = np.linspace(_min_beta, _max_beta, num=int(num), retstep=True)
+    w = np.full(len(z), dz)
+    w[0] = w[-1] = dz / 2.
+    return z, w, beta_dist.logpdf(z)
+
+
+def _grid_posterior_weights(w, log_post):
+    """ Convert an unnormalised log posterior on a grid to normalised posterior quadrature weights.
+
+    The log posterior is shifted by its maximum before exponentiating so that the weights cannot underflow, no matter
+    how many cases have been observed.
+
+    :param w: quadrature weights for the grid, e.g. from _beta_grid
+    :type w: numpy.array
+    :param log_post: unnormalised log posterior density at each grid point
+    :type log_post: numpy.array
+    :return: weights that sum to 1, such that the posterior expectation of g(beta) is sum(weights * g(grid))
+    :rtype: numpy.array
+
+    """
+
+    pw = w * np.exp(log_post - np.max(log_post))
+    return pw / np.sum(pw)
+
+
+def _beta_threshold(F, intercept, dose_label, tox_cutoff):
+    """ Find the value of beta at which the probability of toxicity at a dose equals tox_cutoff.
+
+    The link functions in CRM are monotonic in beta so the event Prob(Tox) > tox_cutoff is equivalent to beta lying on
+    one side of a threshold.
+
+    :param F: link function like logistic or empiric, taking params (dose_label, intercept, slope), returns probability
+    :type F: func
+    :param intercept: the second parameter to F, the intercept
+    :type intercept: float
+    :param dose_label: the first parameter to F, the dose label
+    :type dose_label: float
+    :param tox_cutoff: the probability of toxicity
+    :type tox_cutoff: float
+    :return: 2-tuple, (threshold, increasing), where increasing is True if Prob(Tox) increases in beta.
+                threshold is -inf or inf if Prob(Tox) does not cross tox_cutoff for beta in [_min_beta, _max_beta].
+    :rtype: tuple
+
+    """
+
+    with np.errstate(over='ignore'):
+        g = lambda b: F(dose_label, a0=intercept, beta=b) - tox_cutoff
+        g_min, g_max = g(_min_beta), g(_max_beta)
+    increasing = bool(g_max >= g_min)
+    if g_min * g_max < 0:
+        return brentq(g, _min_beta, _max_beta), increasing
+    elif (g_min > 0) == increasing:
+        # Exceeds cutoff everywhere in range
+        return (-np.inf if increasing else np.inf), increasing
+    else:
+        # Exceeds cutoff nowhere in range
+        return (np.inf if increasing else -np.inf), increasing
+
+
+def _prob_tox_exceeds_normal(F, intercept, dose_label, tox_cutoff, beta_hat, beta_var):
+    """ Calculate Prob(Prob(Tox) > tox_cutoff) at a dose when beta is normally distributed.
+
+    This is the limit of the Monte Carlo estimate made by sampling beta from N(beta_hat, beta_var).
+    The function is vectorised in beta_hat and beta_var.
+
+    :param F: link function like logistic or empiric, taking params (dose_label, intercept, slope), returns probability
+    :type F: func
+    :param intercept: the second parameter to F, the intercept
+    :type intercept: float
+    :param dose_label: the first parameter to F, the dose label
+    :type dose_label: float
+    :param tox_cutoff: the probability of toxicity
+    :type tox_cutoff: float
+    :param beta_hat: mean of beta
+    :type beta_hat: float
+    :param beta_var: variance of beta
+    :type beta_var: float
+    :return: probability that the probability of toxicity exceeds tox_cutoff
+    :rtype: float
+
+    """
+
+    threshold, increasing = _beta_threshold(F, intercept, dose_label, tox_cutoff)
+    z = (threshold - np.asarray(beta_hat)) / np.sqrt(beta_var)
+    return norm.sf(z) if increasing else norm.cdf(z)
+
+
 def crm(prior, target, toxicities, dose_levels, intercept=3, F_func=logistic, inverse_F=inverse_logistic,
         beta_dist=norm(loc=0, scale=np.sqrt(1.34)), method="bayes", use_quick_integration=False,
-        estimate_var=False, plugin_mean=True):
+        estimate_var=False, plugin_mean=True, integration_method=None, beta_start=None):
     """
     Run CRM calculation on observed dosages and toxicities.
 
@@ -272,6 +530,12 @@ def crm(prior, target, toxicities, dose_levels, intercept=3, F_func=logistic, in
     :param plugin_mean: True to estimate toxicity curve by plugging beta estimate (posterior mean or mle) into function;
                         False to estimate using full Bayesian integral (only applies when method="bayes")
     :type plugin_mean: bool
+    :param integration_method: one of 'quad', 'trapezium' or 'gauss_hermite'; None to choose between the first two
+                                using use_quick_integration. See clintrials.quadrature.
+    :type integration_method: str
+    :param beta_start: starting value for the search for the MLE, e.g. the previous estimate. Only pertinent under
+                        method="mle". None to start at 0.
+    :type beta_start: float
     :return: 4-tuple, (recommended dose index (1-based), beta hat estimate, beta variance estimate, Pr(Tox) estimates)
     :rtype: tuple
 
@@ -288,15 +552,15 @@ def crm(prior, target, toxicities, dose_levels, intercept=3, F_func=logistic, in
     dose_labels = [inverse_F(p, a0=intercept, beta=beta0) for p in prior]
     if method == 'bayes':
         beta_hat, var = _get_beta_hat_bayes(F_func, intercept, codified_doses, toxicities, beta_dist.pdf,
-                                            use_quick_integration, estimate_var)
+                                            use_quick_integration, estimate_var, integration_method)
         if plugin_mean:
             post_tox = _estimate_prob_tox_from_param(F_func, intercept, beta_hat, dose_labels)
         else:
             # Bayesian integral
             post_tox = _get_post_tox_bayes(F_func, intercept, dose_labels, codified_doses, toxicities, beta_dist.pdf,
-                                           use_quick_integration)
+                                           use_quick_integration, integration_method)
     elif method == 'mle':
-        beta_hat, var = _get_beta_hat_mle(F_func, intercept, codified_doses, toxicities, estimate_var)
+        beta_hat, var = _get_beta_hat_mle(F_func, intercept, codified_doses, toxicities, estimate_var, beta_start)
         post_tox = _estimate_prob_tox_from_param(F_func, intercept, beta_hat, dose_labels)
     else:
         msg = "Only 'bayes' and 'mle' methods are implemented."
@@ -337,7 +601,7 @@ class CRM(DoseFindingTrial):
                  avoid_skipping_untried_escalation=False, avoid_skipping_untried_deescalation=False,
                  lowest_dose_too_toxic_hurdle=0.0, lowest_dose_too_toxic_certainty=0.0,
                  coherency_threshold=0.0, principle_escalation_func=None, termination_func=None, plugin_mean=True,
-                 intercept=3):
+                 intercept=3, integration_method=None):
         """
 
         Params:
@@ -361,6 +625,8 @@ class CRM(DoseFindingTrial):
                                 method; False to use a quick but approximate method.
                                 In simulations, fast and approximate often suffices.
                                 In trial scenarios, use slow and accurate!
+                                In Bayes mode, the quick method caches the log posterior on a fixed grid of beta
+                                values and updates it with only the new cases at each decision.
         :type use_quick_integration: bool
         :param estimate_var: True to estimate the posterior variance of beta
         :type estimate_var: bool
@@ -399,6 +665,11 @@ class CRM(DoseFindingTrial):
         :type plugin_mean: bool
         :param intercept: the second parameter to F, the intercept. Only pertinent under logistic method.
         :type intercept: float
+        :param integration_method: one of 'quad', 'trapezium' or 'gauss_hermite'; None to choose between the first
+                                two using use_quick_integration. Gauss-Hermite quadrature is centred on the posterior
+                                mode and offers accuracy like 'quad' at a cost like 'trapezium'. Its error estimate
+                                for each decision is kept in integration_error. See clintrials.quadrature.
+        :type integration_method: str
 
         """
 
@@ -421,22 +692,121 @@ class CRM(DoseFindingTrial):
         self.termination_func = termination_func
         self.plugin_mean = plugin_mean
         self.intercept = intercept
+        self.integration_method = _integration_method(use_quick_integration, integration_method)
         if lowest_dose_too_toxic_hurdle and lowest_dose_too_toxic_certainty:
             if not self.estimate_var:
                 logging.warn('To monitor toxicity at lowest dose, I had to enable beta variance estimation.')
             self.estimate_var = True
+        self._dose_labels = np.array([inverse_F(p, a0=intercept, beta=beta_prior.mean()) for p in prior])
+        if method == 'bayes' and self.integration_method == 'trapezium':
+            # Posterior is cached on a fixed grid and updated with only the new cases at each decision
+            self._grid, self._grid_weights, self._log_prior = _beta_grid(beta_prior)
+        else:
+            self._grid, self._grid_weights, self._log_prior = None, None, None
         # Reset
         self.beta_hat, self.beta_var = beta_prior.mean(), beta_prior.var()
         self.post_tox = list(self.prior)
+        self._log_post = self._log_prior
+        self._num_cases_absorbed = 0
+        self.integration_error = None
 
     def _DoseFindingTrial__reset(self):
         self.beta_hat, self.beta_var = self.beta_prior.mean(), self.beta_prior.var()
         self.post_tox = self.prior
+        self._log_post = self._log_prior
+        self._num_cases_absorbed = 0
+        self.integration_error = None
+
+    def _DoseFindingTrial__snapshot(self):
+        # The cached log posterior is replaced, never modified in place, so forks can share it until they update
+        return {
+            'beta_hat': self.beta_hat,
+            'beta_var': self.beta_var,
+            'post_tox': list(self.post_tox),
+            'log_post': self._log_post,
+            'num_cases_absorbed': self._num_cases_absorbed,
+            'integration_error': self.integration_error,
+        }
+
+    def _DoseFindingTrial__restore(self, state):
+        self.beta_hat = state['beta_hat']
+        self.beta_var = state['beta_var']
+        self.post_tox = list(state['post_tox'])
+        self._log_post = state['log_post']
+        self._num_cases_absorbed = state['num_cases_absorbed']
+        self.integration_error = state['integration_error']
+
+    def _update_log_posterior(self):
+        """ Add the log likelihood of cases not yet seen to the cached log posterior on the beta grid. """
+        if self._num_cases_absorbed > len(self._doses):
+            # Cases have been removed behind our back so start again from the prior
+            self._log_post = self._log_prior
+            self._num_cases_absorbed = 0
+        new_doses = self._doses[self._num_cases_absorbed:]
+        if len(new_doses) > 0:
+            new_toxs = self._toxicities[self._num_cases_absorbed:]
+            codified_doses = self._dose_labels[np.asarray(new_doses, dtype=int) - 1]
+            dose_labels, num_treated, num_toxes = _toxicity_counts(codified_doses, new_toxs)
+            self._log_post = self._log_post + _toxicity_log_likelihood_from_counts(
+                self.F_func, self.intercept, self._grid, dose_labels, num_treated, num_toxes)
+            self._num_cases_absorbed += len(new_doses)
+
+    def _grid_crm(self):
+        """ Run the Bayesian CRM calculation as reductions over the cached log posterior on the beta grid.
+
+        :return: 4-tuple, like that returned by crm
+        :rtype: tuple
+
+        """
+
+        self._update_log_posterior()
+        z = self._grid
+        pw = _grid_posterior_weights(self._grid_weights, self._log_post)
+        beta_hat = np.sum(z * pw)
+        var = np.sum(z ** 2 * pw) - beta_hat ** 2 if self.estimate_var else None
+        if self.plugin_mean:
+            post_tox = _estimate_prob_tox_from_param(self.F_func, self.intercept, beta_hat, self._dose_labels)
+        else:
+            post_tox = list(np.dot(self.F_func(self._dose_labels[:, np.newaxis], a0=self.intercept, beta=z), pw))
+        dose = np.argmin(np.abs(np.array(post_tox) - self.target)) + 1
+        return dose, beta_hat, var, post_tox
+
+    def _gauss_hermite_crm(self):
+        """ Run the Bayesian CRM calculation using Gauss-Hermite quadrature centred on the posterior mode.
+
+        The largest estimated absolute error in the posterior quantities is saved in integration_error.
+
+        :return: 4-tuple, like that returned by crm
+        :rtype: tuple
+
+        """
+
+        codified_doses = self._dose_labels[np.asarray(self._doses, dtype=int) - 1]
+        dose_labels, num_treated, num_toxes = _toxicity_counts(codified_doses, self._toxicities)
+        log_post = lambda t: _toxicity_log_likelihood_from_counts(self.F_func, self.intercept, t, dose_labels,
+                                                                  num_treated, num_toxes) + self.beta_prior.logpdf(t)
+        post = GaussHermitePosterior(log_post)
+        beta_hat = post.mean()
+        errors = [post.error()]
+        if self.estimate_var:
+            var = post.var()
+            errors.append(post.error(lambda t: (t - beta_hat) ** 2))
+        else:
+            var = None
+        if self.plugin_mean:
+            post_tox = _estimate_prob_tox_from_param(self.F_func, self.intercept, beta_hat, self._dose_labels)
+        else:
+            tox_func = lambda t: self.F_func(self._dose_labels[:, np.newaxis], a0=self.intercept, beta=t)
+            post_tox = list(post.expect(tox_func))
+            errors.extend(post.error(tox_func))
+        self.integration_error = np.max(errors)
+        dose = np.argmin(np.abs(np.array(post_tox) - self.target)) + 1
+        return dose, beta_hat, var, post_tox
 
     def _DoseFindingTrial__calculate_next_dose(self):
 
         if self.principle_escalation_func:
-            cases = zip(self._doses, self._toxicities)
+            cases = list(zip(self.doses(), self.toxicities()))
             proposed_dose = self.principle_escalation_func(cases)
             if proposed_dose is not None:
                 return proposed_dose
@@ -444,23 +814,28 @@ class CRM(DoseFindingTrial):
         current_dose = self.next_dose()
         max_dose_given = self.maximum_dose_given()
         min_dose_given = self.minimum_dose_given()
-        proposed_dose, beta_hat, beta_var, post_tox = crm(prior=self.prior, target=self.target,
-                                                          toxicities=self._toxicities, dose_levels=self._doses,
-                                                          intercept=self.intercept, F_func=self.F_func,
-                                                          inverse_F=self.inverse_F,
-                                                          beta_dist=self.beta_prior, method=self.method,
-                                                          use_quick_integration=self.use_quick_integration,
-                                                          estimate_var=self.estimate_var, plugin_mean=self.plugin_mean)
+        if self._grid is not None:
+            proposed_dose, beta_hat, beta_var, post_tox = self._grid_crm()
+        elif self.method == 'bayes' and self.integration_method == 'gauss_hermite':
+            proposed_dose, beta_hat, beta_var, post_tox = self._gauss_hermite_crm()
+        else:
+            proposed_dose, beta_hat, beta_var, post_tox = crm(prior=self.prior, target=self.target,
+                                                              toxicities=self._toxicities, dose_levels=self._doses,
+                                                              intercept=self.intercept, F_func=self.F_func,
+                                                              inverse_F=self.inverse_F,
+                                                              beta_dist=self.beta_prior, method=self.method,
+                                                              use_quick_integration=self.use_quick_integration,
+                                                              estimate_var=self.estimate_var,
+                                                              plugin_mean=self.plugin_mean,
+                                                              integration_method=self.integration_method,
+                                                              beta_start=self.beta_hat)
         self.beta_hat = beta_hat
         self.beta_var = beta_var
         self.post_tox = post_tox
 
         # Excess toxicity at lowest dose?
         if self.lowest_dose_too_toxic_hurdle and self.lowest_dose_too_toxic_certainty:
-            labels = [self.inverse_F(p, a0=self.intercept, beta=self.beta_prior.mean()) for p in self.prior]
-            beta_sample = norm(loc=beta_hat, scale=np.sqrt(beta_var)).rvs(1000000)  # N.b. normal sample a la prior
-            p0_sample = self.F_func(labels[0], a0=self.intercept, beta=beta_sample)
-            p0_tox = np.mean(p0_sample > self.lowest_dose_too_toxic_hurdle)
+            p0_tox = self.prob_tox_exceeds(self.lowest_dose_too_toxic_hurdle)[0]
 
             if p0_tox > self.lowest_dose_too_toxic_certainty:
                 proposed_dose = 0
@@ -494,18 +869,46 @@ class CRM(DoseFindingTrial):
     def prob_tox(self):
         return list(self.post_tox)
 
-    def prob_tox_exceeds(self, tox_cutoff, n=10 ** 6):
-        if self.estimate_var:
-            # Estimate probability of toxicity exceeds tox_cutoff using plug-in mean and variance for beta, and randomly
-            # sampling values from normal. Why normal? Because the prior for is normal and the posterior
-            # is asymptotically normal. For low n, non-normality may lead to bias.
+    def prob_tox_exceeds(self, tox_cutoff, n=10 ** 6, sample=False, exact_posterior=False):
+        """ Get the posterior probability that the probability of toxicity at each dose exceeds tox_cutoff.
+
+        By default, beta is taken to be normally distributed with the plug-in mean and variance. Why normal? Because
+        the prior for is normal and the posterior is asymptotically normal. For low n, non-normality may lead to bias.
+        The link functions are monotonic in beta, so each probability is a normal tail probability beyond a threshold.
+
+        :param tox_cutoff: the probability of toxicity
+        :type tox_cutoff: float
+        :param n: number of normal variates to sample when sample=True
+        :type n: int
+        :param sample: True to estimate the probabilities by randomly sampling beta from the normal approximation,
+                        as in earlier versions; False (default) to calculate them deterministically
+        :type sample: bool
+        :param exact_posterior: True to sum the exact posterior mass over the cached beta grid rather than use the
+                                normal approximation. Only available in Bayes mode with use_quick_integration=True.
+        :type exact_posterior: bool
+        :return: probabilities that the probability of toxicity exceeds tox_cutoff, one per dose
+        :rtype: numpy.array
 
-            # TODO: research replacing this with a proper posterior integral when in bayes mode.
+        """
 
-            labels = [self.inverse_F(p, a0=self.intercept, beta=self.beta_prior.mean()) for p in self.prior]
-            beta_sample = norm(loc=self.beta_hat, scale=np.sqrt(self.beta_var)).rvs(n)
-            p0_sample = [self.F_func(label, a0=self.intercept, beta=beta_sample) for label in labels]
-            return np.array([np.mean(x > tox_cutoff) for x in p0_sample])
+        if exact_posterior:
+            if self._grid is None:
+                raise Exception('CRM can only use the exact posterior when the posterior is cached on the beta grid, '
+                                'i.e. method="bayes" and use_quick_integration=True')
+            self._update_log_posterior()
+            pw = _grid_posterior_weights(self._grid_weights, self._log_post)
+            with np.errstate(over='ignore'):
+                p = self.F_func(self._dose_labels[:, np.newaxis], a0=self.intercept, beta=self._grid)
+            return np.dot(p > tox_cutoff, pw)
+        elif self.estimate_var:
+            if sample:
+                beta_sample = norm(loc=self.beta_hat, scale=np.sqrt(self.beta_var)).rvs(n)
+                p0_sample = [self.F_func(label, a0=self.intercept, beta=beta_sample) for label in self._dose_labels]
+                return np.array([np.mean(x > tox_cutoff) for x in p0_sample])
+            else:
+                return np.array([_prob_tox_exceeds_normal(self.F_func, self.intercept, label, tox_cutoff,
+                                                          self.beta_hat, self.beta_var)
+                                 for label in self._dose_labels])
         else:
             raise Exception('CRM can only estimate posterior probabilities when estimate_var=True')
 
@@ -613,6 +1016,221 @@ class CRM(DoseFindingTrial):
             # return p
 
 
+def simulate_crm_trial_batch(design, true_toxicities, num_sims, tolerances=None, cohort_size=1,
+                             calculate_optimal_decision=1):
+    """ Simulate many independent CRM trials together, vectorising the Bayesian calculations across trials.
+
+    This method is equivalent to calling clintrials.dosefinding.simulate_dose_finding_trial num_sims times with a CRM
+    design, but is much faster. The trials advance cohort-by-cohort in unison. The number treated and number of
+    toxicities at each dose are held in (trials x doses) arrays and the log posteriors in a (trials x grid) array, using
+    the same fixed beta grid as CRM with use_quick_integration=True. Trials that have stopped are masked out.
+
+    The skipping rules, coherency threshold and lowest-dose-too-toxic stopping rule of the design are applied to all
+    trials at once. The latter uses the same normal tail probability as CRM.prob_tox_exceeds.
+    If the design has a principle_escalation_func or termination_func, these are invoked trial-by-trial, the latter
+    with a copy of design that holds the trial's data.
+
+    :param design: the CRM design to simulate. In Bayes mode, the design must use trapezium integration. In MLE mode,
+                    all trials are solved at once by Newton-Raphson, so the link must be empiric or logistic.
+    :type design: clintrials.dosefinding.crm.CRM
+    :param true_toxicities: list of the true toxicity rates at the dose levels under investigation.
+    :type true_toxicities: list
+    :param num_sims: number of trials to simulate
+    :type num_sims: int
+    :param tolerances: optional (num_sims x n_patients) array of uniforms used to infer toxicity events for patients.
+                        Leave None to get randomly sampled data.
+    :type tolerances: numpy.array
+    :param cohort_size: to add several patients at a dose at once
+    :type cohort_size: int
+    :param calculate_optimal_decision: True to calculate the optimal dose; False to suppress
+    :type calculate_optimal_decision: bool
+    :return: list of reports of the simulation outcomes, each like that returned by simulate_dose_finding_trial
+    :rtype: list
+
+    """
+
+    if design.method == 'mle':
+        if design.F_func not in _link_derivatives:
+            raise ValueError('Batch simulation in MLE mode requires the empiric or logistic link.')
+    elif design.method != 'bayes':
+        raise ValueError("Only 'bayes' and 'mle' methods are implemented.")
+    elif design.integration_method != 'trapezium':
+        raise ValueError("Batch simulation in Bayes mode requires integration_method='trapezium', i.e. "
+                         "use_quick_integration=True.")
+
+    # Validate inputs
+    max_size = design.max_size()
+    if tolerances is None:
+        tolerances = uniform().rvs((num_sims, max_size))
+    else:
+        tolerances = np.asarray(tolerances, dtype=float).reshape((num_sims, -1))
+        if tolerances.shape[1] < max_size:
+            logging.warn('You have provided fewer tolerances than maximum number of patients on trial. Beware errors!')
+    true_toxicities = np.asarray(true_toxicities, dtype=float)
+    num_doses = design.number_of_doses()
+    dose_labels = np.asarray(design._dose_labels, dtype=float)
+
+    # Log likelihood contributions of a toxicity and a non-toxicity at each dose, on the beta grid
+    z, w, log_prior = _beta_grid(design.beta_prior)
+    log_w = np.log(w)
+    with np.errstate(over='ignore', divide='ignore'):
+        p_grid = design.F_func(dose_labels[:, np.newaxis], a0=design.intercept, beta=z)
+        log_p, log_q = np.log(p_grid), np.log(1 - p_grid)
+
+    if design.lowest_dose_too_toxic_hurdle and design.lowest_dose_too_toxic_certainty:
+        threshold, increasing = _beta_threshold(design.F_func, design.intercept, dose_labels[0],
+                                                design.lowest_dose_too_toxic_hurdle)
+    else:
+        threshold = None
+
+    # State of all trials
+    dose_history = np.zeros(tolerances.shape, dtype=int)
+    tox_history = np.zeros(tolerances.shape, dtype=int)
+    num_treated = np.zeros((num_sims, num_doses), dtype=int)
+    num_toxes = np.zeros((num_sims, num_doses), dtype=int)
+    log_post = np.tile(log_prior, (num_sims, 1))  # Rows for active trials only
+    next_dose = np.full(num_sims, design.first_dose(), dtype=int)
+    status = np.zeros(num_sims, dtype=int)
+    max_dose_given = np.zeros(num_sims, dtype=int)
+    min_dose_given = np.full(num_sims, num_doses + 1, dtype=int)
+    all_beta_hat = np.full(num_sims, design.beta_prior.mean())
+    all_beta_var = np.full(num_sims, design.beta_prior.var())
+    all_post_tox = np.tile(np.asarray(design.prior, dtype=float), (num_sims, 1))
+    view = copy.copy(design) if design.termination_func else None
+    cohort_log_lik = {}
+
+    def trial_view(j, size):
+        view._history = _CaseHistory(num_doses, 1, capacity=max(size, 1))
+        view._history.append(np.column_stack((dose_history[j, :size], tox_history[j, :size])))
+        view._next_dose = next_dose[j]
+        view._status = status[j]
+        view.beta_hat, view.beta_var, view.post_tox = all_beta_hat[j], all_beta_var[j], list(all_post_tox[j])
+        return view
+
+    active = np.arange(num_sims)
+    i = 0
+    while i <= max_size and len(active) > 0:
+        # Treat next cohort
+        tols = tolerances[active, i:i+cohort_size]
+        m = tols.shape[1]
+        dose = next_dose[active]
+        tox = (tols < true_toxicities[dose - 1][:, np.newaxis]).astype(int)
+        num_tox = tox.sum(axis=1)
+        dose_history[active, i:i+m] = dose[:, np.newaxis]
+        tox_history[active, i:i+m] = tox
+        num_treated[active, dose - 1] += m
+        num_toxes[active, dose - 1] += num_tox
+        if m > 0:
+            max_dose_given[active] = np.maximum(max_dose_given[active], dose)
+            min_dose_given[active] = np.minimum(min_dose_given[active], dose)
+        if design.method == 'bayes' and m not in cohort_log_lik:
+            # Log likelihood of each possible number of toxicities in a cohort of m at each dose, on the grid
+            t = np.arange(m + 1)[np.newaxis, :, np.newaxis]
+            with np.errstate(invalid='ignore'):
+                cohort_log_lik[m] = np.where(t > 0, t * log_p[:, np.newaxis, :], 0) \
+                    + np.where(m - t > 0, (m - t) * log_q[:, np.newaxis, :], 0)
+        if design.method == 'bayes':
+            log_post += cohort_log_lik[m][dose - 1, num_tox]
+        i += cohort_size
+        size = min(i, tolerances.shape[1])
+
+        # Principle escalation takes priority over the CRM model
+        model_mask = np.ones(len(active), dtype=bool)
+        if design.principle_escalation_func:
+            for k, j in enumerate(active):
+                cases = list(zip(dose_history[j, :size], tox_history[j, :size]))
+                proposed_dose = design.principle_escalation_func(cases)
+                if proposed_dose is not None:
+                    next_dose[j] = proposed_dose
+                    model_mask[k] = False
+        modelled = active[model_mask]
+        current_dose = next_dose[modelled]
+
+        if design.method == 'mle':
+            # Newton-Raphson for all trials at once, warm-started from their previous estimates
+            beta_hat, beta_var = _get_beta_hat_mle_batch(design.F_func, design.intercept, dose_labels,
+                                                         num_treated[modelled], num_toxes[modelled],
+                                                         beta0=all_beta_hat[modelled])
+            with np.errstate(over='ignore', invalid='ignore'):
+                post_tox = design.F_func(dose_labels, a0=design.intercept, beta=beta_hat[:, np.newaxis])
+        else:
+            # Posterior quantities as reductions over the grid
+            lp = log_post[model_mask] if len(modelled) < len(active) else log_post
+            pw = lp - lp.max(axis=1)[:, np.newaxis]
+            pw += log_w
+            np.exp(pw, out=pw)
+            total = pw.sum(axis=1)
+            beta_hat = np.dot(pw, z) / total
+            beta_var = np.dot(pw, z ** 2) / total - beta_hat ** 2
+            if design.plugin_mean:
+                with np.errstate(over='ignore'):
+                    post_tox = design.F_func(dose_labels, a0=design.intercept, beta=beta_hat[:, np.newaxis])
+            else:
+                post_tox = np.dot(pw, p_grid.T) / total[:, np.newaxis]
+        all_beta_hat[modelled], all_beta_var[modelled], all_post_tox[modelled] = beta_hat, beta_var, post_tox
+        proposed_dose = np.argmin(np.abs(post_tox - design.target), axis=1) + 1
+        decided = np.zeros(len(modelled), dtype=bool)
+
+        # Excess toxicity at lowest dose?
+        if threshold is not None:
+            with np.errstate(invalid='ignore'):
+                zscore = (threshold - beta_hat) / np.sqrt(beta_var)
+                p0_tox = norm.sf(zscore) if increasing else norm.cdf(zscore)
+            too_toxic = p0_tox > design.lowest_dose_too_toxic_certainty
+            proposed_dose[too_toxic] = 0
+            status[modelled[too_toxic]] = -1
+            decided |= too_toxic
+
+        # Coherency
+        if design.coherency_threshold:
+            n_current = num_treated[modelled, current_dose - 1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rate_current = num_toxes[modelled, current_dose - 1] / n_current.astype(float)
+            incoherent = ~decided & (proposed_dose > current_dose) & (n_current > 0) \
+                & (rate_current > design.coherency_threshold)
+            proposed_dose[incoherent] = current_dose[incoherent]
+            decided |= incoherent
+
+        # Skipping doses
+        max_given, min_given = max_dose_given[modelled], min_dose_given[modelled]
+        if design.avoid_skipping_untried_escalation:
+            skip_up = ~decided & (max_given > 0) & (proposed_dose - max_given > 1)
+            proposed_dose[skip_up] = max_given[skip_up] + 1
+            decided |= skip_up
+        if design.avoid_skipping_untried_deescalation:
+            skip_down = ~decided & (min_given <= num_doses) & (min_given - proposed_dose > 1)
+            proposed_dose[skip_down] = min_given[skip_down] - 1
+
+        next_dose[modelled] = proposed_dose
+
+        # Which trials go on?
+        still_active = (size < max_size) & (status[active] >= 0)
+        if design.termination_func:
+            for k, j in enumerate(active):
+                if still_active[k]:
+                    still_active[k] = not design.termination_func(trial_view(j, size))
+        active = active[still_active]
+        if not np.all(still_active):
+            log_post = log_post[still_active]
+
+    # Report findings
+    sims = []
+    for j in range(num_sims):
+        n_j = num_treated[j].sum()
+        report = OrderedDict()
+        report['TrueToxicities'] = iterable_to_json(true_toxicities)
+        report['RecommendedDose'] = atomic_to_json(next_dose[j])
+        report['TrialStatus'] = atomic_to_json(status[j])
+        report['Doses'] = dose_history[j, :n_j].tolist()
+        report['Toxicities'] = tox_history[j, :n_j].tolist()
+        if calculate_optimal_decision:
+            tox_hat = (tolerances[j][:, np.newaxis] < true_toxicities).mean(axis=0)
+            report['FullyInformedToxicityCurve'] = iterable_to_json(tox_hat)
+            report['OptimalAllocation'] = atomic_to_json(design.optimal_decision(tox_hat))
+        sims.append(report)
+    return sims
+
+
 def crm_dtp_detail(trial):
     """ Performs the CRM-specific extra reporting when calculating DTPs
     :param trial: instance of CRM
@@ -0,0 +1,267 @@
+__author__ = 'Kristian Brock'
+__contact__ = 'kristian.brock@gmail.com'
+
+
+""" Precompiled decision tables for toxicity-driven dose-finding designs.
+
+A design whose decisions depend on the cases only through the numbers of patients and toxicities at each dose, like
+3+3 and CRM, makes the same few decisions over and over again in simulations. Here, every state that such a design can
+reach is enumerated once, using :class:`clintrials.dosefinding.DoseFindingStateDAG`, and the decisions are stored in
+arrays indexed by state. Trials can then be replayed from the table for many sets of patients at once, with no
+further calls to the design.
+
+Tables can be saved to and loaded from .npz files. Each file carries a digest of its contents, a SHA-256 hash, or an
+HMAC-SHA256 signature if a key is given, so that a table attached to a protocol can be verified later.
+
+"""
+
+from collections import OrderedDict
+import hashlib
+import hmac
+import json
+
+import numpy as np
+from scipy.stats import uniform
+
+from clintrials.dosefinding import DoseFindingStateDAG
+from clintrials.util import atomic_to_json, iterable_to_json
+
+
+_array_names = ('dose', 'has_more', 'status', 'num_patients', 'children')
+
+
+class DecisionTable(object):
+    """ A table of the decisions of a dose-finding design in every state that it can reach.
+
+    States are numbered from 0, the state before any patient is treated. For state i:
+    dose[i] is the next dose, or the recommended dose if the trial has stopped;
+    has_more[i] is True if the trial continues;
+    status[i] is the trial status;
+    num_patients[i] is the number of patients in the next cohort;
+    children[i, k] is the state reached if k patients in the next cohort have toxicity, else -1.
+
+    e.g. general usage
+    >>> from clintrials.dosefinding import ThreePlusThree
+    >>> table = compile_decision_table(ThreePlusThree(3), cohort_size=3)
+    >>> len(table)
+    57
+    >>> tolerances = np.array([[0.9, 0.8, 0.7, 0.1, 0.8, 0.7, 0.9, 0.8, 0.7,
+    ...                         0.2, 0.1, 0.3, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4]])
+    >>> doses, toxicities, recommended_doses, statuses = table.replay([0.1, 0.2, 0.3], tolerances)
+    >>> doses.tolist()
+    [[1, 1, 1, 2, 2, 2, 2, 2, 2, 3, 3, 3, 0, 0, 0, 0, 0, 0]]
+    >>> toxicities.tolist()
+    [[0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, 0, 0]]
+    >>> recommended_doses.tolist(), statuses.tolist()
+    ([2], [100])
+
+    """
+
+    def __init__(self, dose, has_more, status, num_patients, children, metadata=None):
+        """
+
+        Params:
+        :param dose: next dose, or recommended dose, in each state
+        :type dose: numpy.array
+        :param has_more: True in each state where the trial continues
+        :type has_more: numpy.array
+        :param status: trial status in each state
+        :type status: numpy.array
+        :param num_patients: number of patients in the next cohort in each state
+        :type num_patients: numpy.array
+        :param children: (num_states x (cohort_size + 1)) array of the state reached for each number of toxicities
+        :type children: numpy.array
+        :param metadata: JSON-able dict describing the design and table, e.g. num_doses, max_size and cohort_size
+        :type metadata: dict
+
+        """
+
+        self.dose = np.asarray(dose, dtype=np.int16)
+        self.has_more = np.asarray(has_more, dtype=bool)
+        self.status = np.asarray(status, dtype=np.int16)
+        self.num_patients = np.asarray(num_patients, dtype=np.int16)
+        self.children = np.asarray(children, dtype=np.int32)
+        self.metadata = OrderedDict(sorted((metadata or {}).items()))
+
+    def __len__(self):
+        return len(self.dose)
+
+    def num_doses(self):
+        return self.metadata['num_doses']
+
+    def max_size(self):
+        return self.metadata['max_size']
+
+    def digest(self, key=None):
+        """ Get the digest of the table, i.e. the arrays and the metadata.
+
+        :param key: secret key, or None. If given, the digest is an HMAC-SHA256 signature; else a SHA-256 hash.
+        :type key: bytes
+        :return: hexadecimal digest
+        :rtype: str
+
+        """
+
+        h = hmac.new(key, digestmod=hashlib.sha256) if key is not None else hashlib.sha256()
+        for name in _array_names:
+            x = np.ascontiguousarray(getattr(self, name))
+            h.update(('%s:%s:%s;' % (name, x.dtype.newbyteorder('<').str, x.shape)).encode('utf-8'))
+            h.update(x.astype(x.dtype.newbyteorder('<')).tobytes())
+        h.update(json.dumps(self.metadata, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def save(self, path, key=None):
+        """ Save the table, with its digest, to an .npz file.
+
+        :param path: file path or file-like object
+        :type path: str
+        :param key: secret key to sign the table with HMAC-SHA256, or None to use a plain SHA-256 hash
+        :type key: bytes
+
+        """
+
+        arrays = dict((name, getattr(self, name)) for name in _array_names)
+        np.savez_compressed(path, metadata=np.array(json.dumps(self.metadata, sort_keys=True)),
+                            digest=np.array(self.digest(key)),
+                            digest_method=np.array('hmac-sha256' if key is not None else 'sha256'), **arrays)
+
+    @staticmethod
+    def load(path, key=None):
+        """ Load a table from an .npz file and verify its digest.
+
+        :param path: file path or file-like object
+        :type path: str
+        :param key: the secret key that the table was signed with, or None if it was saved without one
+        :type key: bytes
+        :return: the table
+        :rtype: DecisionTable
+
+        """
+
+        with np.load(path, allow_pickle=False) as data:
+            table = DecisionTable(metadata=json.loads(str(data['metadata'])),
+                                  **dict((name, data[name]) for name in _array_names))
+            digest, digest_method = str(data['digest']), str(data['digest_method'])
+        if (digest_method == 'hmac-sha256') != (key is not None):
+            raise ValueError('Decision table was saved with digest %s, so %s a key to verify it.'
+                             % (digest_method, 'provide' if key is None else 'do not provide'))
+        if not hmac.compare_digest(digest, table.digest(key)):
+            raise ValueError('Decision table does not match its digest.')
+        return table
+
+    def replay(self, true_toxicities, tolerances):
+        """ Replay trials from the table, for many sets of patients at once.
+
+        As in simulate_dose_finding_trial, a patient has toxicity at a dose if their tolerance is less than the true
+        probability of toxicity there.
+
+        :param true_toxicities: list of the true toxicity rates at the dose levels
+        :type true_toxicities: list
+        :param tolerances: (num_sims x n_patients) array of uniforms, with n_patients at least max_size
+        :type tolerances: numpy.array
+        :return: 4-tuple, (doses, toxicities, recommended doses, statuses), the first two
+                    (num_sims x max_size) arrays of the dose and toxicity of each patient, with dose 0 after the trial
+                    has stopped; the others with a value for each sim.
+        :rtype: tuple
+
+        """
+
+        prob_tox = np.asarray(true_toxicities, dtype=float)
+        tolerances = np.asarray(tolerances, dtype=float)
+        max_size = self.max_size()
+        if len(prob_tox) != self.num_doses():
+            raise ValueError('true_toxicities should have a value for each dose.')
+        if tolerances.ndim != 2 or tolerances.shape[1] < max_size:
+            raise ValueError('tolerances should be a num_sims*n_patients array with n_patients at least %s.'
+                             % max_size)
+
+        num_sims = tolerances.shape[0]
+        doses = np.zeros((num_sims, max_size), dtype=int)
+        toxicities = np.zeros((num_sims, max_size), dtype=int)
+        state = np.zeros(num_sims, dtype=int)
+        size = 0
+        while size < max_size:
+            active = np.flatnonzero(self.has_more[state])
+            if len(active) == 0:
+                break
+            # The number of patients treated depends only on the cohort, so all active sims treat the same patients
+            m = self.num_patients[state[active[0]]]
+            dose = self.dose[state[active]]
+            tox = tolerances[active, size:size+m] < prob_tox[dose - 1, np.newaxis]
+            doses[active, size:size+m] = dose[:, np.newaxis]
+            toxicities[active, size:size+m] = tox
+            state[active] = self.children[state[active], tox.sum(axis=1)]
+            size += m
+        return doses, toxicities, self.dose[state].astype(int), self.status[state].astype(int)
+
+    def simulate(self, true_toxicities, num_sims=None, tolerances=None):
+        """ Simulate dose-finding trials from the table.
+
+        :param true_toxicities: list of the true toxicity rates at the dose levels
+        :type true_toxicities: list
+        :param num_sims: number of simulations. Only used when tolerances is None.
+        :type num_sims: int
+        :param tolerances: optional (num_sims x n_patients) array of uniforms used to infer toxicity events for
+                            patients. Leave None to get randomly sampled data.
+        :type tolerances: numpy.array
+        :return: list of reports like those of simulate_dose_finding_trial with calculate_optimal_decision=0
+        :rtype: list
+
+        """
+
+        if tolerances is None:
+            if num_sims is None:
+                raise ValueError('Provide num_sims or tolerances.')
+            tolerances = uniform().rvs((num_sims, self.max_size()))
+        doses, toxicities, recommended_doses, statuses = self.replay(true_toxicities, tolerances)
+        reports = []
+        for i in range(len(recommended_doses)):
+            treated = doses[i] > 0
+            report = OrderedDict()
+            report['TrueToxicities'] = iterable_to_json(true_toxicities)
+            report['RecommendedDose'] = atomic_to_json(recommended_doses[i])
+            report['TrialStatus'] = atomic_to_json(statuses[i])
+            report['Doses'] = iterable_to_json(doses[i][treated])
+            report['Toxicities'] = iterable_to_json(toxicities[i][treated])
+            reports.append(report)
+        return reports
+
+
+def compile_decision_table(design, cohort_size=1):
+    """ Compile the decisions of a design in every state that it can reach into a DecisionTable.
+
+    The design must qualify for DoseFindingStateDAG, i.e. make deterministic decisions that depend on the cases only
+    through the numbers of patients and toxicities at each dose, and the dose just given.
+
+    :param design: the design, e.g. ThreePlusThree, SimpleToxicityCountingDoseEscalationTrial or CRM
+    :type design: clintrials.dosefinding.DoseFindingTrial
+    :param cohort_size: number of patients to add at a dose at once
+    :type cohort_size: int
+    :return: the table
+    :rtype: DecisionTable
+
+    """
+
+    dag = DoseFindingStateDAG(design, cohort_size)
+    num_states = dag.num_states()
+    dose = np.zeros(num_states, dtype=int)
+    has_more = np.zeros(num_states, dtype=bool)
+    status = np.zeros(num_states, dtype=int)
+    num_patients = np.zeros(num_states, dtype=int)
+    children = -np.ones((num_states, cohort_size + 1), dtype=int)
+    offset = 0
+    for states, transitions in zip(dag.states, dag.transitions):
+        for i, (d, s, more) in enumerate(states):
+            dose[offset + i], status[offset + i], has_more[offset + i] = d, s, more
+        for parent, child, d, m, k in transitions:
+            num_patients[offset + parent] = m
+            children[offset + parent, k] = offset + len(states) + child
+        offset += len(states)
+
+    metadata = OrderedDict()
+    metadata['design'] = type(design).__name__
+    metadata['num_doses'] = design.number_of_doses()
+    metadata['first_dose'] = design.first_dose()
+    metadata['max_size'] = design.max_size()
+    metadata['cohort_size'] = cohort_size
+    return DecisionTable(dose, has_more, status, num_patients, children, metadata)
@@ -3,12 +3,14 @@ __author__ = 'brockk'
 
 import abc
 from collections import OrderedDict
+import copy
 from itertools import product, combinations_with_replacement
 import numpy as np
 import logging
 
+from clintrials.dosefinding import _CaseHistory, _dtp_decision, _dtp_executor, _resolve_dtp_futures
 from clintrials.util import (atomic_to_json, iterable_to_json,
-                             correlated_binary_outcomes_from_uniforms, to_1d_list)
+                             correlated_binary_outcomes_from_uniforms, _correlated_binary_outcomes_solve2, to_1d_list)
 # from clintrials.simulation import filter_sims
 
 
@@ -19,6 +21,9 @@ class EfficacyToxicityDoseFindingTrial(object):
     The interface for such a class is:
     status()
     reset()
+    snapshot()
+    restore(state)
+    fork()
     number_of_doses()
     dose_levels()
     first_dose()
@@ -45,6 +50,8 @@ class EfficacyToxicityDoseFindingTrial(object):
     Further internal interface is provided by:
     __reset()
     __calculate_next_dose() # Subclasses should override, set _status & _admissable_set, and return _next_dose.
+    __snapshot() # Subclasses that cache state beyond the cases should return it in a dict
+    __restore(state) # and restore it from that dict.
 
     Class uses the internal variable _status to signify the current status of the trial. At the start of each
     trial, the status is 0, signifying that the trial has not started. It is proposed that trial statuses
@@ -74,24 +81,83 @@ class EfficacyToxicityDoseFindingTrial(object):
         self._max_size = max_size
 
         # Reset
-        self._doses = []
-        self._toxicities = []
-        self._efficacies = []
+        self._history = _CaseHistory(num_doses, 2)
         self._next_dose = self._first_dose
         self._status = 0
         self._admissable_set = []
 
+    @property
+    def _doses(self):
+        """ Read-only numpy view of the doses given. """
+        return self._history.column(0)
+
+    @property
+    def _toxicities(self):
+        """ Read-only numpy view of the toxicities observed. """
+        return self._history.column(1)
+
+    @property
+    def _efficacies(self):
+        """ Read-only numpy view of the efficacies observed. """
+        return self._history.column(2)
+
     def status(self):
         return self._status
 
     def reset(self):
-        self._doses = []
-        self._toxicities = []
-        self._efficacies = []
+        self._history = _CaseHistory(self.num_doses, 2)
         self._next_dose = self._first_dose
         self._status = 0
         self.__reset()
 
+    def snapshot(self):
+        """ Get the state of the trial, i.e. the cases observed, the next dose, status and admissable set, and any
+        posterior quantities cached by the design. Restore it later with restore(state) rather than reset and replay
+        all cases.
+
+        :return: state of trial
+        :rtype: dict
+
+        """
+
+        state = {
+            'history': self._history.copy(),
+            'next_dose': self._next_dose,
+            'status': self._status,
+            'admissable_set': list(self._admissable_set),
+        }
+        state.update(self.__snapshot())
+        return state
+
+    def restore(self, state):
+        """ Restore the state of the trial from a snapshot. The same snapshot can be restored many times.
+
+        :param state: state of trial, as returned by snapshot()
+        :type state: dict
+
+        """
+
+        self._history = state['history'].copy()
+        self._next_dose = state['next_dose']
+        self._status = state['status']
+        self._admissable_set = list(state['admissable_set'])
+        self.__restore(state)
+
+    def fork(self):
+        """ Get an independent copy of the trial in its current state.
+
+        The design parameters are shared and the state is copied, so that the fork can be updated with further cases,
+        in this or another thread, without affecting this trial or recalculating the posterior for past cases.
+
+        :return: copy of trial
+        :rtype: EfficacyToxicityDoseFindingTrial
+
+        """
+
+        clone = copy.copy(self)
+        clone.restore(self.snapshot())
+        return clone
+
     def number_of_doses(self):
         """ How many dose-levels are under investigation?"""
         return self.num_doses
@@ -111,55 +177,46 @@ class EfficacyToxicityDoseFindingTrial(object):
 
     def size(self):
         """ How many patients have been treated? """
-        return len(self._doses)
+        return len(self._history)
 
     def max_size(self):
         """ Maximum number of trial patients. """
         return self._max_size
 
     def doses(self):
-        return self._doses
+        return self._doses.tolist()
 
     def toxicities(self):
-        return self._toxicities
+        return self._toxicities.tolist()
 
     def efficacies(self):
-        return self._efficacies
+        return self._efficacies.tolist()
 
     def treated_at_dose(self, dose):
         """ Number of patients treated at a dose level. """
-        return sum(np.array(self._doses) == dose)
+        return self._history.count(dose)
 
     def toxicities_at_dose(self, dose):
         """ Number of toxicities at (1-based) dose level. """
-        return sum([t for d, t in zip(self.doses(), self.toxicities()) if d == dose])
+        return self._history.count(dose, 1)
 
     def efficacies_at_dose(self, dose):
-        """ Number of toxicities at (1-based) dose level. """
-        return sum([e for d, e in zip(self.doses(), self.efficacies()) if d == dose])
+        """ Number of efficacies at (1-based) dose level. """
+        return self._history.count(dose, 2)
 
     def maximum_dose_given(self):
-        if len(self._doses) > 0:
-            return max(self._doses)
-        else:
-            return None
+        return self._history.max_dose
 
     def minimum_dose_given(self):
-        if len(self._doses) > 0:
-            return min(self._doses)
-        else:
-            return None
+        return self._history.min_dose
 
     def tabulate(self):
         import pandas as pd
         tab_data = OrderedDict()
-        treated_at_dose = [self.treated_at_dose(d) for d in self.dose_levels()]
-        eff_at_dose = [self.efficacies_at_dose(d) for d in self.dose_levels()]
-        tox_at_dose = [self.toxicities_at_dose(d) for d in self.dose_levels()]
         tab_data['Dose'] = self.dose_levels()
-        tab_data['N'] = treated_at_dose
-        tab_data['Efficacies'] = eff_at_dose
-        tab_data['Toxicities'] = tox_at_dose
+        tab_data['N'] = self._history.num_treated
+        tab_data['Efficacies'] = self._history.num_events[1]
+        tab_data['Toxicities'] = self._history.num_events[0]
         df = pd.DataFrame(tab_data)
         df['EffRate'] = np.where(df.N > 0, df.Efficacies / df.N, np.nan)
         df['ToxRate'] = np.where(df.N > 0, df.Toxicities / df.N, np.nan)
@@ -180,17 +237,14 @@ class EfficacyToxicityDoseFindingTrial(object):
         cases, list of 3-tuples, (dose, toxicity, efficacy), where dose is the given (1-based) dose level,
                     toxicity = 1 for a toxicity event; 0 for a tolerance event,
                     efficacy = 1 for an efficacy event; 0 for a non-efficacy event.
+                    Alternatively, an (n x 3) numpy.array with the same columns.
 
         Returns: next dose
 
         """
 
         if len(cases) > 0:
-            for (dose, tox, eff) in cases:
-                self._doses.append(dose)
-                self._toxicities.append(tox)
-                self._efficacies.append(eff)
-
+            self._history.append(cases)
             self._next_dose = self.__calculate_next_dose(**kwargs)
         else:
             logging.warn('Cannot update design with no cases')
@@ -206,27 +260,15 @@ class EfficacyToxicityDoseFindingTrial(object):
 
     def observed_toxicity_rates(self):
         """ Get the observed rate of toxicity at all doses. """
-        tox_rates = []
-        for d in range(1, self.num_doses+1):
-            num_treated = self.treated_at_dose(d)
-            if num_treated:
-                num_toxes = self.toxicities_at_dose(d)
-                tox_rates.append(1. * num_toxes / num_treated)
-            else:
-                tox_rates.append(np.nan)
-        return np.array(tox_rates)
+        num_treated = self._history.num_treated
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(num_treated > 0, 1. * self._history.num_events[0] / num_treated, np.nan)
 
     def observed_efficacy_rates(self):
         """ Get the observed rate of efficacy at all doses. """
-        eff_rates = []
-        for d in range(1, self.num_doses+1):
-            num_treated = self.treated_at_dose(d)
-            if num_treated:
-                num_responses = self.efficacies_at_dose(d)
-                eff_rates.append(1. * num_responses / num_treated)
-            else:
-                eff_rates.append(np.nan)
-        return np.array(eff_rates)
+        num_treated = self._history.num_treated
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(num_treated > 0, 1. * self._history.num_events[1] / num_treated, np.nan)
 
     def optimal_decision(self, prob_tox, prob_eff):
         """ Get the optimal dose choice for a given dose-toxicity curve.
@@ -261,6 +303,14 @@ class EfficacyToxicityDoseFindingTrial(object):
         """ Subclasses should override this method and return the desired next dose. """
         return -1  # Default implementation
 
+    def __snapshot(self):
+        """ Opportunity to return implementation-specific state in a dict. """
+        return {}
+
+    def __restore(self, state):
+        """ Opportunity to restore implementation-specific state from a snapshot. """
+        return
+
 
 def _efftox_patient_outcome_to_label(po):
     """ Converts (0,0) to Neither; (1,0) to Toxicity, (0,1) to Efficacy, (1,1) to Both """
@@ -483,7 +533,7 @@ def simulate_efficacy_toxicity_dose_finding_trials(design_map, true_toxicities,
     # report['TrueEfficacies'] = iterable_to_json(true_efficacies)
     # Do not parrot back parameters
 
-    for label, design in design_map.iteritems():
+    for label, design in design_map.items():
         this_sim = _simulate_trial(design, true_toxicities, true_efficacies, tox_eff_odds_ratio, tolerances,
                                            cohort_size, conduct_trial, calculate_optimal_decision)
         report[label] = this_sim
@@ -492,10 +542,130 @@ def simulate_efficacy_toxicity_dose_finding_trials(design_map, true_toxicities,
 # Alias
 simulate_trials = simulate_efficacy_toxicity_dose_finding_trials
 
+def fully_informed_efficacy_toxicity_curves(tolerances, true_toxicities, true_efficacies, tox_eff_odds_ratio=1.0):
+    """ Get the fully-informed toxicity and efficacy curves for each of many sets of patient tolerances, in one
+    broadcast.
+
+    Each curve is the proportion of patients that would have the event at each dose, as calculated in simulate_trial.
+    Where outcomes are associated, events are inferred from all three uniforms per patient as in
+    clintrials.util.correlated_binary_outcomes_from_uniforms; otherwise, from the first two.
+
+    :param tolerances: (num_sims x n_patients x 3) array of uniforms
+    :type tolerances: numpy.array
+    :param true_toxicities: list of the true toxicity rates at the dose levels
+    :type true_toxicities: list
+    :param true_efficacies: list of the true efficacy rates at the dose levels
+    :type true_efficacies: list
+    :param tox_eff_odds_ratio: odds ratio of toxicity and efficacy events. Use 1. for no association
+    :type tox_eff_odds_ratio: float
+    :return: 2-tuple, ((num_sims x num_doses) array of toxicity proportions, same for efficacy)
+    :rtype: tuple
+
+    """
+
+    tolerances = np.asarray(tolerances, dtype=float)
+    prob_tox = np.asarray(true_toxicities, dtype=float)
+    prob_eff = np.asarray(true_efficacies, dtype=float)
+    tox = tolerances[:, :, 0, np.newaxis] < prob_tox
+    if tox_eff_odds_ratio < 1.0 or tox_eff_odds_ratio > 1.0:
+        prob_both = np.array([_correlated_binary_outcomes_solve2(t, e, tox_eff_odds_ratio)
+                              for t, e in zip(prob_tox, prob_eff)])
+        eff = np.where(tox, tolerances[:, :, 1, np.newaxis] <= prob_both / prob_tox,
+                       tolerances[:, :, 2, np.newaxis] <= (prob_eff - prob_both) / (1 - prob_tox))
+    else:
+        eff = tolerances[:, :, 1, np.newaxis] < prob_eff
+    return tox.mean(axis=1), eff.mean(axis=1)
+
+
+def simulate_efficacy_toxicity_dose_finding_trials_batch(design_map, true_toxicities, true_efficacies, num_sims=None,
+                                                         tox_eff_odds_ratio=1.0, tolerances=None, cohort_size=1,
+                                                         conduct_trial=1, calculate_optimal_decision=1):
+    """ Simulate many sets of patients, each treated by multiple dose finding designs based on efficacy and toxicity.
+
+    This is the batch form of simulate_efficacy_toxicity_dose_finding_trials. Each design is given the same patients in
+    each simulation (common random numbers), so that comparisons between designs are paired. Only the fully-informed
+    toxicity and efficacy curves are calculated for all simulations at once. Each design is then run trial by trial,
+    on the slice of tolerances for each simulation, as in simulate_efficacy_toxicity_dose_finding_trials.
+
+    :param design_map: dict, label -> instance of EfficacyToxicityDoseFindingTrial
+    :type design_map: dict
+    :param true_toxicities: list of the true toxicity rates at the dose levels under investigation.
+    :type true_toxicities: list
+    :param true_efficacies: list of the true efficacy rates at the dose levels under investigation.
+    :type true_efficacies: list
+    :param num_sims: number of simulations. Only used when tolerances is None.
+    :type num_sims: int
+    :param tox_eff_odds_ratio: odds ratio of toxicity and efficacy events. Use 1. for no association
+    :type tox_eff_odds_ratio: float
+    :param tolerances: optional (num_sims x n_patients x 3) array of uniforms used to infer correlated toxicity and
+                        efficacy events for patients. Leave None to get randomly sampled data.
+    :type tolerances: numpy.array
+    :param cohort_size: to add several patients at a dose at once
+    :type cohort_size: int
+    :param conduct_trial: True to conduct cohort-by-cohort dosing using the trial design; False to suppress
+    :type conduct_trial: bool
+    :param calculate_optimal_decision: True to calculate the optimal dose; False to suppress
+    :type calculate_optimal_decision: bool
+    :return: list of reports of the simulation outcomes, each like that returned by
+                simulate_efficacy_toxicity_dose_finding_trials
+    :rtype: list
+
+    """
+
+    max_size = max([design.max_size() for design in design_map.values()])
+    if tolerances is not None:
+        tolerances = np.asarray(tolerances, dtype=float)
+        if tolerances.ndim != 3 or tolerances.shape[1] < max_size or tolerances.shape[2] != 3:
+            raise ValueError('tolerances should be a num_sims*max_size*3 array')
+    elif num_sims is None:
+        raise ValueError('Provide num_sims or tolerances.')
+    else:
+        tolerances = np.random.uniform(size=(num_sims, max_size, 3))
+    num_sims = tolerances.shape[0]
+
+    if tox_eff_odds_ratio != 1.0 and calculate_optimal_decision:
+        logging.warn('Patient outcomes are not sequential when toxicity and efficacy events are correlated. ' +
+                     'E.g. toxicity at d_1 dose not necessarily imply toxicity at d_2. It is important ' +
+                     'to appreciate this when calculating optimal decisions.')
+
+    if calculate_optimal_decision:
+        tox_hats, eff_hats = fully_informed_efficacy_toxicity_curves(tolerances, true_toxicities, true_efficacies,
+                                                                     tox_eff_odds_ratio)
+        tox_hats, eff_hats = np.round(tox_hats, 4), np.round(eff_hats, 4)
+
+    reports = [OrderedDict() for i in range(num_sims)]
+    for label, design in design_map.items():
+        for i, report in enumerate(reports):
+            this_sim = _simulate_trial(design, true_toxicities, true_efficacies, tox_eff_odds_ratio, tolerances[i],
+                                       cohort_size, conduct_trial, calculate_optimal_decision=0)
+            if calculate_optimal_decision:
+                try:
+                    optimal_allocation = design.optimal_decision(tox_hats[i], eff_hats[i])
+                    this_sim['FullyInformedToxicityCurve'] = iterable_to_json(tox_hats[i])
+                    this_sim['FullyInformedEfficacyCurve'] = iterable_to_json(eff_hats[i])
+                    this_sim['OptimalAllocation'] = atomic_to_json(optimal_allocation)
+                except NotImplementedError:
+                    pass
+            report[label] = this_sim
+
+    return reports
+# Alias
+simulate_trials_batch = simulate_efficacy_toxicity_dose_finding_trials_batch
+
 def dose_transition_pathways(trial, next_dose, cohort_sizes, cohort_number=1, cases_already_observed=[],
-                                    custom_output_func=None, verbose=False, **kwargs):
+                                    custom_output_func=None, verbose=False, memoize=True, n_jobs=None,
+                                    executor=None, parallel_depth=1, seed=None, _cache=None, _depth=0,
+                                    _executor=None, **kwargs):
     """ Calculate dose-transition pathways for an efficacy-toxicity design.
 
+    The trial is reset and updated with all cases at each node, so the decision depends on the cases only through
+    the number of patients with each outcome at each dose. With memoize=True, each such state is evaluated just once,
+    however many paths reach it.
+
+    With n_jobs or executor, the subtrees below the first parallel_depth cohorts are computed in parallel, each on its
+    own deep copy of trial, and merged back in order. The result is identical to a serial run, provided that designs
+    that use Monte Carlo methods, like EffTox, are given a seed.
+
     :param trial: subclass of EfficacyToxicityDoseFindingTrial that will determine the dose path
     :type trial: clintrials.dosefinding.EfficacyToxicityDoseFindingTrial
     :param next_dose: the dose that will be given to patients in the very next cohort to get things going.
@@ -513,6 +683,21 @@ def dose_transition_pathways(trial, next_dose, cohort_sizes, cohort_number=1, ca
     :type custom_output_func: func
     :param verbose: True to print extra information to monitor progress
     :type verbose: bool
+    :param memoize: True to evaluate each distinct state once; False to replay the trial at every node.
+                    Designs that integrate by Monte Carlo give one estimate per state when memoized. Designs with a
+                    principle_escalation_func, whose decisions may depend on the order of patients, are always
+                    replayed.
+    :type memoize: bool
+    :param n_jobs: number of worker processes to compute subtrees in parallel; None to compute serially
+    :type n_jobs: int
+    :param executor: a concurrent.futures.Executor to compute subtrees in parallel, in preference to n_jobs.
+                        Trial, custom_output_func and kwargs must be picklable for a process pool.
+    :type executor: concurrent.futures.Executor
+    :param parallel_depth: number of cohorts to compute serially before subtrees are fanned out
+    :type parallel_depth: int
+    :param seed: if not None, the random number generators are seeded from seed and the sufficient-statistic state
+                    before each decision, so that Monte Carlo designs give reproducible DTPs
+    :type seed: int
     :param kwargs: extra keyword args to send to trial.update method
     :type kwargs: dict
 
@@ -525,6 +710,22 @@ def dose_transition_pathways(trial, next_dose, cohort_sizes, cohort_number=1, ca
         return None
     else:
         cohort_size = cohort_sizes[0]
+        if memoize and _cache is None:
+            _cache = {}
+        if _depth == 0:
+            _executor, shutdown = _dtp_executor(n_jobs, executor)
+            if _executor is not None:
+                try:
+                    dtps = dose_transition_pathways(
+                        trial, next_dose, cohort_sizes, cohort_number=cohort_number,
+                        cases_already_observed=cases_already_observed, custom_output_func=custom_output_func,
+                        verbose=verbose, memoize=memoize, parallel_depth=parallel_depth, seed=seed, _cache=_cache,
+                        _depth=1, _executor=_executor, **kwargs)
+                    return _resolve_dtp_futures(dtps)
+                finally:
+                    if shutdown:
+                        _executor.shutdown()
+            _depth = 1
         patient_outcomes = [(0, 0), (0, 1), (1, 0), (1, 1)]
         cohort_outcomes = list(combinations_with_replacement(patient_outcomes, cohort_size))
         path_outputs = []
@@ -532,10 +733,9 @@ def dose_transition_pathways(trial, next_dose, cohort_sizes, cohort_number=1, ca
             # Invoke dose-decision
             cohort_cases = [(next_dose, x[0], x[1]) for x in path]
             cases = cases_already_observed + cohort_cases
-            if verbose:
-                print('Running %s' % cases)
-            trial.reset()
-            obd = trial.update(cases, **kwargs)
+            obd, extra_output = _dtp_decision(trial, cases, next_dose, _cache if memoize else None,
+                                              custom_output_func=custom_output_func, set_next_dose=False,
+                                              verbose=verbose, seed=seed, **kwargs)
             # Collect output
             bag_o_tricks = OrderedDict([('Pat{}.{}'.format(cohort_number, j+1), _efftox_patient_outcome_to_label(po))
                                         for (j, po) in enumerate(path)])
@@ -546,14 +746,20 @@ def dose_transition_pathways(trial, next_dose, cohort_sizes, cohort_number=1, ca
                         ('NumEff', sum([x[1] for x in path])),
                         ('NumTox', sum([x[0] for x in path])),
                     ]))
-            if custom_output_func:
-                bag_o_tricks.update(custom_output_func(trial))
+            bag_o_tricks.update(extra_output)
 
             # Recurse subsequent cohorts
-            further_paths = dose_transition_pathways(trial, next_dose=obd, cohort_sizes=cohort_sizes[1:],
-                                                     cohort_number=cohort_number+1, cases_already_observed=cases,
-                                                     custom_output_func=custom_output_func, verbose=verbose,
-                                                     **kwargs)
+            if _executor is not None and _depth >= parallel_depth and len(cohort_sizes) > 1:
+                further_paths = _executor.submit(
+                    dose_transition_pathways, copy.deepcopy(trial), next_dose=obd, cohort_sizes=cohort_sizes[1:],
+                    cohort_number=cohort_number+1, cases_already_observed=cases,
+                    custom_output_func=custom_output_func, verbose=verbose, memoize=memoize, seed=seed, **kwargs)
+            else:
+                further_paths = dose_transition_pathways(
+                    trial, next_dose=obd, cohort_sizes=cohort_sizes[1:], cohort_number=cohort_number+1,
+                    cases_already_observed=cases, custom_output_func=custom_output_func, verbose=verbose,
+                    memoize=memoize, parallel_depth=parallel_depth, seed=seed, _cache=_cache, _depth=_depth+1,
+                    _executor=_executor, **kwargs)
             if further_paths:
                 bag_o_tricks['Next'] = further_paths
 
@@ -565,6 +771,64 @@ efftox_dose_transition_pathways = dose_transition_pathways
 efficacy_toxicity_dose_transition_pathways = dose_transition_pathways
 
 
+def dose_transition_pathway_rows(trial, next_dose, cohort_sizes, cases_already_observed=[], dose_label_func=None,
+                                 memoize=True, seed=None, _cache=None, _prefix=(), **kwargs):
+    """ Generate dose-transition pathways for an efficacy-toxicity design as flat rows, one per path.
+
+    Rows are yielded as the paths are calculated, so the nested structure returned by
+    :func:`dose_transition_pathways` is never held in memory. Each cohort contributes its outcomes, coded by patient
+    as in :func:`get_path`, e.g. 'BN' for one patient with both events and one with neither, followed by the dose
+    recommended. Use clintrials.dosefinding.dtp_columns(len(cohort_sizes), 'Outcomes') for column names and
+    clintrials.dosefinding.dtp_rows_to_csv or dtp_rows_to_pandas to write the table.
+
+    :param trial: subclass of EfficacyToxicityDoseFindingTrial that will determine the dose path
+    :type trial: clintrials.dosefinding.EfficacyToxicityDoseFindingTrial
+    :param next_dose: the dose that will be given to patients in the very next cohort to get things going.
+    :type next_dose: int
+    :param cohort_sizes: list of ints, sizes of future cohorts that we want to calculate DTPs for.
+    :type cohort_size: list
+    :param cases_already_observed: list of (dose, tox=0/1, eff=0/1) cases that have already been observed
+    :type cases_already_observed: list
+    :param dose_label_func: func to convert each recommended dose to its label in the row. None for str, as in
+                            get_path and clintrials.dosefinding.dose_transition_pathway_rows.
+    :type dose_label_func: func
+    :param memoize: True to evaluate each distinct state once; False to replay the trial at every node.
+                    Designs with a principle_escalation_func are always replayed.
+    :type memoize: bool
+    :param seed: if not None, the random number generators are seeded from seed and the sufficient-statistic state
+                    before each decision, so that Monte Carlo designs give reproducible DTPs
+    :type seed: int
+    :param kwargs: extra keyword args to send to trial.update method
+    :type kwargs: dict
+    :return: generator of lists
+    :rtype: generator
+
+    """
+
+    if len(cohort_sizes) <= 0:
+        return
+    if dose_label_func is None:
+        dose_label_func = lambda x: str(x)
+    if memoize and _cache is None:
+        _cache = {}
+    cohort_size = cohort_sizes[0]
+    patient_outcomes = [(0, 0), (0, 1), (1, 0), (1, 1)]
+    for path in combinations_with_replacement(patient_outcomes, cohort_size):
+        cohort_cases = [(next_dose, x[0], x[1]) for x in path]
+        cases = cases_already_observed + cohort_cases
+        obd, _ = _dtp_decision(trial, cases, next_dose, _cache if memoize else None, set_next_dose=False, seed=seed,
+                               **kwargs)
+        outcomes = ''.join([_efftox_patient_outcome_to_label(po)[0] for po in path])
+        row = _prefix + (outcomes, dose_label_func(atomic_to_json(obd)))
+        if len(cohort_sizes) > 1:
+            for further_row in dose_transition_pathway_rows(trial, obd, cohort_sizes[1:], cases_already_observed=cases,
+                                                            dose_label_func=dose_label_func, memoize=memoize,
+                                                            seed=seed, _cache=_cache, _prefix=row, **kwargs):
+                yield further_row
+        else:
+            yield list(row)
+
+
 def get_path(x, dose_label_func=None):
     if dose_label_func is None:
         dose_label_func = lambda x: str(x)
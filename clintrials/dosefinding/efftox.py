@@ -583,7 +583,7 @@ class EffTox(EfficacyToxicityDoseFindingTrial):
         """
         if n is None:
             n = self.num_integral_steps
-        cases = list(zip(self._doses, self._toxicities, self._efficacies))
+        cases = list(zip(self.doses(), self.toxicities(), self.efficacies()))
         post_probs, _pds = efftox_get_posterior_probs(cases, self.priors, self._scaled_doses, self.tox_cutoff,
                                                      self.eff_cutoff, n)
         prob_tox, prob_eff, prob_acc_tox, prob_acc_eff = zip(*post_probs)
@@ -646,6 +646,26 @@ class EffTox(EfficacyToxicityDoseFindingTrial):
         self._admissable_set = []
         self.utility = []
 
+    def _EfficacyToxicityDoseFindingTrial__snapshot(self):
+        # Posterior quantities are replaced, never modified in place, on each update
+        return {
+            'prob_tox': self.prob_tox,
+            'prob_eff': self.prob_eff,
+            'prob_acc_tox': self.prob_acc_tox,
+            'prob_acc_eff': self.prob_acc_eff,
+            'utility': self.utility,
+            'pds': getattr(self, 'pds', None),
+        }
+
+    def _EfficacyToxicityDoseFindingTrial__restore(self, state):
+        self.prob_tox = state['prob_tox']
+        self.prob_eff = state['prob_eff']
+        self.prob_acc_tox = state['prob_acc_tox']
+        self.prob_acc_eff = state['prob_acc_eff']
+        self.utility = state['utility']
+        if state['pds'] is not None:
+            self.pds = state['pds']
+
     def has_more(self):
         return EfficacyToxicityDoseFindingTrial.has_more(self)
 
@@ -678,7 +698,7 @@ class EffTox(EfficacyToxicityDoseFindingTrial):
         """ Get posterior parameter estimates """
         if n is None:
             n = self.num_integral_steps
-        cases = list(zip(self._doses, self._toxicities, self._efficacies))
+        cases = list(zip(self.doses(), self.toxicities(), self.efficacies()))
         post_params, pds = efftox_get_posterior_params(cases, self.priors, self._scaled_doses, n)
         return post_params
 
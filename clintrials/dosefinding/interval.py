@@ -0,0 +1,473 @@
+__author__ = 'Kristian Brock'
+__contact__ = 'kristian.brock@gmail.com'
+
+
+""" Interval-based dose-finding designs, BOIN and mTPI-2.
+
+These designs escalate, stay or de-escalate according to the number of patients treated and the number of toxicities
+seen at the current dose alone, and eliminate doses that are very likely to be too toxic. The rules are precomputed as
+lookup tables indexed by (number treated, number of toxicities), so trial decisions and batch simulations need no
+further calculation.
+
+See:
+Liu, S. & Yuan, Y. (2015). Bayesian optimal interval designs for phase I clinical trials,
+                            Journal of the Royal Statistical Society: Series C, 64: 507-523.
+Guo, W., Wang, S.-J., Yang, S., Lynn, H. & Ji, Y. (2017). A Bayesian interval dose-finding design addressing
+                            Ockham's razor: mTPI-2, Contemporary Clinical Trials, 58: 23-33.
+
+"""
+
+from collections import OrderedDict
+import logging
+
+import numpy as np
+from scipy.stats import beta, uniform
+
+from clintrials.dosefinding import DoseFindingTrial
+from clintrials.util import atomic_to_json, iterable_to_json
+
+
+# Decisions in the lookup tables
+ESCALATE, STAY, DEESCALATE = 1, 0, -1
+
+
+def _pava(y, w):
+    """ Weighted isotonic (non-decreasing) regression of y by the pool-adjacent-violators algorithm.
+
+    >>> _pava([0.1, 0.3, 0.2, 0.4], [1, 1, 1, 1]).tolist()
+    [0.1, 0.25, 0.25, 0.4]
+
+    """
+
+    blocks = []  # [weighted mean, total weight, number of values]
+    for y_i, w_i in zip(y, w):
+        blocks.append([y_i, w_i, 1])
+        while len(blocks) > 1 and blocks[-2][0] > blocks[-1][0]:
+            y2, w2, n2 = blocks.pop()
+            y1, w1, n1 = blocks[-1]
+            blocks[-1] = [(y1 * w1 + y2 * w2) / (w1 + w2), w1 + w2, n1 + n2]
+    return np.concatenate([[y_i] * n_i for y_i, w_i, n_i in blocks])
+
+
+def select_mtd(target, num_treated, num_toxicities, admissible_doses=None):
+    """ Select the MTD by isotonic regression of the toxicity rates observed at the doses given, as in BOIN.
+
+    The rates are estimated as (tox + 0.05) / (n + 0.1) and pooled where they decrease, weighted by the reciprocal of
+    their variance. The dose with estimate closest to target is selected, ties going to the higher dose.
+
+    :param target: target toxicity rate
+    :type target: float
+    :param num_treated: number of patients treated at each dose
+    :type num_treated: list
+    :param num_toxicities: number of toxicities at each dose
+    :type num_toxicities: list
+    :param admissible_doses: number of admissible doses, counting from the lowest; None for all
+    :type admissible_doses: int
+    :return: the selected (1-based) dose, or 0 if no admissible dose has been given
+    :rtype: int
+
+    >>> select_mtd(0.3, [3, 6, 9, 3], [0, 1, 4, 2])
+    2
+
+    """
+
+    n = np.asarray(num_treated, dtype=float)[:admissible_doses]
+    y = np.asarray(num_toxicities, dtype=float)[:admissible_doses]
+    tried = np.flatnonzero(n > 0)
+    if len(tried) == 0:
+        return 0
+    n, y = n[tried], y[tried]
+    p_hat = (y + 0.05) / (n + 0.1)
+    p_var = (y + 0.05) * (n - y + 0.05) / ((n + 0.1) ** 2 * (n + 0.1 + 1))
+    p_iso = _pava(p_hat, 1 / p_var) + np.arange(1, len(tried) + 1) * 1e-10
+    return int(tried[np.argmin(np.abs(p_iso - target))] + 1)
+
+
+class IntervalDoseFindingTrial(DoseFindingTrial):
+    """ Base class for interval-based dose-finding designs like BOIN and mTPI-2.
+
+    After each cohort, the decision to escalate, stay or de-escalate is looked up from the number treated and the
+    number of toxicities at the current dose. A dose, and all doses above it, are eliminated when at least three
+    patients have been treated there and the posterior probability, under a Beta(1, 1) prior, that its toxicity rate
+    exceeds the target is greater than elimination_cutoff. The trial stops with no dose selected if the lowest dose is
+    eliminated. Otherwise, it stops when max_size patients have been treated, or when n_earlystop patients have been
+    treated at the next dose, and the MTD is selected by :func:`select_mtd`.
+
+    Subclasses should override __decisions(n, tox) to give the decision for arrays of numbers treated and numbers of
+    toxicities.
+
+    """
+
+    def __init__(self, target, first_dose, num_doses, max_size, elimination_cutoff=0.95, n_earlystop=None):
+        """
+
+        Params:
+        :param target: target toxicity rate
+        :type target: float
+        :param first_dose: starting dose level, 1-based
+        :type first_dose: int
+        :param num_doses: number of doses being tested
+        :type num_doses: int
+        :param max_size: maximum number of patients to use in trial
+        :type max_size: int
+        :param elimination_cutoff: posterior probability of excess toxicity above which a dose is eliminated
+        :type elimination_cutoff: float
+        :param n_earlystop: stop the trial when this many patients have been treated at the next dose; None to continue
+                            to max_size
+        :type n_earlystop: int
+
+        """
+
+        DoseFindingTrial.__init__(self, first_dose=first_dose, num_doses=num_doses, max_size=max_size)
+
+        self.target = target
+        self.elimination_cutoff = elimination_cutoff
+        self.n_earlystop = n_earlystop
+        self._decisions, self._eliminate = None, None
+        # Reset
+        self._continue = True
+
+    def _DoseFindingTrial__reset(self):
+        self._continue = True
+
+    def _DoseFindingTrial__snapshot(self):
+        return {'continue': self._continue}
+
+    def _DoseFindingTrial__restore(self, state):
+        self._continue = state['continue']
+
+    def __decisions(self, n, tox):
+        """ Get the escalation decisions for arrays of numbers treated and numbers of toxicities. """
+        raise NotImplementedError()
+
+    def decision_table(self, max_n=None):
+        """ Get the escalation decisions and dose eliminations as lookup tables indexed by [n, tox].
+
+        :param max_n: largest number of patients at a dose to tabulate; None for max_size
+        :type max_n: int
+        :return: 2-tuple, ((max_n+1) x (max_n+1) array of decisions, ESCALATE, STAY or DEESCALATE,
+                            (max_n+1) x (max_n+1) array of True where the dose is eliminated).
+                    Entries with tox > n are meaningless.
+        :rtype: tuple
+
+        """
+
+        if max_n is None:
+            max_n = self.max_size()
+        if self._decisions is None or len(self._decisions) <= max_n:
+            n, tox = np.meshgrid(np.arange(max_n + 1), np.arange(max_n + 1), indexing='ij')
+            tox = np.minimum(tox, n)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                decisions = np.where(n > 0, self.__decisions(n, tox), STAY).astype(np.int8)
+            eliminate = (n >= 3) & (beta.sf(self.target, 1 + tox, 1 + n - tox) > self.elimination_cutoff)
+            self._decisions, self._eliminate = decisions, eliminate
+        return self._decisions[:max_n + 1, :max_n + 1], self._eliminate[:max_n + 1, :max_n + 1]
+
+    def admissible_doses(self):
+        """ Get the number of doses not eliminated, counting from the lowest. """
+        n, tox = self._history.num_treated, self._history.num_events[0]
+        decisions, eliminate = self.decision_table(max(self.max_size(), n.max()))
+        eliminated = np.flatnonzero(eliminate[n, tox])
+        return int(eliminated[0]) if len(eliminated) else self.number_of_doses()
+
+    def _DoseFindingTrial__calculate_next_dose(self):
+        current_dose = self.next_dose()
+        admissible = self.admissible_doses()
+        if admissible == 0:
+            # The lowest dose is too toxic
+            self._status = -1
+            self._continue = False
+            return 0
+
+        n, tox = self.treated_at_dose(current_dose), self.toxicities_at_dose(current_dose)
+        decisions, eliminate = self.decision_table(max(self.max_size(), n))
+        decision = decisions[n, tox]
+        if current_dose > admissible:
+            next_dose = admissible
+        elif decision == ESCALATE:
+            next_dose = min(current_dose + 1, admissible)
+        elif decision == DEESCALATE:
+            next_dose = max(current_dose - 1, 1)
+        else:
+            next_dose = current_dose
+
+        if self.size() >= self.max_size() or \
+                (self.n_earlystop is not None and self.treated_at_dose(next_dose) >= self.n_earlystop):
+            self._status = 100
+            self._continue = False
+            return select_mtd(self.target, self._history.num_treated, self._history.num_events[0], admissible)
+        else:
+            self._status = 1
+            return next_dose
+
+    def has_more(self):
+        """ Is the trial ongoing? """
+        return DoseFindingTrial.has_more(self) and self._continue
+
+    def optimal_decision(self, prob_tox):
+        """ Get the optimal dose choice for a given dose-toxicity curve, the dose with toxicity closest to target.
+
+        :param prob_tox: collection of toxicity probabilities
+        :type prob_tox: list
+        :return: the optimal (1-based) dose decision
+        :rtype: int
+
+        """
+
+        return np.argmin(np.abs(np.asarray(prob_tox) - self.target)) + 1
+
+
+class BOIN(IntervalDoseFindingTrial):
+    """ Liu & Yuan's Bayesian optimal interval (BOIN) design.
+
+    The design escalates if the observed toxicity rate at the current dose is no greater than the escalation boundary
+    lambda_e, de-escalates if it is no less than the de-escalation boundary lambda_d, and otherwise stays.
+
+    e.g. general usage
+    >>> trial = BOIN(0.3, 1, 5, 12)
+    >>> [round(float(x), 4) for x in trial.boundaries()]
+    [0.2365, 0.3585]
+    >>> trial.update([(1,0), (1,0), (1,0)])
+    2
+    >>> trial.update([(2,0), (2,1), (2,0)])
+    2
+    >>> trial.update([(2,0), (2,1), (2,1)])
+    1
+    >>> trial.has_more()
+    True
+    >>> trial.update([(1,0), (1,1), (1,0)])
+    1
+    >>> trial.has_more(), trial.status()
+    (False, 100)
+
+    """
+
+    def __init__(self, target, first_dose, num_doses, max_size, phi1=None, phi2=None, elimination_cutoff=0.95,
+                 n_earlystop=None):
+        """
+
+        Params:
+        :param target: target toxicity rate
+        :type target: float
+        :param first_dose: starting dose level, 1-based
+        :type first_dose: int
+        :param num_doses: number of doses being tested
+        :type num_doses: int
+        :param max_size: maximum number of patients to use in trial
+        :type max_size: int
+        :param phi1: highest toxicity rate deemed sub-therapeutic, such that escalation is needed; None for 0.6 * target
+        :type phi1: float
+        :param phi2: lowest toxicity rate deemed overly toxic, such that de-escalation is needed; None for 1.4 * target
+        :type phi2: float
+        :param elimination_cutoff: posterior probability of excess toxicity above which a dose is eliminated
+        :type elimination_cutoff: float
+        :param n_earlystop: stop the trial when this many patients have been treated at the next dose; None to continue
+                            to max_size
+        :type n_earlystop: int
+
+        """
+
+        IntervalDoseFindingTrial.__init__(self, target, first_dose, num_doses, max_size,
+                                          elimination_cutoff=elimination_cutoff, n_earlystop=n_earlystop)
+        self.phi1 = 0.6 * target if phi1 is None else phi1
+        self.phi2 = 1.4 * target if phi2 is None else phi2
+
+    def boundaries(self):
+        """ Get the escalation and de-escalation boundaries for the observed toxicity rate.
+
+        :return: 2-tuple, (lambda_e, lambda_d)
+        :rtype: tuple
+
+        """
+
+        phi, phi1, phi2 = self.target, self.phi1, self.phi2
+        lambda_e = np.log((1 - phi1) / (1 - phi)) / np.log(phi * (1 - phi1) / (phi1 * (1 - phi)))
+        lambda_d = np.log((1 - phi) / (1 - phi2)) / np.log(phi2 * (1 - phi) / (phi * (1 - phi2)))
+        return lambda_e, lambda_d
+
+    def _IntervalDoseFindingTrial__decisions(self, n, tox):
+        lambda_e, lambda_d = self.boundaries()
+        rate = 1. * tox / n
+        return np.where(rate <= lambda_e, ESCALATE, np.where(rate >= lambda_d, DEESCALATE, STAY))
+
+
+class MTPI2(IntervalDoseFindingTrial):
+    """ Guo et al.'s modified toxicity probability interval design, mTPI-2.
+
+    The unit interval is split into the equivalence interval, (target - epsilon1, target + epsilon2], and intervals of
+    the same width below and above it, truncated at 0 and 1. The design escalates, stays or de-escalates according to
+    whether the interval with the greatest unit probability mass, i.e. posterior probability under a Beta(1, 1) prior
+    divided by width, lies below, is, or lies above the equivalence interval.
+
+    e.g. general usage
+    >>> trial = MTPI2(0.3, 1, 5, 12)
+    >>> decisions, eliminate = trial.decision_table()
+    >>> decisions[3, :4].tolist(), eliminate[3, :4].tolist()
+    ([1, 0, -1, -1], [False, False, False, True])
+    >>> trial.update([(1,0), (1,0), (1,0)])
+    2
+    >>> trial.update([(2,1), (2,1), (2,1)])
+    1
+
+    """
+
+    def __init__(self, target, first_dose, num_doses, max_size, epsilon1=0.05, epsilon2=0.05,
+                 elimination_cutoff=0.95, n_earlystop=None):
+        """
+
+        Params:
+        :param target: target toxicity rate
+        :type target: float
+        :param first_dose: starting dose level, 1-based
+        :type first_dose: int
+        :param num_doses: number of doses being tested
+        :type num_doses: int
+        :param max_size: maximum number of patients to use in trial
+        :type max_size: int
+        :param epsilon1: width of the equivalence interval below target
+        :type epsilon1: float
+        :param epsilon2: width of the equivalence interval above target
+        :type epsilon2: float
+        :param elimination_cutoff: posterior probability of excess toxicity above which a dose is eliminated
+        :type elimination_cutoff: float
+        :param n_earlystop: stop the trial when this many patients have been treated at the next dose; None to continue
+                            to max_size
+        :type n_earlystop: int
+
+        """
+
+        IntervalDoseFindingTrial.__init__(self, target, first_dose, num_doses, max_size,
+                                          elimination_cutoff=elimination_cutoff, n_earlystop=n_earlystop)
+        self.epsilon1 = epsilon1
+        self.epsilon2 = epsilon2
+
+    def intervals(self):
+        """ Get the intervals of toxicity rate, and the decision associated with each.
+
+        :return: list of 3-tuples, (lower bound, upper bound, decision), from lowest to highest
+        :rtype: list
+
+        """
+
+        lower, upper = self.target - self.epsilon1, self.target + self.epsilon2
+        width = self.epsilon1 + self.epsilon2
+        below = []
+        while lower > 1e-12:
+            below.insert(0, (max(lower - width, 0), lower, ESCALATE))
+            lower -= width
+        above = []
+        while upper < 1 - 1e-12:
+            above.append((upper, min(upper + width, 1), DEESCALATE))
+            upper += width
+        return below + [(self.target - self.epsilon1, self.target + self.epsilon2, STAY)] + above
+
+    def _IntervalDoseFindingTrial__decisions(self, n, tox):
+        intervals = self.intervals()
+        upm = np.array([(beta.cdf(b, 1 + tox, 1 + n - tox) - beta.cdf(a, 1 + tox, 1 + n - tox)) / (b - a)
+                        for a, b, decision in intervals])
+        return np.array([decision for a, b, decision in intervals])[np.argmax(upm, axis=0)]
+
+
+def simulate_interval_trial_batch(design, true_toxicities, num_sims, tolerances=None, cohort_size=1,
+                                  calculate_optimal_decision=1):
+    """ Simulate many independent trials of an interval design together, vectorising the decisions across trials.
+
+    This method is equivalent to calling clintrials.dosefinding.simulate_dose_finding_trial num_sims times with a BOIN
+    or MTPI2 design, but is much faster. The trials advance cohort-by-cohort in unison. The number treated and number
+    of toxicities at each dose are held in (trials x doses) arrays and each decision is a lookup into the design's
+    decision tables. Only the final selection of the MTD is made trial-by-trial, and that is cached.
+
+    :param design: the design to simulate
+    :type design: clintrials.dosefinding.interval.IntervalDoseFindingTrial
+    :param true_toxicities: list of the true toxicity rates at the dose levels under investigation.
+    :type true_toxicities: list
+    :param num_sims: number of trials to simulate
+    :type num_sims: int
+    :param tolerances: optional (num_sims x n_patients) array of uniforms used to infer toxicity events for patients.
+                        Leave None to get randomly sampled data.
+    :type tolerances: numpy.array
+    :param cohort_size: to add several patients at a dose at once
+    :type cohort_size: int
+    :param calculate_optimal_decision: True to calculate the optimal dose; False to suppress
+    :type calculate_optimal_decision: bool
+    :return: list of reports of the simulation outcomes, each like that returned by simulate_dose_finding_trial
+    :rtype: list
+
+    """
+
+    # Validate inputs
+    max_size = design.max_size()
+    if tolerances is None:
+        tolerances = uniform().rvs((num_sims, max_size))
+    else:
+        tolerances = np.asarray(tolerances, dtype=float).reshape((num_sims, -1))
+        if tolerances.shape[1] < max_size:
+            logging.warn('You have provided fewer tolerances than maximum number of patients on trial. Beware errors!')
+    true_toxicities = np.asarray(true_toxicities, dtype=float)
+    num_doses = design.number_of_doses()
+    decisions, eliminate = design.decision_table(max(max_size, tolerances.shape[1]))
+
+    # State of all trials
+    dose_history = np.zeros(tolerances.shape, dtype=int)
+    tox_history = np.zeros(tolerances.shape, dtype=int)
+    num_treated = np.zeros((num_sims, num_doses), dtype=int)
+    num_toxes = np.zeros((num_sims, num_doses), dtype=int)
+    next_dose = np.full(num_sims, design.first_dose(), dtype=int)
+    status = np.zeros(num_sims, dtype=int)
+    admissible = np.full(num_sims, num_doses, dtype=int)
+    selections = {}
+
+    active = np.arange(num_sims)
+    i = 0
+    while i <= max_size and len(active) > 0:
+        # Treat next cohort
+        tols = tolerances[active, i:i+cohort_size]
+        m = tols.shape[1]
+        dose = next_dose[active]
+        tox = (tols < true_toxicities[dose - 1][:, np.newaxis]).astype(int)
+        dose_history[active, i:i+m] = dose[:, np.newaxis]
+        tox_history[active, i:i+m] = tox
+        num_treated[active, dose - 1] += m
+        num_toxes[active, dose - 1] += tox.sum(axis=1)
+        i += cohort_size
+        size = min(i, tolerances.shape[1])
+
+        # Look up decisions at the current dose
+        n, t = num_treated[active, dose - 1], num_toxes[active, dose - 1]
+        admissible[active] = np.where(eliminate[n, t], np.minimum(admissible[active], dose - 1), admissible[active])
+        adm = admissible[active]
+        decision = decisions[n, t]
+        proposed_dose = np.where(decision == ESCALATE, np.minimum(dose + 1, np.maximum(adm, 1)),
+                                 np.where(decision == DEESCALATE, np.maximum(dose - 1, 1), dose))
+        proposed_dose = np.where(dose > adm, np.maximum(adm, 1), proposed_dose)
+
+        # Which trials go on?
+        too_toxic = adm == 0
+        finished = ~too_toxic & (size >= max_size)
+        if design.n_earlystop is not None:
+            finished |= ~too_toxic & (num_treated[active, proposed_dose - 1] >= design.n_earlystop)
+        status[active] = np.where(too_toxic, -1, np.where(finished, 100, 1))
+        next_dose[active] = np.where(too_toxic, 0, proposed_dose)
+        for j in active[finished]:
+            key = (num_treated[j].tobytes(), num_toxes[j].tobytes(), admissible[j])
+            if key not in selections:
+                selections[key] = select_mtd(design.target, num_treated[j], num_toxes[j], admissible[j])
+            next_dose[j] = selections[key]
+        active = active[~too_toxic & ~finished]
+
+    # Report findings
+    sims = []
+    for j in range(num_sims):
+        n_j = num_treated[j].sum()
+        report = OrderedDict()
+        report['TrueToxicities'] = iterable_to_json(true_toxicities)
+        report['RecommendedDose'] = atomic_to_json(next_dose[j])
+        report['TrialStatus'] = atomic_to_json(status[j])
+        report['Doses'] = dose_history[j, :n_j].tolist()
+        report['Toxicities'] = tox_history[j, :n_j].tolist()
+        if calculate_optimal_decision:
+            tox_hat = (tolerances[j][:, np.newaxis] < true_toxicities).mean(axis=0)
+            report['FullyInformedToxicityCurve'] = iterable_to_json(tox_hat)
+            report['OptimalAllocation'] = atomic_to_json(design.optimal_decision(tox_hat))
+        sims.append(report)
+    return sims
@@ -10,20 +10,68 @@ Wages, N.A. and Tait, C. (2015). Seamless Phase I/II Adaptive Design For Oncolog
 """
 
 
+import copy
 import numpy as np
 from scipy.stats import norm, beta
 from scipy.integrate import quad, trapz
+try:
+    from scipy.integrate import quad_vec
+except ImportError:
+    quad_vec = None  # scipy < 1.4
 from random import sample
 
 from clintrials.common import empiric, inverse_empiric
 from clintrials.dosefinding.efficacytoxicity import EfficacyToxicityDoseFindingTrial
 #from clintrials.util import correlated_binary_outcomes_from_uniforms
-from clintrials.dosefinding.crm import CRM
+from clintrials.dosefinding.crm import CRM, _toxicity_counts, _toxicity_log_likelihood_from_counts
+from clintrials.quadrature import GaussHermitePosterior, integration_method as _integration_method
 
 
 _min_theta, _max_theta = -10, 10
 
 
+def _wt_counts(cases, skeleton):
+    """ Collapse cases to the per-dose counts that are sufficient for the efficacy likelihood in Wages & Tait.
+
+    Params:
+    cases, list of 3-tuples, (dose, toxicity, efficacy), where dose is 1-based index of dose level received,
+                                toxicity is 1 for toxic event, 0 for tolerance event
+                                and efficacy is 1 for efficacious outcome, 0 for alternative.
+    skeleton, list of prior efficacy probabilities
+
+    Returns a 3-tuple of numpy arrays, (distinct skeleton labels, number treated at each, number of efficacies at each)
+
+    """
+
+    doses = np.array([dose for dose, tox, eff in cases], dtype=int)
+    effs = [eff for dose, tox, eff in cases]
+    skeleton_labels = np.asarray(skeleton, dtype=float)[doses - 1]
+    return _toxicity_counts(skeleton_labels, effs)
+
+
+def _wt_log_lik(cases, skeleton, theta, F=empiric, a0=0):
+    """ Calculate the compound log likelihood for many dose & efficacy pairs in Wages & Tait dose-finding method.
+
+    The cases are collapsed to the number treated and number of efficacies at each dose, so the cost is proportional to
+    the number of doses given, not the number of patients. The function is vectorised in theta.
+
+    Params:
+    cases, list of 3-tuples, (dose, toxicity, efficacy), where dose is 1-based index of dose level received,
+                                toxicity is 1 for toxic event, 0 for tolerance event
+                                and efficacy is 1 for efficacious outcome, 0 for alternative.
+    skeleton, list of prior efficacy probabilities
+    theta, the third parameter to F, the slope
+    F, a link function like logistic or empiric that takes params x, intercept, slope and returns a probability
+    a0, the second parameter to F, the intercept
+
+    Returns the log of a probability.
+
+    """
+
+    dose_labels, num_treated, num_effs = _wt_counts(cases, skeleton)
+    return _toxicity_log_likelihood_from_counts(F, a0, theta, dose_labels, num_treated, num_effs)
+
+
 def _wt_lik(cases, skeleton, theta, F=empiric, a0=0):
     """ Calculate the compound likelihood for many dose & efficacy pairs in Wages & Tait dose-finding method.
 
@@ -40,14 +88,11 @@ def _wt_lik(cases, skeleton, theta, F=empiric, a0=0):
 
     """
 
-    l = 1
-    for dose, tox, eff in cases:
-        p = F(skeleton[dose-1], a0=a0, beta=theta)
-        l = l * p**eff * (1-p)**(1-eff)
-    return l
+    return np.exp(_wt_log_lik(cases, skeleton, theta, F, a0))
 
 
-def _wt_get_theta_hat(cases, skeletons, theta_prior, F=empiric, use_quick_integration=False, estimate_var=False):
+def _wt_get_theta_hat(cases, skeletons, theta_prior, F=empiric, use_quick_integration=False, estimate_var=False,
+                      integration_method=None):
     """ Get posterior estimates of theta hat (and optionally, variance) in Wages & Tait dose-finding method.
 
     See Wages, N.A. & Tait, C. - Seamless Phase I/II Adaptive Design For Oncology Trials
@@ -68,17 +113,27 @@ def _wt_get_theta_hat(cases, skeletons, theta_prior, F=empiric, use_quick_integr
     :type use_quick_integration: bool
     :param estimate_var: True to estimate the posterior variance of theta
     :type estimate_var: bool
+    :param integration_method: one of 'quad', 'trapezium' or 'gauss_hermite'; None to choose between the first two
+                                using use_quick_integration. See clintrials.quadrature.
+    :type integration_method: str
     :return: 3-tuple, vectors for (posterior means, posterior variances, posterior model probabilities)
     :rtype: tuple
 
     """
 
+    integration_method = _integration_method(use_quick_integration, integration_method)
     theta_hats = []
     for skeleton in skeletons:
-        if use_quick_integration:
+        counts = _wt_counts(cases, skeleton)
+        log_lik = lambda t: _toxicity_log_likelihood_from_counts(F, 0, t, *counts)
+        lik = lambda t: np.exp(log_lik(t))
+        if integration_method == 'gauss_hermite':
+            post = GaussHermitePosterior(lambda t: log_lik(t) + theta_prior.logpdf(t))
+            theta_hats.append((post.mean(), post.var() if estimate_var else None, post.evidence()))
+        elif integration_method == 'trapezium':
             n = 100 * max(np.log(len(cases) + 1) / 2, 1)  # My own rule of thumb for num points needed
-            z, dz = np.linspace(_min_theta, _max_theta, num=n, retstep=1)
-            denom_y = _wt_lik(cases, skeleton, z, F) * theta_prior.pdf(z)
+            z, dz = np.linspace(_min_theta, _max_theta, num=int(n), retstep=1)
+            denom_y = lik(z) * theta_prior.pdf(z)
             num_y = z * denom_y
             num = trapz(num_y, z, dz)
             denom = trapz(denom_y, z, dz)
@@ -92,11 +147,11 @@ def _wt_get_theta_hat(cases, skeletons, theta_prior, F=empiric, use_quick_integr
             else:
                 theta_hats.append((num / denom, None, denom))
         else:
-            num = quad(lambda t: t * _wt_lik(cases, skeleton, t, F) * theta_prior.pdf(t), -np.inf, np.inf)
-            denom = quad(lambda t: _wt_lik(cases, skeleton, t, F) * theta_prior.pdf(t), -np.inf, np.inf)
+            num = quad(lambda t: t * lik(t) * theta_prior.pdf(t), -np.inf, np.inf)
+            denom = quad(lambda t: lik(t) * theta_prior.pdf(t), -np.inf, np.inf)
             theta_hat = num[0] / denom[0]
             if estimate_var:
-                num2 = quad(lambda t: t**2 * _wt_lik(cases, skeleton, t, F) * theta_prior.pdf(t), -np.inf, np.inf)
+                num2 = quad(lambda t: t**2 * lik(t) * theta_prior.pdf(t), -np.inf, np.inf)
                 exp_x2 = num2[0] / denom[0]
                 var = exp_x2 - theta_hat**2
                 theta_hats.append((theta_hat, var, denom[0]))
@@ -105,7 +160,8 @@ def _wt_get_theta_hat(cases, skeletons, theta_prior, F=empiric, use_quick_integr
     return theta_hats
 
 
-def _get_post_eff_bayes(cases, skeleton, dose_labels, theta_prior, F=empiric, use_quick_integration=False):
+def _get_post_eff_bayes(cases, skeleton, dose_labels, theta_prior, F=empiric, use_quick_integration=False,
+                        integration_method=None):
     """ Calculate the posterior probability of efficacy at doses using the Bayesian integral
 
     :param cases: list of 3-tuples, (dose, toxicity, efficacy), where dose is 1-based index of dose level received,
@@ -123,29 +179,43 @@ def _get_post_eff_bayes(cases, skeleton, dose_labels, theta_prior, F=empiric, us
     :param use_quick_integration: True to use a faster but slightly less accurate estimate of the integrals;
                                   False to use a slower but more accurate method.
     :type use_quick_integration: bool
+    :param integration_method: one of 'quad', 'trapezium' or 'gauss_hermite'; None to choose between the first two
+                                using use_quick_integration. See clintrials.quadrature.
+    :type integration_method: str
     :return: estimates of Pr(Eff) at each dose
     :rtype: list
 
     """
 
-    post_eff = []
+    integration_method = _integration_method(use_quick_integration, integration_method)
     intercept = 0
-    if use_quick_integration:
+    counts = _wt_counts(cases, skeleton)
+    log_lik = lambda t: _toxicity_log_likelihood_from_counts(F, intercept, t, *counts)
+    lik = lambda t: np.exp(log_lik(t))
+    # The posterior weights are evaluated once per node and reduced against a (doses x nodes) matrix of F values
+    x = np.reshape(np.asarray(dose_labels, dtype=float), (-1, 1))
+    if integration_method == 'gauss_hermite':
+        # Gauss-Hermite quadrature centred on the posterior mode. Accurate and fast.
+        post = GaussHermitePosterior(lambda t: log_lik(t) + theta_prior.logpdf(t))
+        post_eff = post.expect(lambda t: F(x, a0=intercept, beta=t))
+    elif integration_method == 'trapezium':
         # This method uses simple trapezium quadrature. It is quite accurate and pretty fast.
         n = 100 * max(np.log(len(cases) + 1) / 2, 1)  # My own rule of thumb for num points needed
-        z, dz = np.linspace(_min_theta, _max_theta, num=n, retstep=1)
-        denom_y = _wt_lik(cases, skeleton, z, F) * theta_prior.pdf(z)
-        denom = trapz(denom_y, z, dz)
-        for x in dose_labels:
-            num_y = F(x, a0=intercept, beta=z) * denom_y
-            num = trapz(num_y, z, dz)
-            post_eff.append(num / denom)
+        z = np.linspace(_min_theta, _max_theta, num=int(n))
+        denom_y = lik(z) * theta_prior.pdf(z)
+        denom = trapz(denom_y, z)
+        post_eff = trapz(F(x, a0=intercept, beta=z) * denom_y, z, axis=1) / denom
+    elif quad_vec is not None:
+        # Adaptive quadrature of the vector of integrands for all doses, and the normalising constant, at once
+        integrals = quad_vec(lambda t: theta_prior.pdf(t) * lik(t) * np.append(1, F(x[:, 0], a0=intercept, beta=t)),
+                             -np.inf, np.inf)[0]
+        post_eff = integrals[1:] / integrals[0]
     else:
         # This method uses numpy's adaptive quadrature method. Superior accuracy but quite slow
-        denom = quad(lambda t: theta_prior.pdf(t) * _wt_lik(cases, skeleton, t, F), -np.inf, np.inf)
-        for x in dose_labels:
-            num = quad(lambda t: F(x, a0=intercept, beta=t) * theta_prior.pdf(t) * _wt_lik(cases, skeleton, t, F),
-                       -np.inf, np.inf)
+        post_eff = []
+        denom = quad(lambda t: theta_prior.pdf(t) * lik(t), -np.inf, np.inf)
+        for label in dose_labels:
+            num = quad(lambda t: F(label, a0=intercept, beta=t) * theta_prior.pdf(t) * lik(t), -np.inf, np.inf)
             post_eff.append(num[0] / denom[0])
 
     return np.array(post_eff)
@@ -200,7 +270,8 @@ class WagesTait(EfficacyToxicityDoseFindingTrial):
                  F_func=empiric, inverse_F=inverse_empiric,
                  theta_prior=norm(0, np.sqrt(1.34)), beta_prior=norm(0, np.sqrt(1.34)),
                  excess_toxicity_alpha=0.025, deficient_efficacy_alpha=0.025,
-                 model_prior_weights=None, use_quick_integration=False, estimate_var=False, plugin_mean=False):
+                 model_prior_weights=None, use_quick_integration=False, estimate_var=False, plugin_mean=False,
+                 integration_method=None):
         """
 
         Params:
@@ -245,6 +316,9 @@ class WagesTait(EfficacyToxicityDoseFindingTrial):
         :param plugin_mean: True to estimate event curves by plugging parameter estimate into function;
                             False to estimate using full Bayesian integral (default).
         :type plugin_mean: bool
+        :param integration_method: one of 'quad', 'trapezium' or 'gauss_hermite'; None to choose between the first
+                                two using use_quick_integration. See clintrials.quadrature.
+        :type integration_method: str
 
         """
 
@@ -277,6 +351,7 @@ class WagesTait(EfficacyToxicityDoseFindingTrial):
         self.use_quick_integration = use_quick_integration
         self.estimate_var = estimate_var
         self.plugin_mean = plugin_mean
+        self.integration_method = _integration_method(use_quick_integration, integration_method)
 
         # Reset
         self.most_likely_model_index = \
@@ -290,7 +365,8 @@ class WagesTait(EfficacyToxicityDoseFindingTrial):
             self.randomise_at_start = False
         self.crm = CRM(prior=prior_tox_probs, target=tox_target, first_dose=first_dose, max_size=max_size,
                        F_func=empiric, inverse_F=inverse_empiric, beta_prior=beta_prior,
-                       use_quick_integration=use_quick_integration, estimate_var=estimate_var, plugin_mean=plugin_mean)
+                       use_quick_integration=use_quick_integration, estimate_var=estimate_var, plugin_mean=plugin_mean,
+                       integration_method=integration_method)
         self.post_tox_probs = np.zeros(self.I)
         self.post_eff_probs = np.zeros(self.I)
         self.theta_hats = np.zeros(self.K)
@@ -336,16 +412,20 @@ class WagesTait(EfficacyToxicityDoseFindingTrial):
         return self.theta_hats[self.most_likely_model_index]
 
     def _EfficacyToxicityDoseFindingTrial__calculate_next_dose(self):
-        cases = list(zip(self._doses, self._toxicities, self._efficacies))
-        toxicity_cases = []
-        for (dose, tox, eff) in cases:
-            toxicity_cases.append((dose, tox))
-        self.crm.reset()
-        self.crm.update(toxicity_cases)
+        cases = list(zip(self.doses(), self.toxicities(), self.efficacies()))
+        # The toxicity model has usually seen all but the latest cases, so just update it with those
+        num_absorbed = self.crm.size()
+        if num_absorbed > self.size() \
+                or not np.array_equal(self.crm._doses, self._doses[:num_absorbed]) \
+                or not np.array_equal(self.crm._toxicities, self._toxicities[:num_absorbed]):
+            self.crm.reset()
+            num_absorbed = 0
+        self.crm.update(np.column_stack((self._doses[num_absorbed:], self._toxicities[num_absorbed:])))
 
         # Update parameters for efficacy estimates
         integrals = _wt_get_theta_hat(cases, self.skeletons, self.theta_prior,
-                                      use_quick_integration=self.use_quick_integration, estimate_var=False)
+                                      use_quick_integration=self.use_quick_integration, estimate_var=False,
+                                      integration_method=self.integration_method)
         theta_hats, theta_vars, model_probs = zip(*integrals)
 
         self.theta_hats = theta_hats
@@ -362,8 +442,8 @@ class WagesTait(EfficacyToxicityDoseFindingTrial):
             theta0 = self.theta_prior.mean()
             dose_labels = [self.inverse_F(p, a0=a0, beta=theta0) for p in self.skeletons[most_likely_model_index]]
             self.post_eff_probs = _get_post_eff_bayes(cases, self.skeletons[most_likely_model_index], dose_labels,
-                                                      self.theta_prior, use_quick_integration=self.use_quick_integration
-                                                      )
+                                                      self.theta_prior, use_quick_integration=self.use_quick_integration,
+                                                      integration_method=self.integration_method)
 
         # Update combined model
         if self.size() < self.randomisation_stage_size:
@@ -398,6 +478,28 @@ class WagesTait(EfficacyToxicityDoseFindingTrial):
             self._next_dose = self._randomise_next_dose(self.prior_tox_probs,
                                                         self.skeletons[self.most_likely_model_index])
 
+
+    def _EfficacyToxicityDoseFindingTrial__snapshot(self):
+        # Posterior quantities are replaced, never modified in place, on each update
+        return {
+            'most_likely_model_index': self.most_likely_model_index,
+            'w': self.w,
+            'post_tox_probs': self.post_tox_probs,
+            'post_eff_probs': self.post_eff_probs,
+            'theta_hats': self.theta_hats,
+            'crm': self.crm.snapshot(),
+        }
+
+    def _EfficacyToxicityDoseFindingTrial__restore(self, state):
+        self.most_likely_model_index = state['most_likely_model_index']
+        self.w = state['w']
+        self.post_tox_probs = state['post_tox_probs']
+        self.post_eff_probs = state['post_eff_probs']
+        self.theta_hats = state['theta_hats']
+        # Take a copy of the toxicity model so that forks do not share it
+        self.crm = copy.copy(self.crm)
+        self.crm.restore(state['crm'])
+
     def has_more(self):
         return EfficacyToxicityDoseFindingTrial.has_more(self)
 
@@ -15,15 +15,17 @@ Berry, Carlin, Lee and Mueller. Bayesian Adaptive Methods for Clinical Trials, C
 """
 
 
+import copy
 import numpy as np
 from scipy.stats import norm, beta
 from random import sample
 
 from clintrials.common import empiric, inverse_empiric
-from clintrials.dosefinding.crm import CRM
+from clintrials.dosefinding.crm import CRM, _prob_tox_exceeds_normal
 from clintrials.dosefinding.efficacytoxicity import EfficacyToxicityDoseFindingTrial
 from clintrials.dosefinding.efftox import solve_metrizable_efftox_scenario
 from clintrials.dosefinding.wagestait import _wt_get_theta_hat, _get_post_eff_bayes
+from clintrials.quadrature import integration_method as _integration_method
 
 
 class WATU(EfficacyToxicityDoseFindingTrial):
@@ -84,7 +86,7 @@ class WATU(EfficacyToxicityDoseFindingTrial):
                  avoid_skipping_untried_escalation_stage_1=True, avoid_skipping_untried_deescalation_stage_1=True,
                  avoid_skipping_untried_escalation_stage_2=True, avoid_skipping_untried_deescalation_stage_2=True,
                  must_try_lowest_dose=True,
-                 plugin_mean=False
+                 plugin_mean=False, integration_method=None
                  ):
         """
 
@@ -142,6 +144,9 @@ class WATU(EfficacyToxicityDoseFindingTrial):
         :param plugin_mean: True to estimate event curves by plugging parameter estimate into function;
                             False to estimate using full Bayesian integral (default).
         :type plugin_mean: bool
+        :param integration_method: one of 'quad', 'trapezium' or 'gauss_hermite'; None to choose between the first
+                                two using use_quick_integration. See clintrials.quadrature.
+        :type integration_method: str
 
         """
 
@@ -179,6 +184,7 @@ class WATU(EfficacyToxicityDoseFindingTrial):
         self.avoid_skipping_untried_deescalation_stage_2 = avoid_skipping_untried_deescalation_stage_2
         self.must_try_lowest_dose = must_try_lowest_dose
         self.plugin_mean = plugin_mean
+        self.integration_method = _integration_method(use_quick_integration, integration_method)
 
         # Reset
         self.most_likely_model_index = \
@@ -189,7 +195,7 @@ class WATU(EfficacyToxicityDoseFindingTrial):
                        use_quick_integration=use_quick_integration, estimate_var=estimate_var,
                        avoid_skipping_untried_escalation=avoid_skipping_untried_escalation_stage_1,
                        avoid_skipping_untried_deescalation=avoid_skipping_untried_deescalation_stage_1,
-                       plugin_mean=plugin_mean)
+                       plugin_mean=plugin_mean, integration_method=integration_method)
         self.post_tox_probs = np.zeros(self.I)
         self.post_eff_probs = np.zeros(self.I)
         self.theta_hats = np.zeros(self.K)
@@ -207,16 +213,20 @@ class WATU(EfficacyToxicityDoseFindingTrial):
         return self.theta_vars[self.most_likely_model_index]
 
     def _EfficacyToxicityDoseFindingTrial__calculate_next_dose(self):
-        cases = list(zip(self._doses, self._toxicities, self._efficacies))
-        toxicity_cases = []
-        for (dose, tox, eff) in cases:
-            toxicity_cases.append((dose, tox))
-        self.crm.reset()
-        self.crm.update(toxicity_cases)
+        cases = list(zip(self.doses(), self.toxicities(), self.efficacies()))
+        # The toxicity model has usually seen all but the latest cases, so just update it with those
+        num_absorbed = self.crm.size()
+        if num_absorbed > self.size() \
+                or not np.array_equal(self.crm._doses, self._doses[:num_absorbed]) \
+                or not np.array_equal(self.crm._toxicities, self._toxicities[:num_absorbed]):
+            self.crm.reset()
+            num_absorbed = 0
+        self.crm.update(np.column_stack((self._doses[num_absorbed:], self._toxicities[num_absorbed:])))
 
         # Update parameters for efficacy estimates
         integrals = _wt_get_theta_hat(cases, self.skeletons, self.theta_prior,
-                                      use_quick_integration=self.use_quick_integration, estimate_var=True)
+                                      use_quick_integration=self.use_quick_integration, estimate_var=True,
+                                      integration_method=self.integration_method)
         theta_hats, theta_vars, model_probs = zip(*integrals)
         self.theta_hats = theta_hats
         self.theta_vars = theta_vars
@@ -233,8 +243,8 @@ class WATU(EfficacyToxicityDoseFindingTrial):
             theta0 = self.theta_prior.mean()
             dose_labels = [self.inverse_F(p, a0=a0, beta=theta0) for p in self.skeletons[most_likely_model_index]]
             self.post_eff_probs = _get_post_eff_bayes(cases, self.skeletons[most_likely_model_index], dose_labels,
-                                                      self.theta_prior, use_quick_integration=self.use_quick_integration
-                                                      )
+                                                      self.theta_prior, use_quick_integration=self.use_quick_integration,
+                                                      integration_method=self.integration_method)
 
         # Update combined model
         if self.size() < self.stage_one_size:
@@ -255,6 +265,32 @@ class WATU(EfficacyToxicityDoseFindingTrial):
         self.theta_vars = np.zeros(self.K)
         self.crm.reset()
 
+
+    def _EfficacyToxicityDoseFindingTrial__snapshot(self):
+        # Posterior quantities are replaced, never modified in place, on each update
+        return {
+            'most_likely_model_index': self.most_likely_model_index,
+            'w': self.w,
+            'post_tox_probs': self.post_tox_probs,
+            'post_eff_probs': self.post_eff_probs,
+            'theta_hats': self.theta_hats,
+            'theta_vars': self.theta_vars,
+            'utility': self.utility,
+            'crm': self.crm.snapshot(),
+        }
+
+    def _EfficacyToxicityDoseFindingTrial__restore(self, state):
+        self.most_likely_model_index = state['most_likely_model_index']
+        self.w = state['w']
+        self.post_tox_probs = state['post_tox_probs']
+        self.post_eff_probs = state['post_eff_probs']
+        self.theta_hats = state['theta_hats']
+        self.theta_vars = state['theta_vars']
+        self.utility = state['utility']
+        # Take a copy of the toxicity model so that forks do not share it
+        self.crm = copy.copy(self.crm)
+        self.crm.restore(state['crm'])
+
     def has_more(self):
         return EfficacyToxicityDoseFindingTrial.has_more(self)
 
@@ -278,15 +314,36 @@ class WATU(EfficacyToxicityDoseFindingTrial):
                                                                               self.tox_limit, self.eff_limit)
         return obd
 
-    def prob_eff_exceeds(self, eff_cutoff, n=10**6):
+    def prob_eff_exceeds(self, eff_cutoff, n=10**6, sample=False):
+        """ Get the posterior probability that the probability of efficacy at each dose exceeds eff_cutoff.
+
+        Theta is taken to be normally distributed with the plug-in mean and variance of the most likely model.
+        Why normal? Because the prior for is normal and the posterior is asymptotically normal. For low n,
+        non-normality may lead to bias. The link function is monotonic in theta, so each probability is a normal tail
+        probability beyond a threshold.
 
-        # Estimate probability of efficacy exceeds eff_cutoff using plug-in mean and variance for theta
-        # and randomly sampling values from normal. Why normal? Because the prior for is normal and the posterior
-        # is asymptotically normal. For low n, non-normality may lead to bias.
-        # TODO: research replacing this with a proper posterior integral
-        theta_sample = norm(loc=self.model_theta_hat(), scale=np.sqrt(self.model_theta_var())).rvs(n)
-        p0_sample = [empiric(prob, beta=theta_sample) for prob in self.skeletons[self.most_likely_model_index]]
-        return np.array([np.mean(x > eff_cutoff) for x in p0_sample])
+        :param eff_cutoff: the probability of efficacy
+        :type eff_cutoff: float
+        :param n: number of normal variates to sample when sample=True
+        :type n: int
+        :param sample: True to estimate the probabilities by randomly sampling theta, as in earlier versions;
+                        False (default) to calculate them deterministically
+        :type sample: bool
+        :return: probabilities that the probability of efficacy exceeds eff_cutoff, one per dose
+        :rtype: numpy.array
+
+        """
+
+        skeleton = self.skeletons[self.most_likely_model_index]
+        if sample:
+            theta_sample = norm(loc=self.model_theta_hat(), scale=np.sqrt(self.model_theta_var())).rvs(n)
+            p0_sample = [empiric(prob, beta=theta_sample) for prob in skeleton]
+            return np.array([np.mean(x > eff_cutoff) for x in p0_sample])
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.array([_prob_tox_exceeds_normal(empiric, 0, prob, eff_cutoff, self.model_theta_hat(),
+                                                          self.model_theta_var())
+                                 for prob in skeleton])
 
     def prob_acc_eff(self, threshold=None, **kwargs):
         if threshold is None:
@@ -301,8 +358,8 @@ class WATU(EfficacyToxicityDoseFindingTrial):
     # Private interface
     def _stage_one_next_dose(self):
 
-        prob_unacc_tox = self.crm.prob_tox_exceeds(self.tox_limit, n=10**5)  # TODO: make n=10**5 editable
-        prob_unacc_eff = 1 - self.prob_eff_exceeds(self.eff_limit, n=10**5)
+        prob_unacc_tox = self.crm.prob_tox_exceeds(self.tox_limit)
+        prob_unacc_eff = 1 - self.prob_eff_exceeds(self.eff_limit)
         admissable = [(prob_tox < (1-self.tox_certainty)) and (prob_eff < (1-self.eff_certainty))
                       for (prob_eff, prob_tox) in zip(prob_unacc_eff, prob_unacc_tox)]
         admissable_set = [i+1 for i, x in enumerate(admissable) if x]
@@ -344,8 +401,8 @@ class WATU(EfficacyToxicityDoseFindingTrial):
 
     def _stage_two_next_dose(self, tox_probs, eff_probs):
 
-        prob_unacc_tox = self.crm.prob_tox_exceeds(self.tox_limit, n=10**5) # TODO: make n=10**5 editable
-        prob_unacc_eff = 1 - self.prob_eff_exceeds(self.eff_limit, n=10**5)
+        prob_unacc_tox = self.crm.prob_tox_exceeds(self.tox_limit)
+        prob_unacc_eff = 1 - self.prob_eff_exceeds(self.eff_limit)
         admissable = [(prob_tox < (1-self.tox_certainty)) and (prob_eff < (1-self.eff_certainty))
                       for (prob_eff, prob_tox) in zip(prob_unacc_eff, prob_unacc_tox)]
         admissable_set = [i+1 for i, x in enumerate(admissable) if x]
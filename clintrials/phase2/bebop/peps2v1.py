@@ -29,6 +29,7 @@ import logging
 import numpy as np
 import pandas as pd
 
+from clintrials.simulation import dump_json_atomically, open_sims_writer
 from clintrials.stats import chi_squ_test, or_test, ProbabilityDensitySample
 from clintrials.util import correlated_binary_outcomes, atomic_to_json, iterable_to_json
 
@@ -394,27 +395,44 @@ def simulate_peps2_patients(num_patients, prob_pretreated, prob_mutated, params)
 
 def simulate_peps2_trial_batch(model, num_patients, prob_pretreated, prob_biomarker, prob_effes, prob_toxes, efftox_ors,
                                  num_batches, num_sims_per_batch, out_file=None):
+    """ Simulate batches of PePS2 trials, saving after each batch.
+
+    If out_file is a JsonLinesWriter or names a JSON Lines file, e.g. sims.jsonl.gz, each batch of simulations is
+    appended one per line, and the report of parameters is written once, to the path of the file plus
+    '.parameters.json'. Otherwise, the whole object of parameters and simulations is re-written to out_file after each
+    batch, via a temporary file, so that a crash leaves the file of the previous batch.
+
+    """
+
     sims = []
-    sims_object = {}
-    for i in range(num_batches):
-        these_sims = simulate_peps2_trial(model, num_patients=num_patients, prob_pretreated=prob_pretreated, prob_biomarker=prob_biomarker,
-                                          prob_effes=prob_effes, prob_toxes=prob_toxes, efftox_ors=efftox_ors,
-                                          num_sims=num_sims_per_batch, log_every=0)
-        sims = sims + these_sims
-        print 'Ran batch', i, datetime.datetime.now()
-
-        sims_object = OrderedDict()
-        sims_object['Parameters'] = peps2_parameters_report(num_patients=num_patients, prob_pretreated=prob_pretreated, prob_biomarker=prob_biomarker,
-                                                            prob_effes=prob_effes, prob_toxes=prob_toxes, efftox_ors=efftox_ors)
-        sims_object['Simulations'] = sims
-
-        if out_file:
-            try:
-                json.dump(sims_object, open(out_file, 'w'))
-            except:
-                import sys
-                e = sys.exc_info()[0]
-                logging.error(e.message)
+    sims_object = OrderedDict()
+    sims_object['Parameters'] = peps2_parameters_report(num_patients=num_patients, prob_pretreated=prob_pretreated, prob_biomarker=prob_biomarker,
+                                                        prob_effes=prob_effes, prob_toxes=prob_toxes, efftox_ors=efftox_ors)
+    sims_object['Simulations'] = sims
+    writer, close_writer = open_sims_writer(out_file)
+    try:
+        if writer is not None:
+            with open(writer.path + '.parameters.json', 'w') as f:
+                json.dump(sims_object['Parameters'], f)
+        for i in range(num_batches):
+            these_sims = simulate_peps2_trial(model, num_patients=num_patients, prob_pretreated=prob_pretreated, prob_biomarker=prob_biomarker,
+                                              prob_effes=prob_effes, prob_toxes=prob_toxes, efftox_ors=efftox_ors,
+                                              num_sims=num_sims_per_batch, log_every=0)
+            sims.extend(these_sims)
+            print 'Ran batch', i, datetime.datetime.now()
+
+            if writer is not None:
+                writer.write_batch(these_sims)
+            elif out_file:
+                try:
+                    dump_json_atomically(sims_object, out_file)
+                except:
+                    import sys
+                    e = sys.exc_info()[0]
+                    logging.error(e.message)
+    finally:
+        if close_writer:
+            writer.close()
 
     return sims_object
 
@@ -0,0 +1,229 @@
+__author__ = 'Kristian Brock'
+__contact__ = 'kristian.brock@gmail.com'
+
+""" Fixed-node quadrature for the one-parameter posterior integrals in CRM-like dose-finding designs.
+
+The designs in clintrials.dosefinding estimate posterior means, variances and event probabilities as ratios of
+integrals like int g(t) L(t) pi(t) dt, where L is a likelihood and pi a prior density.
+Adaptive quadrature over the real line is accurate but slow; the trapezium rule on a truncated range is quick but
+its accuracy depends on the number of points. This module offers Gauss-Hermite quadrature, centred on the posterior
+mode and scaled by the posterior curvature, so that a few dozen nodes usually achieve accuracy comparable to adaptive
+quadrature. The number of nodes is doubled until successive rules agree, and each estimate is accompanied by an error
+estimate, the discrepancy between the final rule and the rule with half as many nodes.
+
+"""
+
+import numpy as np
+from numpy.polynomial.hermite import hermgauss
+from scipy.optimize import minimize_scalar
+
+
+INTEGRATION_METHODS = ('quad', 'trapezium', 'gauss_hermite')
+_default_num_nodes = 32
+_default_max_nodes = 256
+_default_tol = 1e-8
+_min_param, _max_param = -10, 10
+
+
+def integration_method(use_quick_integration=False, method=None):
+    """ Resolve the numerical integration method to use.
+
+    :param use_quick_integration: the legacy flag, True for trapezium quadrature; False for adaptive quadrature.
+                                    Only used when method is None.
+    :type use_quick_integration: bool
+    :param method: one of 'quad', 'trapezium', 'gauss_hermite', or None to use use_quick_integration
+    :type method: str
+    :return: one of 'quad', 'trapezium', 'gauss_hermite'
+    :rtype: str
+
+    """
+
+    if method is None:
+        return 'trapezium' if use_quick_integration else 'quad'
+    elif method in INTEGRATION_METHODS:
+        return method
+    else:
+        raise ValueError('integration_method should be one of %s.' % ', '.join(INTEGRATION_METHODS))
+
+
+def posterior_mode(log_post, lower=_min_param, upper=_max_param, h=1e-3):
+    """ Locate the mode of a univariate log posterior and the scale implied by its curvature there.
+
+    :param log_post: unnormalised log posterior density, a function of the parameter
+    :type log_post: func
+    :param lower: lower bound for the mode search
+    :type lower: float
+    :param upper: upper bound for the mode search
+    :type upper: float
+    :param h: step used in the finite difference estimate of the curvature
+    :type h: float
+    :return: 2-tuple, (mode, scale), where scale is the standard deviation of the normal approximation at the mode,
+                or None if the log posterior is not concave at the mode
+    :rtype: tuple
+
+    """
+
+    res = minimize_scalar(lambda t: -log_post(t), bounds=(lower, upper), method='bounded')
+    mode = float(res.x)
+    curvature = (log_post(mode + h) - 2 * log_post(mode) + log_post(mode - h)) / h ** 2
+    if np.isfinite(curvature) and curvature < 0:
+        scale = 1 / np.sqrt(-curvature)
+    else:
+        scale = None
+    return mode, scale
+
+
+_hermite_rules = {}
+
+
+def _hermite_rule(num_nodes):
+    """ Get the Gauss-Hermite nodes and log weights for num_nodes, computing them just once. """
+    if num_nodes not in _hermite_rules:
+        x, w = hermgauss(num_nodes)
+        _hermite_rules[num_nodes] = (x, np.log(w) + x ** 2)
+    return _hermite_rules[num_nodes]
+
+
+def _gauss_hermite_rule(log_post, centre, scale, num_nodes):
+    """ Get nodes, normalised posterior weights and the log normalising constant under a rescaled Gauss-Hermite rule.
+
+    Substituting t = centre + sqrt(2) * scale * x, int f(t) dt = sqrt(2) * scale * int f(t(x)) e^{x^2} e^{-x^2} dx,
+    so the Hermite weights are multiplied by sqrt(2) * scale * e^{x^2}. The arithmetic is done in log space.
+
+    """
+
+    x, log_w = _hermite_rule(num_nodes)
+    t = centre + np.sqrt(2) * scale * x
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        log_f = np.asarray(log_post(t), dtype=float)
+    log_f = np.where(np.isnan(log_f), -np.inf, log_f)
+    log_terms = log_f + log_w
+    max_log_term = np.max(log_terms)
+    terms = np.exp(log_terms - max_log_term)
+    total = np.sum(terms)
+    log_norm = max_log_term + np.log(total) + np.log(np.sqrt(2) * scale)
+    return t, terms / total, log_norm
+
+
+class GaussHermitePosterior(object):
+    """ Gauss-Hermite quadrature for the posterior of a single real-valued parameter.
+
+    The rule is centred on the posterior mode and scaled by the posterior curvature there, unless a centre and scale
+    are given. The number of nodes is doubled from num_nodes until the posterior mean, variance and normalising
+    constant change by less than tol, or until max_nodes is reached. Error estimates are the discrepancies between
+    the final rule and the rule with half as many nodes.
+
+    For a normal prior and no data, the rule with centre and scale equal to the prior mean and standard deviation is
+    exact for polynomial integrands.
+
+    e.g. general usage
+    >>> from scipy.stats import norm
+    >>> post = GaussHermitePosterior(norm(1, 2).logpdf)
+    >>> round(post.mean(), 6), round(post.var(), 6), round(post.evidence(), 6)
+    (1.0, 4.0, 1.0)
+
+    """
+
+    def __init__(self, log_post, num_nodes=_default_num_nodes, centre=None, scale=None,
+                 lower=_min_param, upper=_max_param, tol=_default_tol, max_nodes=_default_max_nodes):
+        """
+
+        Params:
+        :param log_post: unnormalised log posterior density, i.e. log likelihood plus log prior density, a function
+                            of the parameter that is vectorised over numpy arrays
+        :type log_post: func
+        :param num_nodes: initial number of nodes in the quadrature rule
+        :type num_nodes: int
+        :param centre: centre of the rule. None to use the posterior mode.
+        :type centre: float
+        :param scale: scale of the rule. None to use the standard deviation of the normal approximation at the mode.
+        :type scale: float
+        :param lower: lower bound for the mode search
+        :type lower: float
+        :param upper: upper bound for the mode search
+        :type upper: float
+        :param tol: absolute tolerance for the posterior mean and variance, and relative tolerance for the
+                    normalising constant, at which to stop doubling the number of nodes
+        :type tol: float
+        :param max_nodes: maximum number of nodes in the quadrature rule
+        :type max_nodes: int
+
+        """
+
+        if num_nodes < 2:
+            raise ValueError('num_nodes should be at least 2.')
+
+        if centre is None or scale is None:
+            mode, mode_scale = posterior_mode(log_post, lower, upper)
+            if centre is None:
+                centre = mode
+            if scale is None:
+                scale = mode_scale if mode_scale is not None else 1.0
+
+        self.centre = centre
+        self.scale = scale
+        half_rule = _gauss_hermite_rule(log_post, centre, scale, max(num_nodes // 2, 1))
+        rule = _gauss_hermite_rule(log_post, centre, scale, num_nodes)
+        while num_nodes < max_nodes and self._discrepancy(rule, half_rule) >= tol:
+            num_nodes *= 2
+            half_rule, rule = rule, _gauss_hermite_rule(log_post, centre, scale, num_nodes)
+        self.num_nodes = num_nodes
+        self.nodes, self.weights, self.log_norm = rule
+        self._half_nodes, self._half_weights, self._half_log_norm = half_rule
+
+    def expect(self, func=None):
+        """ Get the posterior expectation of a function of the parameter.
+
+        :param func: function of the parameter, vectorised so that func(nodes) has the nodes in its last axis.
+                        None for the identity.
+        :type func: func
+        :return: posterior expectation(s)
+        :rtype: float or numpy.array
+
+        """
+
+        return self._expect(func, self.nodes, self.weights)
+
+    def error(self, func=None):
+        """ Estimate the absolute error in expect(func) by comparison to the rule with half as many nodes.
+
+        :param func: function of the parameter, vectorised so that func(nodes) has the nodes in its last axis.
+                        None for the identity.
+        :type func: func
+        :return: absolute error estimate(s)
+        :rtype: float or numpy.array
+
+        """
+
+        return np.abs(self._expect(func, self.nodes, self.weights)
+                      - self._expect(func, self._half_nodes, self._half_weights))
+
+    def mean(self):
+        """ Get the posterior mean. """
+        return self.expect()
+
+    def var(self):
+        """ Get the posterior variance. """
+        mu = self.mean()
+        return self.expect(lambda t: (t - mu) ** 2)
+
+    def evidence(self):
+        """ Get the normalising constant of the posterior, i.e. the integral of exp(log_post). """
+        return np.exp(self.log_norm)
+
+    def evidence_error(self):
+        """ Estimate the absolute error in evidence() by comparison to the rule with half as many nodes. """
+        return np.abs(np.exp(self.log_norm) - np.exp(self._half_log_norm))
+
+    @staticmethod
+    def _expect(func, nodes, weights):
+        if func is None:
+            return np.dot(nodes, weights)
+        return np.dot(func(nodes), weights)
+
+    @staticmethod
+    def _discrepancy(rule, half_rule):
+        (t, w, log_norm), (half_t, half_w, half_log_norm) = rule, half_rule
+        mean, half_mean = np.dot(t, w), np.dot(half_t, half_w)
+        var, half_var = np.dot((t - mean) ** 2, w), np.dot((half_t - half_mean) ** 2, half_w)
+        return max(abs(mean - half_mean), abs(var - half_var), abs(np.expm1(half_log_norm - log_norm)))
@@ -4,12 +4,600 @@ __contact__ = 'kristian.brock@gmail.com'
 
 from collections import OrderedDict
 from datetime import datetime
+from functools import reduce
 import glob
+import gzip
+import hashlib
+import io
 import itertools
 import json
+import os
+import random
+import re
+import threading
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
+import numpy as np
 
-def run_sims(sim_func, n1=1, n2=1, out_file=None, **kwargs):
+
+def _sim_executor(n_jobs=None, executor=None):
+    """ Get the executor to which batches of simulations are submitted.
+
+    :param n_jobs: number of worker processes, or None to simulate serially unless executor is given
+    :type n_jobs: int
+    :param executor: a concurrent.futures.Executor to use rather than a process pool of n_jobs workers
+    :type executor: concurrent.futures.Executor
+    :return: 2-tuple, (executor or None, True if the executor was created here and should be shut down by the caller)
+    :rtype: tuple
+
+    """
+
+    if executor is not None:
+        return executor, False
+    elif n_jobs is not None and n_jobs > 1:
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError:
+            raise ImportError('Parallel simulation requires concurrent.futures, which is in the standard library '
+                              'from Python 3.2 and in the futures package for Python 2.7.')
+        return ProcessPoolExecutor(max_workers=n_jobs), True
+    else:
+        return None, False
+
+
+def _num_workers(n_jobs=None):
+    """ Get the number of workers among which to split work, n_jobs if given, else the number of CPUs. """
+    if n_jobs:
+        return n_jobs
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _seed_sequence_class():
+    try:
+        from numpy.random import SeedSequence
+    except ImportError:
+        raise ImportError('Seeded and parallel simulation require numpy.random.SeedSequence, from numpy 1.17.')
+    return SeedSequence
+
+
+def _sim_seed_sequence(seed=None, parallel=False):
+    """ Get the root numpy.random.SeedSequence from which each simulation gets its own child stream.
+
+    Serial runs without a seed return None so that sim_func continues to use the global random state, as before.
+
+    """
+
+    if seed is None and not parallel:
+        return None
+    SeedSequence = _seed_sequence_class()
+    return seed if isinstance(seed, SeedSequence) else SeedSequence(seed)
+
+
+def _seed_global_rngs(seed_seq):
+    """ Seed the global numpy and random states, used by sim_func, from a numpy.random.SeedSequence. """
+    np.random.seed(seed_seq.generate_state(4))
+    random.seed(int(seed_seq.generate_state(1, np.uint64)[0]))
+
+
+def _run_sim_chunk(sim_func, params, seed_seqs):
+    """ Run a simulation for each map of kwargs in params, seeding each from its own stream in seed_seqs. """
+    sims = []
+    for kwargs, seed_seq in zip(params, seed_seqs):
+        if seed_seq is not None:
+            _seed_global_rngs(seed_seq)
+        sims.append(sim_func(**kwargs))
+    return sims
+
+
+def _run_sim_batch(sim_func, params, root_seed_seq=None, executor=None, chunk_size=None, num_workers=None):
+    """ Run a batch of simulations, one for each map of kwargs in params, serially or on executor.
+
+    Each simulation gets its own child of root_seed_seq, spawned in order, so the results do not depend on how the
+    batch is split across workers. Results are returned in the order of params.
+    Without chunk_size, the batch is split into about four chunks for each of num_workers, by default the number of
+    CPUs.
+
+    """
+
+    if root_seed_seq is None:
+        seed_seqs = [None] * len(params)
+    else:
+        seed_seqs = root_seed_seq.spawn(len(params))
+
+    if executor is None or len(params) == 0:
+        return _run_sim_chunk(sim_func, params, seed_seqs)
+    else:
+        if not chunk_size:
+            chunk_size = int(np.ceil(len(params) / (4.0 * _num_workers(num_workers))))
+        futures = [executor.submit(_run_sim_chunk, sim_func, params[i:i+chunk_size], seed_seqs[i:i+chunk_size])
+                   for i in range(0, len(params), chunk_size)]
+        sims = []
+        for future in futures:
+            sims += future.result()
+        return sims
+
+
+_json_lines_extensions = ('.jsonl', '.ndjson')
+
+
+def _is_gzip(file_loc):
+    return file_loc.endswith('.gz')
+
+
+def _is_json_lines(file_loc):
+    """ Files are taken to be JSON Lines when named like *.jsonl or *.ndjson, optionally followed by .gz """
+    if _is_gzip(file_loc):
+        file_loc = file_loc[:-3]
+    return file_loc.endswith(_json_lines_extensions)
+
+
+class JsonLinesWriter(object):
+    """ Append-only writer of simulations to a JSON Lines file, i.e. one JSON object per line.
+
+    Each call to write_batch appends just the new simulations, then flushes and fsyncs the file, so saving N batches
+    costs time linear in N and a crash can only lose the batch being written. Paths ending in .gz are gzip-compressed,
+    each batch as a separate gzip member, so that the file is complete after each batch.
+    With background=True, batches are compressed and written by a background thread so that simulation does not wait
+    on I/O. Errors in that thread are raised by the next call to write_batch, flush or close.
+
+    e.g. general usage
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'sims.jsonl.gz')
+    >>> with JsonLinesWriter(path, background=True) as writer:
+    ...     writer.write_batch([{'Dose': 1}, {'Dose': 2}])
+    ...     writer.write_batch([{'Dose': 3}])
+    >>> [x['Dose'] for x in iter_json_sims(path)]
+    [1, 2, 3]
+
+    """
+
+    def __init__(self, path, mode='a', compress=None, fsync=True, background=False, max_pending_batches=0):
+        """
+
+        Params:
+        :param path: location of the file
+        :type path: str
+        :param mode: 'a' to append to an existing file; 'w' to truncate it
+        :type mode: str
+        :param compress: True to gzip-compress the output; None to compress when path ends in .gz
+        :type compress: bool
+        :param fsync: True to fsync the file after each batch
+        :type fsync: bool
+        :param background: True to write batches on a background thread
+        :type background: bool
+        :param max_pending_batches: maximum number of batches waiting to be written before write_batch blocks.
+                                        0 for no maximum. Only used when background is True.
+        :type max_pending_batches: int
+
+        """
+
+        if mode not in ('a', 'w'):
+            raise ValueError("mode should be 'a' or 'w'.")
+        self.path = path
+        self.compress = _is_gzip(path) if compress is None else compress
+        self.fsync = fsync
+        self.num_written = 0
+        self._file = open(path, mode + 'b')
+        self._error = None
+        if background:
+            self._queue = Queue(maxsize=max_pending_batches)
+            self._thread = threading.Thread(target=self._work)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._queue = None
+            self._thread = None
+
+    def write_batch(self, records):
+        """ Append a batch of JSON-able records to the file, one per line.
+
+        :param records: JSON-able objects, e.g. simulations
+        :type records: list
+
+        """
+
+        self._raise_error()
+        lines = [json.dumps(x) + '\n' for x in records]
+        if not lines:
+            return
+        data = ''.join(lines).encode('utf-8')
+        if self._queue is None:
+            self._write(data)
+        else:
+            self._queue.put(data)
+        self.num_written += len(lines)
+
+    def flush(self):
+        """ Wait until all batches have been written. """
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def size(self):
+        """ Get the size of the file in bytes, once all batches have been written. """
+        self.flush()
+        return os.fstat(self._file.fileno()).st_size
+
+    def truncate(self, size):
+        """ Truncate the file to size bytes, once all batches have been written, e.g. to discard a torn batch. """
+        self.flush()
+        self._file.truncate(size)
+        self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        """ Write outstanding batches and close the file. """
+        if self._file.closed:
+            return
+        try:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+            self._raise_error()
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write(self, data):
+        if self.compress:
+            gz = gzip.GzipFile(fileobj=self._file, mode='wb', mtime=0)
+            gz.write(data)
+            gz.close()
+        else:
+            self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _work(self):
+        while True:
+            data = self._queue.get()
+            try:
+                if data is None:
+                    return
+                if self._error is None:
+                    self._write(data)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
+
+
+def open_sims_writer(out_file, mode='w'):
+    """ Get the JsonLinesWriter for out_file, if it is one or names a JSON Lines file.
+
+    e.g. general usage
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'sims.jsonl')
+    >>> writer, close_writer = open_sims_writer(path)
+    >>> writer.write_batch([{'Dose': 1}])
+    >>> if close_writer:
+    ...     writer.close()
+    >>> open_sims_writer(path[:-1])
+    (None, False)
+
+    :param out_file: a JsonLinesWriter, or the location of the file of simulations, or None
+    :type out_file: JsonLinesWriter or str
+    :param mode: 'a' to append to an existing file; 'w' to truncate it
+    :type mode: str
+    :return: 2-tuple, (writer or None, True if the writer was opened here and should be closed by the caller)
+    :rtype: tuple
+
+    """
+
+    if isinstance(out_file, JsonLinesWriter):
+        return out_file, False
+    elif out_file and _is_json_lines(out_file):
+        return JsonLinesWriter(out_file, mode=mode), True
+    else:
+        return None, False
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def dump_json_atomically(obj, path):
+    """ Write obj to path as JSON, via a temporary file that then replaces path, so that a crash leaves either the old
+    or the new file.
+
+    :param obj: JSON-able object
+    :type obj: object
+    :param path: location of the file
+    :type path: str
+
+    """
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    _replace(tmp_path, path)
+
+
+def _save_sims(out_file, writer, sims, new_sims, strict=False):
+    """ Save simulations after a batch, appending new_sims with writer if given, else re-dumping all sims to out_file.
+
+    The JSON array is written to a temporary file that then replaces out_file, so that a crash leaves either the old
+    or the new file. Errors are printed, or raised if strict is True, e.g. when a checkpoint relies on the file.
+
+    """
+
+    if writer is not None:
+        writer.write_batch(new_sims)
+    elif out_file:
+        try:
+            dump_json_atomically(sims, out_file)
+        except Exception as e:
+            if strict:
+                raise
+            print('Error writing: %s' % e)
+
+
+def _checkpoint_file(out_file):
+    return out_file + '.ckpt'
+
+
+def _rng_state(root_seed_seq):
+    """ Get a JSON-able record of the random state from which the next batch of simulations continues. """
+    if root_seed_seq is not None:
+        entropy = root_seed_seq.entropy
+        return {'SeedSequence': {'entropy': entropy.tolist() if hasattr(entropy, 'tolist') else entropy,
+                                 'spawn_key': [int(x) for x in root_seed_seq.spawn_key],
+                                 'pool_size': root_seed_seq.pool_size,
+                                 'n_children_spawned': root_seed_seq.n_children_spawned}}
+    else:
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        version, internal_state, gauss_next = random.getstate()
+        return {'NumpyState': [name, keys.tolist(), int(pos), int(has_gauss), float(cached_gaussian)],
+                'RandomState': [version, list(internal_state), gauss_next]}
+
+
+def _restore_rng_state(state):
+    """ Restore the random state recorded by _rng_state, returning the root SeedSequence, if there was one. """
+    if 'SeedSequence' in state:
+        SeedSequence = _seed_sequence_class()
+        x = state['SeedSequence']
+        return SeedSequence(x['entropy'], spawn_key=tuple(x['spawn_key']), pool_size=x['pool_size'],
+                            n_children_spawned=x['n_children_spawned'])
+    else:
+        name, keys, pos, has_gauss, cached_gaussian = state['NumpyState']
+        np.random.set_state((str(name), np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+        version, internal_state, gauss_next = state['RandomState']
+        random.setstate((version, tuple(internal_state), gauss_next))
+        return None
+
+
+def _write_checkpoint(path, checkpoint):
+    """ Write checkpoint to path atomically, so that a crash leaves either the old or the new checkpoint. """
+    dump_json_atomically(checkpoint, path)
+
+
+def _fingerprint_default(x):
+    """ Describe x, which json cannot serialise, for a fingerprint. Objects other than numpy values are described by
+    name, or the name of their type, so that the description is the same in every process. """
+    if isinstance(x, (np.ndarray, np.generic)):
+        return x.tolist()
+    name = getattr(x, '__qualname__', None) or getattr(x, '__name__', None)
+    if name is None:
+        x, name = type(x), type(x).__name__
+    return '<%s.%s>' % (getattr(x, '__module__', None), name)
+
+
+def _run_fingerprint(sim_func, n2, seed, params, precision=None, min_sims=None):
+    """ Get a digest of the arguments that determine the simulations of a run, to check that a checkpoint belongs to
+    the run resuming from it.
+
+    :param params: the kwargs for sim_func, or the items of a ParameterSpace
+    :param precision: the precision targets of the run, or None
+    :param min_sims: the minimum number of sims before the run may stop by precision; ignored without precision
+    :return: hexadecimal SHA-256 digest
+    :rtype: str
+
+    """
+
+    if hasattr(seed, 'spawn_key'):
+        entropy = seed.entropy
+        seed = {'entropy': entropy.tolist() if hasattr(entropy, 'tolist') else entropy,
+                'spawn_key': [int(x) for x in seed.spawn_key]}
+    run = OrderedDict([('SimFunc', sim_func), ('BatchSize', n2), ('Seed', seed), ('Params', params),
+                       ('Precision', {'Targets': sorted((label, target_se)
+                                                        for label, (func, target_se) in precision.items()),
+                                      'MinSims': min_sims} if precision else None)])
+    return hashlib.sha256(json.dumps(run, default=_fingerprint_default).encode('utf-8')).hexdigest()
+
+
+def _read_checkpoint(path, n2, fingerprint=None):
+    """ Read the checkpoint at path, or get None if there is none. """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        checkpoint = json.load(f)
+    if checkpoint['BatchSize'] != n2:
+        raise ValueError('Checkpoint %s was written with n2=%s, not %s.' % (path, checkpoint['BatchSize'], n2))
+    if checkpoint.get('Fingerprint') != fingerprint:
+        raise ValueError('Checkpoint %s was written by a run with a different sim_func, seed, kwargs, parameter space '
+                         'or precision or min_sims. Delete it, or use another out_file, to start afresh.' % path)
+    return checkpoint
+
+
+def _restore_sims(out_file, writer, checkpoint):
+    """ Get the simulations saved up to the checkpoint, discarding any saved after it. """
+    if writer is not None:
+        writer.truncate(checkpoint['OutFileSize'])
+        sims = list(iter_json_sims(out_file))
+    else:
+        sims = _open_json_local(out_file)[:checkpoint['NumSims']]
+    if len(sims) != checkpoint['NumSims']:
+        raise ValueError('%s holds %s sims but its checkpoint expects %s.' % (out_file, len(sims),
+                                                                           checkpoint['NumSims']))
+    return sims
+
+
+class _PrecisionMonitor(object):
+    """ Running means and Monte Carlo standard errors of summaries of simulations, for each parameter combination.
+
+    precision maps a label to a 2-tuple, (func, target_se), where func takes a simulation and returns a number or a
+    list of numbers, like an indicator of correct selection or the number of patients at each dose; and target_se is
+    the standard error sought for the mean of each. A combination has converged when it has at least min_sims sims and
+    every target has been met.
+    Means and sums of squared deviations are accumulated by Welford's method. Summaries that have only taken the values
+    0 and 1 are treated as proportions, with variance at least p(1-p) where p = (k + 0.5) / (n + 1) for k ones in n
+    sims, so that a run of identical outcomes does not give a standard error of 0.
+
+    """
+
+    def __init__(self, precision, num_combinations=1, min_sims=100):
+        self.precision = OrderedDict(sorted(precision.items()))
+        self.num_combinations = num_combinations
+        self.min_sims = max(2, min_sims)
+        self._stats = OrderedDict()  # hashable params -> [params, n, {label: [mean, M2, binary]}]
+
+    def update(self, params, sims):
+        for p, sim in zip(params, sims):
+            key = _hashable(p)
+            if key not in self._stats:
+                self._stats[key] = [p, 0, OrderedDict()]
+            stats = self._stats[key]
+            stats[1] += 1
+            n = stats[1]
+            for label, (func, target_se) in self.precision.items():
+                x = np.atleast_1d(np.asarray(func(sim), dtype=float))
+                mean, m2, binary = stats[2].get(label, (np.zeros_like(x), np.zeros_like(x),
+                                                        np.ones_like(x, dtype=bool)))
+                delta = x - mean
+                mean = mean + delta / n
+                stats[2][label] = (mean, m2 + delta * (x - mean), binary & ((x == 0) | (x == 1)))
+
+    def estimates(self, params):
+        """ Get the running means and standard errors for a parameter combination as dict, label -> (mean, se). """
+        stats = self._stats.get(_hashable(params))
+        if stats is None or stats[1] < 2:
+            return None
+        n = stats[1]
+        estimates = OrderedDict()
+        for label, (mean, m2, binary) in stats[2].items():
+            p = (mean * n + 0.5) / (n + 1)
+            var = np.where(binary, np.maximum(m2 / (n - 1), p * (1 - p)), m2 / (n - 1))
+            estimates[label] = (mean, np.sqrt(var / n))
+        return estimates
+
+    def converged(self, params):
+        stats = self._stats.get(_hashable(params))
+        if stats is None or stats[1] < self.min_sims:
+            return False
+        estimates = self.estimates(params)
+        return all(np.all(se <= self.precision[label][1]) for label, (mean, se) in estimates.items())
+
+    def num_converged(self):
+        return sum(1 for p, n, s in self._stats.values() if self.converged(p))
+
+    def done(self):
+        return self.num_converged() >= self.num_combinations
+
+    def to_json(self):
+        return [[p, n, OrderedDict((label, [mean.tolist(), m2.tolist(), binary.tolist()])
+                                   for label, (mean, m2, binary) in s.items())]
+                for p, n, s in self._stats.values()]
+
+    def restore(self, state):
+        self._stats = OrderedDict()
+        for p, n, s in state:
+            self._stats[_hashable(p)] = [p, n, OrderedDict((label, (np.array(mean), np.array(m2),
+                                                                    np.array(binary, dtype=bool)))
+                                                           for label, (mean, m2, binary) in s.items())]
+
+
+def _run_sim_batches(sim_func, get_params, n1, n2, out_file=None, n_jobs=None, executor=None, seed=None,
+                     chunk_size=None, resume=False, params_iterator=None, monitor=None, fingerprint=None):
+    """ Run n1 batches of n2 simulations, the kwargs for each batch provided by get_params, saving after each batch.
+
+    With resume=True, a checkpoint of the batch count, position of params_iterator and random state is written next
+    to out_file after each batch, along with fingerprint, from :func:`_run_fingerprint`. If a checkpoint with the
+    same fingerprint exists at the start, the run continues from it. The checkpoint is deleted when the run completes.
+    Runs with resume=False delete any stale checkpoint next to out_file.
+    If a _PrecisionMonitor is given, it is updated after each batch and the run stops early when it is done.
+
+    """
+
+    if resume and (not out_file or isinstance(out_file, JsonLinesWriter)):
+        raise ValueError('resume requires out_file to be a file location.')
+    if not resume and out_file and not isinstance(out_file, JsonLinesWriter) \
+            and os.path.exists(_checkpoint_file(out_file)):
+        os.remove(_checkpoint_file(out_file))
+
+    _executor, shutdown = _sim_executor(n_jobs, executor)
+    root_seed_seq = _sim_seed_sequence(seed, parallel=_executor is not None)
+    checkpoint_file = _checkpoint_file(out_file) if resume else None
+    checkpoint = _read_checkpoint(checkpoint_file, n2, fingerprint) if resume else None
+    writer, close_writer = open_sims_writer(out_file, mode='a' if checkpoint else 'w')
+    sims = []
+    first_batch = 0
+    try:
+        if checkpoint:
+            sims = _restore_sims(out_file, writer, checkpoint)
+            first_batch = checkpoint['Batches']
+            root_seed_seq = _restore_rng_state(checkpoint)
+            if root_seed_seq is None and _executor is not None:
+                raise ValueError('An unseeded serial run cannot be resumed in parallel.')
+            if params_iterator is not None:
+                params_iterator.cursor = checkpoint['Cursor']
+            if monitor is not None:
+                monitor.restore(checkpoint['Precision'])
+            print('Resuming from batch {} with {} sims'.format(first_batch, len(sims)))
+
+        for j in range(first_batch, n1):
+            if monitor is not None and monitor.done():
+                break
+            params = get_params()
+            sims1 = _run_sim_batch(sim_func, params, root_seed_seq, _executor, chunk_size, n_jobs)
+            sims += sims1
+            _save_sims(out_file, writer, sims, sims1, strict=resume)
+            if monitor is not None:
+                monitor.update(params, sims1)
+            if resume:
+                checkpoint = _rng_state(root_seed_seq)
+                checkpoint['Batches'] = j + 1
+                checkpoint['BatchSize'] = n2
+                checkpoint['NumSims'] = len(sims)
+                checkpoint['Cursor'] = params_iterator.cursor if params_iterator is not None else None
+                checkpoint['OutFileSize'] = writer.size() if writer is not None else None
+                checkpoint['Precision'] = monitor.to_json() if monitor is not None else None
+                checkpoint['Fingerprint'] = fingerprint
+                _write_checkpoint(checkpoint_file, checkpoint)
+            if monitor is not None:
+                print('{} {} {} {}/{} converged'.format(j, datetime.now(), len(sims), monitor.num_converged(),
+                                                        monitor.num_combinations))
+            else:
+                print('{} {} {}'.format(j, datetime.now(), len(sims)))
+    finally:
+        if shutdown:
+            _executor.shutdown()
+        if close_writer:
+            writer.close()
+    if resume and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return sims
+
+
+def run_sims(sim_func, n1=1, n2=1, out_file=None, n_jobs=None, executor=None, seed=None, chunk_size=None,
+             resume=False, precision=None, min_sims=100, **kwargs):
     """ Run simulations using a delegate function.
 
     :param sim_func: Delegate function to be called to yield single simulation.
@@ -18,8 +606,32 @@ def run_sims(sim_func, n1=1, n2=1, out_file=None, **kwargs):
     :type n1: int
     :param n2: Number of iterations per batch
     :type n2: int
-    :param out_file: Location of file for incremental saving after completion of each batch.
-    :type out_file: str
+    :param out_file: Location of file for incremental saving after completion of each batch. Paths like *.jsonl or
+                        *.jsonl.gz are written as JSON Lines, appending each batch; other paths are re-written with
+                        all sims as a JSON array. A JsonLinesWriter may also be given, and is left open.
+    :type out_file: str or clintrials.simulation.JsonLinesWriter
+    :param n_jobs: number of worker processes across which each batch is spread. None or 1 to simulate serially.
+    :type n_jobs: int
+    :param executor: a concurrent.futures.Executor to use rather than a process pool of n_jobs workers
+    :type executor: concurrent.futures.Executor
+    :param seed: seed for the numpy.random.SeedSequence from which each simulation gets an independent stream.
+                    None to simulate serially from the current global random state, or to seed parallel workers
+                    from fresh entropy.
+    :type seed: int or numpy.random.SeedSequence
+    :param chunk_size: number of simulations submitted to a worker at a time. None to split each batch into about four
+                        chunks per worker, counting n_jobs workers, or the number of CPUs if just executor is given.
+    :type chunk_size: int
+    :param resume: True to write a checkpoint to out_file + '.ckpt' after each batch and, if a checkpoint exists
+                    already, to continue from the last completed batch as if the run had not been interrupted
+    :type resume: bool
+    :param precision: optional dict, label -> (func, target_se), to stop early once the Monte Carlo standard errors of
+                        the means of summaries of the sims have reached their targets. func takes a sim and returns a
+                        number or list of numbers, e.g. 1 for correct selection, else 0; or the number of patients
+                        at each dose. target_se is the standard error sought for the mean of each. The estimates are
+                        checked after each batch, so n1 becomes the maximum number of batches.
+    :type precision: dict
+    :param min_sims: minimum number of sims before the run may be stopped by precision
+    :type min_sims: int
     :param kwargs: key-word args for sim_func
     :type kwargs: dict
 
@@ -28,24 +640,34 @@ def run_sims(sim_func, n1=1, n2=1, out_file=None, **kwargs):
         - n1 * n2 simualtions are performed, in all.
         - sim_func is expected to return a JSON-able object
         - file is saved after each of n1 iterations, where applicable.
+        - when simulating in parallel, sim_func and kwargs must be picklable, and sim_func should draw its random
+          numbers from numpy.random or random. Each simulation seeds those global states from its own child
+          SeedSequence, so for a given seed, the results are the same whatever the number of workers.
+          Thread pools share those global states and so should not be used as executor.
+        - seeded and parallel runs require numpy 1.17 or later, and parallel runs on Python 2.7 require the futures
+          package.
+        - when resuming, out_file must be a location, and sim_func, n2, seed, kwargs, the targets of precision and
+          min_sims must be as before, else the checkpoint is refused. kwargs are compared in their JSON form, with other
+          objects compared by type. n1 may be increased to extend an interrupted run. The random state is restored
+          from the checkpoint, so the output matches an uninterrupted run. The checkpoint is deleted when the run
+          completes, and runs with resume=False delete any stale checkpoint.
+        - with precision, summaries that have only taken the values 0 and 1, like indicators of correct selection,
+          are treated as proportions, with variance at least p(1-p) where p = (k + 0.5) / (n + 1) for k ones in n
+          sims. Together with min_sims, this stops a run of identical early outcomes from ending the run with a
+          standard error of 0.
 
     """
 
-    sims = []
-    for j in range(n1):
-        sims1 = [sim_func(**kwargs) for i in range(n2)]
-        sims += sims1
-        if out_file:
-            try:
-                with open(out_file, 'w') as outfile:
-                    json.dump(sims, outfile)
-            except Exception as e:
-                print('Error writing: %s' % e)
-        print('{} {} {}'.format(j, datetime.now(), len(sims)))
-    return sims
+    monitor = _PrecisionMonitor(precision, min_sims=min_sims) if precision else None
+    fingerprint = _run_fingerprint(sim_func, n2, seed, sorted(kwargs.items()), precision,
+                                   min_sims) if resume else None
+    return _run_sim_batches(sim_func, lambda: [kwargs] * n2, n1, n2, out_file=out_file, n_jobs=n_jobs,
+                            executor=executor, seed=seed, chunk_size=chunk_size, resume=resume, monitor=monitor,
+                            fingerprint=fingerprint)
 
 
-def sim_parameter_space(sim_func, ps, n1=1, n2=None, out_file=None):
+def sim_parameter_space(sim_func, ps, n1=1, n2=None, out_file=None, n_jobs=None, executor=None, seed=None,
+                        chunk_size=None, resume=False, precision=None, min_sims=100):
     """ Run simulations using a function and a ParameterSpace.
 
     :param sim_func: function to be called to yield single simulation. Parameters are provided via ps as unpacked kwargs
@@ -56,36 +678,197 @@ def sim_parameter_space(sim_func, ps, n1=1, n2=None, out_file=None):
     :type n1: int
     :param n2: Number of iterations per batch
     :type n2: int
-    :param out_file: Location of file for incremental saving after completion of each batch.
-    :type out_file: str
+    :param out_file: Location of file for incremental saving after completion of each batch. Paths like *.jsonl or
+                        *.jsonl.gz are written as JSON Lines, appending each batch; other paths are re-written with
+                        all sims as a JSON array. A JsonLinesWriter may also be given, and is left open.
+    :type out_file: str or clintrials.simulation.JsonLinesWriter
+    :param n_jobs: number of worker processes across which each batch is spread. None or 1 to simulate serially.
+    :type n_jobs: int
+    :param executor: a concurrent.futures.Executor to use rather than a process pool of n_jobs workers
+    :type executor: concurrent.futures.Executor
+    :param seed: seed for the numpy.random.SeedSequence from which each simulation gets an independent stream.
+                    None to simulate serially from the current global random state, or to seed parallel workers
+                    from fresh entropy.
+    :type seed: int or numpy.random.SeedSequence
+    :param chunk_size: number of simulations submitted to a worker at a time. None to split each batch into about four
+                        chunks per worker, counting n_jobs workers, or the number of CPUs if just executor is given.
+    :type chunk_size: int
+    :param resume: True to write a checkpoint to out_file + '.ckpt' after each batch and, if a checkpoint exists
+                    already, to continue from the last completed batch as if the run had not been interrupted
+    :type resume: bool
+    :param precision: optional dict, label -> (func, target_se), to stop simulating each parameter combination once
+                        the Monte Carlo standard errors of the means of func(sim) have reached target_se. See
+                        :func:`clintrials.simulation.run_sims`. Later batches cycle through only the combinations
+                        whose targets have not been met, and n1 becomes the maximum number of batches.
+    :type precision: dict
+    :param min_sims: minimum number of sims of each parameter combination before it may be stopped by precision
+    :type min_sims: int
 
     .. note::
 
-        - n1 * n2 simualtions are performed, in all.
+        - n1 * n2 simualtions are performed, in all, unless precision is given.
         - sim_func is expected to return a JSON-able object
         - file is saved after each of n1 iterations, where applicable.
+        - see :func:`clintrials.simulation.run_sims` for the requirements of parallel simulation and resuming.
+          When resuming, the parameter space must also be as before.
+          With precision and resume, the parameter values must also be JSON-able.
 
     """
 
     if not n2 or n2 <= 0:
         n2 = ps.size()
 
-    sims = []
     params_iterator = ps.get_cyclical_iterator()
-    for j in range(n1):
-        sims1 = [sim_func(**params_iterator.next()) for i in range(n2)]
-        sims += sims1
-        if out_file:
+    if precision:
+        num_combinations = len(params_iterator.paths)
+        monitor = _PrecisionMonitor(precision, num_combinations, min_sims)
+
+        def get_params():
+            # Cycle through the combinations that have yet to converge
+            params, skipped = [], 0
+            while len(params) < n2 and skipped < num_combinations:
+                x = params_iterator.next()
+                if monitor.converged(x):
+                    skipped += 1
+                else:
+                    params.append(x)
+                    skipped = 0
+            return params
+    else:
+        monitor = None
+        get_params = lambda: [params_iterator.next() for i in range(n2)]
+    fingerprint = _run_fingerprint(sim_func, n2, seed, list(ps.vals_map.items()), precision,
+                                   min_sims) if resume else None
+    return _run_sim_batches(sim_func, get_params, n1, n2, out_file=out_file, n_jobs=n_jobs, executor=executor,
+                            seed=seed, chunk_size=chunk_size, resume=resume, params_iterator=params_iterator,
+                            monitor=monitor, fingerprint=fingerprint)
+
+
+_json_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def _read_more(f, buf, pos, size):
+    """ Drop the consumed part of buf and append up to size more characters from f. """
+    chunk = f.read(size)
+    return buf[pos:] + chunk, 0, len(chunk) == 0
+
+
+def _skip_whitespace(f, buf, pos, eof, size):
+    """ Advance pos to the next non-whitespace character, reading from f as necessary, or to the end at EOF. """
+    while True:
+        pos = _json_whitespace.match(buf, pos).end()
+        if pos < len(buf) or eof:
+            return buf, pos, eof
+        buf, pos, eof = _read_more(f, buf, pos, size)
+
+
+def iter_json_array(f, chunk_size=65536):
+    """ Incrementally parse a top-level JSON array, yielding one element at a time.
+
+    The file is read in chunks, so memory is bounded by the largest element plus chunk_size, not the size of the file.
+
+    :param f: file-like object of text, opened for reading
+    :type f: file
+    :param chunk_size: number of characters to read at a time
+    :type chunk_size: int
+    :return: generator of the elements of the array
+    :rtype: generator
+
+    e.g.
+
+    >>> import io
+    >>> list(iter_json_array(io.StringIO(u'[{"Dose": 1}, 2.5, [3, 4] ]'), chunk_size=4))
+    [{'Dose': 1}, 2.5, [3, 4]]
+
+    """
+
+    decoder = json.JSONDecoder()
+    buf, pos, eof = _skip_whitespace(f, '', 0, False, chunk_size)
+    if pos >= len(buf) or buf[pos] != '[':
+        raise ValueError('Expecting a JSON array.')
+    pos += 1
+
+    first = True
+    while True:
+        # Find the next element, or the end of the array
+        buf, pos, eof = _skip_whitespace(f, buf, pos, eof, chunk_size)
+        if pos >= len(buf):
+            raise ValueError('Unterminated JSON array.')
+        if buf[pos] == ']':
+            return
+        if not first:
+            if buf[pos] != ',':
+                raise ValueError("Expecting ',' delimiter in JSON array.")
+            buf, pos, eof = _skip_whitespace(f, buf, pos + 1, eof, chunk_size)
+        first = False
+
+        # Decode the element, reading more while it is incomplete. An element is only complete once followed by a
+        # delimiter, because a number split across chunks, like 2.5 read as 2. then 5, decodes in part.
+        # Reads double in size so that large elements are not re-parsed many times.
+        size = chunk_size
+        while True:
             try:
-                with open(out_file, 'w') as outfile:
-                    json.dump(sims, outfile)
-            except Exception as e:
-                print('Error writing: %s' % e)
-        print('{} {} {}'.format(j, datetime.now(), len(sims)))
-    return sims
+                obj, end = decoder.raw_decode(buf, pos)
+                q = _json_whitespace.match(buf, end).end()
+                if eof or (q < len(buf) and buf[q] in ',]'):
+                    break
+            except ValueError:
+                if eof:
+                    raise
+            buf, pos, eof = _read_more(f, buf, pos, size)
+            size *= 2
+        pos = end
+        yield obj
+
+
+def _open_text(file_loc):
+    """ Open file_loc for reading as UTF-8 text, decompressing it if it is gzipped. """
+    if _is_gzip(file_loc):
+        return io.TextIOWrapper(gzip.open(file_loc, 'rb'), encoding='utf-8')
+    return io.open(file_loc, 'r', encoding='utf-8')
+
+
+def iter_json_sims(file_loc):
+    """ Iterate the simulations in a file, either a JSON array or JSON Lines, optionally gzip-compressed.
+
+    JSON Lines files are read one line at a time. A final line left incomplete by an interrupted write is ignored.
+    JSON arrays are parsed incrementally by :func:`clintrials.simulation.iter_json_array`, so that just one simulation
+    at a time is held in memory.
+
+    :param file_loc: location of the file. JSON Lines files are named like *.jsonl or *.ndjson, optionally with .gz
+    :type file_loc: str
+    :return: generator of simulations
+    :rtype: generator
+
+    """
+
+    opener = gzip.open if _is_gzip(file_loc) else open
+    if _is_json_lines(file_loc):
+        with opener(file_loc, 'rb') as f:
+            line = b''
+            try:
+                for line in f:
+                    if line.strip():
+                        try:
+                            yield json.loads(line.decode('utf-8'))
+                        except ValueError:
+                            if line.endswith(b'\n'):
+                                raise
+            except EOFError:
+                # A gzip member truncated by an interrupted write
+                pass
+    else:
+        with _open_text(file_loc) as f:
+            for x in iter_json_array(f):
+                yield x
 
 
 def _open_json_local(file_loc):
+    if _is_json_lines(file_loc):
+        return list(iter_json_sims(file_loc))
+    elif _is_gzip(file_loc):
+        with gzip.open(file_loc, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
     return json.load(open(file_loc, 'r'))
 
 
@@ -101,24 +884,413 @@ def go_fetch_json_sims(file_pattern):
     files = glob.glob(file_pattern)
     sims = []
     for f in files:
-        sub_sims = _open_json_local(f)
+        sub_sims = list(iter_json_sims(f))
         print('{} {}'.format(f, len(sub_sims)))
         sims += sub_sims
     print('Fetched %s sims' % len(sims))
     return sims
 
 
+try:
+    _string_types = (str, unicode)
+except NameError:
+    _string_types = (str,)
+
+
+def _compact_int_array(values):
+    """ Get an array of integers in the smallest signed integer type that holds them all. """
+    try:
+        x = np.asarray(values, dtype=np.int64)
+    except OverflowError:
+        return _object_array(values)
+    if len(x) == 0:
+        return x
+    return x.astype(np.result_type(np.min_scalar_type(-abs(int(x.min())) - 1), np.min_scalar_type(-int(x.max()) - 1)))
+
+
+def _object_array(values):
+    x = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        x[i] = v
+    return x
+
+
+def _typed_array(values):
+    """ Get values as a numpy array of bools, compact integers, floats or strings, or objects failing those.
+    Integers mixed with floats are kept as objects, so that each value keeps its type. """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int8)
+    elif all(isinstance(v, (bool, np.bool_)) for v in values):
+        return np.array(values, dtype=bool)
+    elif all(isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)) for v in values):
+        return _compact_int_array(values)
+    elif all(isinstance(v, (float, np.floating)) for v in values):
+        return np.array(values, dtype=float)
+    elif all(isinstance(v, _string_types) for v in values):
+        return np.array(values)
+    else:
+        return _object_array(values)
+
+
+def _concatenate_arrays(arrays):
+    """ Concatenate arrays, ignoring the types of empty arrays and falling back to objects if types conflict, as
+    integers and floats do. """
+    non_empty = [x for x in arrays if len(x)]
+    if len(non_empty) == 0:
+        return arrays[0][:0] if len(arrays) else np.zeros(0, dtype=np.int8)
+    kinds = set(x.dtype.kind for x in non_empty)
+    if kinds <= set('iu') or len(kinds) == 1:
+        return np.concatenate(non_empty)
+    else:
+        return _object_array([y for x in non_empty for y in x.tolist()])
+
+
+class RaggedColumn(object):
+    """ Column of variable-length lists of atomic values, stored as one flat array of values and an array of offsets.
+
+    Row i is values[offsets[i]:offsets[i+1]].
+
+    e.g. general usage
+    >>> x = RaggedColumn.from_lists([[1, 1, 2], [], [3]])
+    >>> len(x), x.lengths().tolist(), x[0].tolist(), x.values.tolist()
+    (3, [3, 0, 1], [1, 1, 2], [1, 1, 2, 3])
+    >>> x.take([2, 0]).tolist()
+    [[3], [1, 1, 2]]
+
+    """
+
+    def __init__(self, values, offsets):
+        """
+
+        Params:
+        :param values: flat array of the values in all rows
+        :type values: numpy.array
+        :param offsets: array of n+1 offsets into values, where n is the number of rows
+        :type offsets: numpy.array
+
+        """
+
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @staticmethod
+    def from_lists(lists):
+        """ Create a RaggedColumn from a list of lists. """
+        lengths = [len(x) for x in lists]
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return RaggedColumn(_typed_array([y for x in lists for y in x]), offsets)
+
+    @staticmethod
+    def concatenate(columns):
+        """ Concatenate RaggedColumns, row-wise. """
+        offsets = [np.zeros(1, dtype=np.int64)]
+        total = 0
+        for x in columns:
+            offsets.append(x.offsets[1:] - x.offsets[0] + total)
+            total += x.offsets[-1] - x.offsets[0]
+        values = _concatenate_arrays([x.values[x.offsets[0]:x.offsets[-1]] for x in columns])
+        return RaggedColumn(values, np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+    def lengths(self):
+        """ Get the number of values in each row. """
+        return np.diff(self.offsets)
+
+    def row_index(self):
+        """ Get the index of the row to which each value belongs. """
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+    def take(self, indices):
+        """ Get a RaggedColumn of the rows at indices, an array of ints or a boolean mask. """
+        indices = np.arange(len(self))[indices]
+        lengths = self.lengths()[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        starts = self.offsets[:-1][indices]
+        value_index = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedColumn(self.values[value_index], offsets)
+
+    def equals(self, row):
+        """ Get a boolean mask of the rows equal to the list row. """
+        row = list(row)
+        mask = self.lengths() == len(row)
+        if len(row) and mask.any():
+            candidates = np.flatnonzero(mask)
+            value_index = self.offsets[candidates][:, np.newaxis] + np.arange(len(row))
+            mask[candidates] = np.all(self.values[value_index] == np.array(row, dtype=object), axis=1)
+        return mask
+
+    def tolist(self):
+        """ Get the rows as a list of lists of python objects. """
+        values = self.values.tolist()
+        return [values[a:b] for a, b in zip(self.offsets[:-1], self.offsets[1:])]
+
+
+def _flatten_sim(sim, prefix=()):
+    """ Yield the (path, value) pairs of the items in sim, descending into non-empty dicts. """
+    for key, val in sim.items():
+        path = prefix + (key,)
+        if isinstance(val, dict) and val:
+            for x in _flatten_sim(val, path):
+                yield x
+        else:
+            yield path, val
+
+
+def _is_ragged(values):
+    return len(values) > 0 and all(isinstance(v, (list, tuple)) and
+                                   all(y is not None and not isinstance(y, (list, tuple, dict)) for y in v)
+                                   for v in values)
+
+
+class SimulationResults(object):
+    """ Columnar store of simulations, e.g. those from :func:`clintrials.simulation.run_sims`.
+
+    Each item in the simulations, like RecommendedDose or a parameter value, is stored as a numpy array with one entry
+    per simulation. Lists of atomic values, like Doses and Toxicities, are stored in a RaggedColumn.
+    Nested items are stored under paths of keys, so that results['CRM']['RecommendedDose'] gets the array of
+    RecommendedDose in the CRM item of each simulation.
+    Items missing from some simulations are tracked, integers mixed with floats are kept as python objects and empty
+    dicts are stored as items, so that to_sims() reproduces the original list of dicts.
+
+    e.g. general usage
+    >>> sims = [{'Scenario': 1, 'CRM': {'RecommendedDose': 2, 'Doses': [1, 2, 2]}},
+    ...         {'Scenario': 2, 'CRM': {'RecommendedDose': 3, 'Doses': [1, 2, 3, 3]}}]
+    >>> results = SimulationResults.from_sims(sims)
+    >>> len(results), results['CRM']['RecommendedDose'].tolist(), results['CRM']['Doses'].values.tolist()
+    (2, [2, 3], [1, 2, 2, 1, 2, 3, 3])
+    >>> results.filter({'Scenario': 2}).to_sims() == sims[1:]
+    True
+
+    """
+
+    def __init__(self, columns, num_sims, present=None):
+        """
+
+        Params:
+        :param columns: map of key path, a tuple, to column, a numpy array or RaggedColumn with num_sims rows
+        :type columns: collections.OrderedDict
+        :param num_sims: number of simulations
+        :type num_sims: int
+        :param present: map of key path to boolean array of simulations that have the item, for the items that are
+                        missing from some simulations
+        :type present: dict
+
+        """
+
+        self._columns = columns
+        self._num_sims = num_sims
+        self._present = present if present is not None else {}
+
+    @staticmethod
+    def from_sims(sims, chunk_size=10000):
+        """ Create a SimulationResults from an iterable of simulations, each a dict.
+
+        :param sims: simulations, e.g. a list or a generator like :func:`clintrials.simulation.iter_json_sims`
+        :type sims: iterable
+        :param chunk_size: number of simulations to convert at a time, bounding the memory used by python objects
+        :type chunk_size: int
+        :return: columnar store of sims
+        :rtype: clintrials.simulation.SimulationResults
+
+        """
+
+        if isinstance(sims, SimulationResults):
+            return sims
+        chunks = []
+        sims = iter(sims)
+        while True:
+            chunk = list(itertools.islice(sims, chunk_size))
+            if not chunk:
+                break
+            chunks.append(SimulationResults._from_sims_chunk(chunk))
+        return SimulationResults.concatenate(chunks)
+
+    @staticmethod
+    def _from_sims_chunk(sims):
+        flat = [OrderedDict(_flatten_sim(x)) for x in sims]
+        paths = OrderedDict()
+        for x in flat:
+            for path in x:
+                paths[path] = None
+        columns, present = OrderedDict(), {}
+        for path in paths:
+            has = np.array([path in x for x in flat], dtype=bool)
+            values = [x[path] for x in flat if path in x]
+            if _is_ragged(values):
+                columns[path] = RaggedColumn.from_lists([x.get(path, []) for x in flat])
+            else:
+                column = _typed_array(values)
+                if not has.all():
+                    full = np.zeros(len(flat), dtype=column.dtype)
+                    full[has] = column
+                    column = full
+                columns[path] = column
+            if not has.all():
+                present[path] = has
+        return SimulationResults(columns, len(flat), present)
+
+    @staticmethod
+    def concatenate(results):
+        """ Concatenate several SimulationResults, simulation-wise.
+
+        :param results: SimulationResults to concatenate
+        :type results: list
+        :return: concatenated results
+        :rtype: clintrials.simulation.SimulationResults
+
+        """
+
+        results = list(results)
+        paths = OrderedDict()
+        for r in results:
+            for path in r._columns:
+                paths[path] = None
+        columns, present = OrderedDict(), {}
+        for path in paths:
+            parts = [r._columns.get(path) for r in results]
+            if all(x is None or isinstance(x, RaggedColumn) for x in parts):
+                columns[path] = RaggedColumn.concatenate(
+                    [x if x is not None else RaggedColumn(np.zeros(0, dtype=np.int8), np.zeros(len(r) + 1))
+                     for x, r in zip(parts, results)])
+            else:
+                dtype = [x.dtype for x in parts if x is not None and not isinstance(x, RaggedColumn)][0]
+                arrays = []
+                for x, r in zip(parts, results):
+                    if x is None:
+                        arrays.append(np.zeros(len(r), dtype=dtype))
+                    elif isinstance(x, RaggedColumn):
+                        arrays.append(_object_array(x.tolist()))
+                    else:
+                        arrays.append(x)
+                columns[path] = _concatenate_arrays(arrays)
+            has = np.concatenate([r._present.get(path, np.full(len(r), path in r._columns, dtype=bool))
+                                  for r in results]) if results else np.zeros(0, dtype=bool)
+            if not has.all():
+                present[path] = has
+        return SimulationResults(columns, sum(len(r) for r in results), present)
+
+    def __len__(self):
+        return self._num_sims
+
+    def __iter__(self):
+        """ Iterate the simulations as dicts, converting a chunk at a time. """
+        for start in range(0, self._num_sims, 1000):
+            for x in self.take(slice(start, start + 1000)).to_sims():
+                yield x
+
+    def keys(self):
+        """ Get the key paths of the items stored, as tuples. """
+        return list(self._columns.keys())
+
+    def __contains__(self, key):
+        path = key if isinstance(key, tuple) else (key,)
+        return any(x[:len(path)] == path for x in self._columns)
+
+    def __getitem__(self, key):
+        """ Get the column at key, or the SimulationResults nested under key.
+
+        :param key: item name or tuple path of item names
+        :type key: str or tuple
+        :return: numpy array or RaggedColumn for an item; SimulationResults for a nested item
+        :rtype: object
+
+        """
+
+        path = key if isinstance(key, tuple) else (key,)
+        if path in self._columns:
+            return self._columns[path]
+        columns = OrderedDict((x[len(path):], y) for x, y in self._columns.items() if x[:len(path)] == path)
+        if not columns:
+            raise KeyError(key)
+        present = dict((x[len(path):], y) for x, y in self._present.items() if x[:len(path)] == path)
+        return SimulationResults(columns, self._num_sims, present)
+
+    def present(self, key):
+        """ Get a boolean array of the simulations that have the item at key. """
+        path = key if isinstance(key, tuple) else (key,)
+        return self._present.get(path, np.ones(self._num_sims, dtype=bool))
+
+    def take(self, indices):
+        """ Get the SimulationResults of the simulations at indices, an array of ints or a boolean mask. """
+        indices = np.arange(self._num_sims)[indices]
+        columns = OrderedDict((path, x.take(indices) if isinstance(x, RaggedColumn) else x[indices])
+                              for path, x in self._columns.items())
+        present = dict((path, x[indices]) for path, x in self._present.items())
+        return SimulationResults(columns, len(indices), present)
+
+    def mask(self, filter):
+        """ Get a boolean array of the simulations matching filter, like :func:`clintrials.simulation.filter_sims`.
+
+        :param filter: map of item -> value pairs. Exact matches are retained. Tuples and lists are equivalent.
+        :type filter: dict
+        :return: boolean array of matching simulations
+        :rtype: numpy.array
+
+        """
+
+        mask = np.ones(self._num_sims, dtype=bool)
+        for key, val in filter.items():
+            column = self[key]
+            if isinstance(column, RaggedColumn):
+                if isinstance(val, (tuple, list)):
+                    mask &= column.equals(val)
+                else:
+                    mask[:] = False
+            elif column.dtype == object:
+                mask &= np.array([x == val or (isinstance(val, tuple) and x == list(val)) for x in column],
+                                 dtype=bool)
+            elif isinstance(val, (tuple, list, dict)):
+                mask[:] = False
+            else:
+                mask &= column == val
+            mask &= self.present(key)
+        return mask
+
+    def filter(self, filter):
+        """ Get the SimulationResults of the simulations matching filter. See mask. """
+        return self.take(self.mask(filter))
+
+    def to_sims(self):
+        """ Get the simulations as a list of dicts of python objects, the form output by the simulation functions.
+
+        :return: list of simulations
+        :rtype: list
+
+        """
+
+        sims = [OrderedDict() for i in range(self._num_sims)]
+        for path, column in self._columns.items():
+            values = column.tolist()
+            has = self._present.get(path)
+            for i, (sim, val) in enumerate(zip(sims, values)):
+                if has is not None and not has[i]:
+                    continue
+                for key in path[:-1]:
+                    sim = sim.setdefault(key, OrderedDict())
+                sim[path[-1]] = OrderedDict() if isinstance(val, dict) else val
+        return sims
+
+
 def filter_sims(sims, filter):
     """ Filter a list of simulations.
 
-    :param sims: list of simulations (probably in JSON format)
+    :param sims: list of simulations (probably in JSON format), or a SimulationResults
     :type sims: list
     :param filter: map of item -> value pairs that forms the filter. Exact matches are retained.
     :type filter: dict
 
     """
 
-    for key, val in filter.iteritems():
+    if isinstance(sims, SimulationResults):
+        return sims.filter(filter)
+    for key, val in filter.items():
         # In JSON, tuples are masked as lists. In this filter, we treat them as equivalent:
         if isinstance(val, (tuple)):
             sims = [x for x in sims if x[key] == val or x[key] == list(val)]
@@ -127,14 +1299,83 @@ def filter_sims(sims, filter):
     return sims
 
 
+def _hashable(val):
+    """ Get a hashable equivalent of val, treating lists and tuples as equivalent, as filter_sims does. """
+    if isinstance(val, (list, tuple)):
+        return tuple(_hashable(x) for x in val)
+    elif isinstance(val, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in val.items()))
+    elif isinstance(val, np.ndarray):
+        return _hashable(val.tolist())
+    else:
+        return val
+
+
+def index_sims(sims, keys):
+    """ Index simulations by the values of their items at keys, in a single pass.
+
+    Looking up the rows for a combination of parameter values in the index is equivalent to filtering by those values
+    with :func:`clintrials.simulation.filter_sims`, without scanning all simulations for each combination.
+    As in filter_sims, tuples and lists are treated as equivalent. Simulations lacking any of the keys are not indexed.
+
+    :param sims: list of simulations (probably in JSON format), or a SimulationResults
+    :type sims: list or clintrials.simulation.SimulationResults
+    :param keys: names of the items by which to index
+    :type keys: list
+    :return: map of tuple of values, in the order of keys, to list of row numbers in sims
+    :rtype: collections.OrderedDict
+
+    e.g.
+
+    >>> sims = [{'A': 1, 'B': [1, 2]}, {'A': 2, 'B': [1, 2]}, {'A': 1, 'B': [1, 2]}]
+    >>> index = index_sims(sims, ['A', 'B'])
+    >>> index[(1, (1, 2))]
+    [0, 2]
+    >>> [x for i, x in enumerate(sims) if i in index[(1, (1, 2))]] == filter_sims(sims, {'A': 1, 'B': (1, 2)})
+    True
+
+    """
+
+    keys = list(keys)
+    if isinstance(sims, SimulationResults):
+        present = np.ones(len(sims), dtype=bool)
+        columns = []
+        for key in keys:
+            if key not in sims:
+                return OrderedDict()
+            present &= sims.present(key)
+            columns.append(sims[key].tolist())
+        rows = zip(*columns) if keys else [()] * len(sims)
+        has = present.tolist()
+    else:
+        rows = ([x[key] for key in keys] if all(key in x for key in keys) else None for x in sims)
+        has = None
+
+    index = OrderedDict()
+    for i, row in enumerate(rows):
+        if row is None or (has is not None and not has[i]):
+            continue
+        index.setdefault(_hashable(row), []).append(i)
+    return index
+
+
+def _take_sims(sims, rows):
+    """ Get the simulations at rows, a list of row numbers, in the form of sims. """
+    if isinstance(sims, SimulationResults):
+        return sims.take(np.array(rows, dtype=np.int64))
+    else:
+        return [sims[i] for i in rows]
+
+
 def summarise_sims(sims, ps, func_map, var_map=None, to_pandas=True):
     """ Summarise a list of simulations.
 
     Method partitions simulations into subsets that used the same set of parameters, and then invokes
     a collection of summary functions on each subset; outputs a pandas DataFrame with a multi-index.
+    The simulations are partitioned in a single pass, via :func:`clintrials.simulation.index_sims`.
 
-    :param sims: list of simulations (probably in JSON format)
-    :type sims: list
+    :param sims: list of simulations (probably in JSON format), or a SimulationResults
+    :type sims: list or clintrials.simulation.SimulationResults
     :param ps: ParameterSpace that will explain how to filter simulations
     :type ps: ParameterSpace
     :param var_map: map from variable name in simulation JSON to arg name in ParameterSpace
@@ -158,13 +1399,14 @@ def summarise_sims(sims, ps, func_map, var_map=None, to_pandas=True):
     z = [(var_name, ps[var_map[var_name]]) for var_name in var_names]
     labels, val_arrays = zip(*z)
     param_combinations = list(itertools.product(*val_arrays))
+    index = index_sims(sims, labels)
     index_tuples = []
     row_tuples = []
     for param_combo in param_combinations:
         these_params = dict(zip(labels, param_combo))
-        these_sims = filter_sims(sims, these_params)
+        these_sims = _take_sims(sims, index.get(_hashable(param_combo), []))
         if len(these_sims):
-            these_metrics = dict([(label, func(these_sims, these_params)) for label, func in func_map.iteritems()])
+            these_metrics = dict([(label, func(these_sims, these_params)) for label, func in func_map.items()])
             index_tuples.append(param_combo)
             row_tuples.append(these_metrics)
     if len(row_tuples):
@@ -184,7 +1426,22 @@ def summarise_sims(sims, ps, func_map, var_map=None, to_pandas=True):
 
 
 # Map-Reduce methods for summarising sims in memory-efficient ways
-def map_reduce_files(files, map_func, reduce_func):
+def _tree_reduce(reduce_func, x):
+    """ Reduce the list x with reduce_func in a balanced tree of pairs of neighbours, preserving order. """
+    x = list(x)
+    if not x:
+        raise TypeError('Nothing to reduce')
+    while len(x) > 1:
+        x = [reduce_func(x[i], x[i+1]) if i + 1 < len(x) else x[i] for i in range(0, len(x), 2)]
+    return x[0]
+
+
+def _map_reduce_chunk(files, map_func, reduce_func):
+    """ Map the files and tree-reduce the results, so that a worker returns just one reduced object. """
+    return _tree_reduce(reduce_func, [map_func(f) for f in files])
+
+
+def map_reduce_files(files, map_func, reduce_func, n_jobs=None, executor=None, files_per_task=None):
     """
     Invoke map_func on each file in sim_files and reduce results using reduce_func.
 
@@ -194,14 +1451,43 @@ def map_reduce_files(files, map_func, reduce_func):
     :type map_func: function
     :param reduce_func: function to reduce summary content of objects x & y
     :type reduce_func: function
+    :param n_jobs: number of worker processes across which to map the files. None or 1 to map serially.
+    :type n_jobs: int
+    :param executor: a concurrent.futures.Executor to use rather than a process pool of n_jobs workers
+    :type executor: concurrent.futures.Executor
+    :param files_per_task: number of consecutive files mapped and reduced by a worker at a time. None to give each
+                            worker one task, counting n_jobs workers, or the number of CPUs if just executor is given.
+    :type files_per_task: int
+
+    :returns: the reduced object, e.g. a map of parameter combination to reduced object when map_func is
+                :func:`clintrials.simulation.fetch_partition_and_aggregate` and reduce_func is
+                :func:`clintrials.simulation.reduce_product_of_two_files_by_summing`
+    :rtype: object
 
-    :returns: ?
-    :rtype: ?
+    .. note::
+
+        - when mapping in parallel, files are split into runs of consecutive files. Each worker maps its files and
+          reduces them in a balanced tree, returning just the reduced object. The objects from the workers are then
+          reduced in a balanced tree in file order. The result matches the serial reduction when reduce_func is
+          associative, as reduce_maps_by_summing and reduce_product_of_two_files_by_summing are.
+        - map_func and reduce_func must be picklable, e.g. module-level functions or functools.partial objects
+          of them, not lambdas.
 
     """
     if len(files):
-        x = map(map_func, files)
-        return reduce(reduce_func, x)
+        _executor, shutdown = _sim_executor(n_jobs, executor)
+        if _executor is None:
+            x = map(map_func, files)
+            return reduce(reduce_func, x)
+        try:
+            if not files_per_task:
+                files_per_task = int(np.ceil(len(files) / float(_num_workers(n_jobs))))
+            futures = [_executor.submit(_map_reduce_chunk, files[i:i+files_per_task], map_func, reduce_func)
+                       for i in range(0, len(files), files_per_task)]
+            return _tree_reduce(reduce_func, [future.result() for future in futures])
+        finally:
+            if shutdown:
+                _executor.shutdown()
     else:
         raise TypeError('No files')
 
@@ -216,7 +1502,7 @@ def invoke_map_reduce_function_map(sims, function_map):
     """
 
     response = OrderedDict()
-    for item, function_tuple in function_map.iteritems():
+    for item, function_tuple in function_map.items():
         map_func, reduce_func = function_tuple
         x = reduce(reduce_func, map(map_func, sims))
         response[item] = x
@@ -247,9 +1533,12 @@ def reduce_maps_by_summing(x, y):
 def partition_and_aggregate(sims, ps, function_map):
     """ Function partitions simulations into subsets that used the same set of parameters,
     and then invokes a collection of map/reduce function pairs on each subset.
+    The simulations are consumed in a single pass, each reduced into the running result for its parameters as it
+    arrives, so sims may be a generator like :func:`clintrials.simulation.iter_json_sims` and memory is bounded by
+    one simulation plus the reduced objects.
 
-    :param sims: list of simulations (probably in JSON format)
-    :type sims: list
+    :param sims: simulations (probably in JSON format), e.g. a list, a generator or a SimulationResults
+    :type sims: iterable
     :param ps: ParameterSpace that will explain how to filter simulations
     :type ps: ParameterSpace
     :param function_map: map of item -> (map_func, reduce_func) pairs
@@ -264,19 +1553,32 @@ def partition_and_aggregate(sims, ps, function_map):
     z = [(var_name, ps[var_name]) for var_name in var_names]
     labels, val_arrays = zip(*z)
     param_combinations = list(itertools.product(*val_arrays))
-    out = OrderedDict()
-    for param_combo in param_combinations:
-
-        these_params = dict(zip(labels, param_combo))
-        these_sims = filter_sims(sims, these_params)
+    keys = OrderedDict((_hashable(param_combo), param_combo) for param_combo in param_combinations)
+    reduced = {}
+    for x in sims:
+        if not all(label in x for label in labels):
+            continue
+        key = _hashable([x[label] for label in labels])
+        if key not in keys:
+            continue
+        if key in reduced:
+            response = reduced[key]
+            for item, (map_func, reduce_func) in function_map.items():
+                response[item] = reduce_func(response[item], map_func(x))
+        else:
+            reduced[key] = OrderedDict((item, map_func(x)) for item, (map_func, reduce_func) in function_map.items())
 
-        out[param_combo] =  invoke_map_reduce_function_map(these_sims, function_map)
+    out = OrderedDict()
+    for key, param_combo in keys.items():
+        if key not in reduced:
+            raise TypeError('No sims to reduce for parameters %s' % (param_combo, ))
+        out[param_combo] = reduced[key]
 
     return out
 
 
 def fetch_partition_and_aggregate(f, ps, function_map, verbose=False):
-    """ Function loads JSON sims in file f and then hands off to partition_and_aggregate.
+    """ Function streams JSON sims in file f through partition_and_aggregate, one simulation at a time.
 
     :param f: file location
     :type f: str
@@ -290,10 +1592,17 @@ def fetch_partition_and_aggregate(f, ps, function_map, verbose=False):
 
     """
 
-    sims = _open_json_local(f)
+    num_sims = [0]
+
+    def counted(sims):
+        for x in sims:
+            num_sims[0] += 1
+            yield x
+
+    out = partition_and_aggregate(counted(iter_json_sims(f)), ps, function_map)
     if verbose:
-        print('Fetched {} sims from {}'.format(len(sims), f))
-    return partition_and_aggregate(sims, ps, function_map)
+        print('Fetched {} sims from {}'.format(num_sims[0], f))
+    return out
 
 
 def reduce_product_of_two_files_by_summing(x, y):
@@ -316,6 +1625,6 @@ def multiindex_dataframe_from_tuple_map(x, labels):
 
     """
     import pandas as pd
-    k, v = zip(*[(k, v) for (k, v) in x.iteritems()])
+    k, v = zip(*[(k, v) for (k, v) in x.items()])
     i = pd.MultiIndex.from_tuples(k, names=labels)
     return pd.DataFrame(list(v), index=i)
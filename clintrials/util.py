@@ -589,7 +589,7 @@ class ParameterSpace:
 
         """
 
-        return np.array([len(y) for x,y in self.vals_map.iteritems()])
+        return np.array([len(y) for x,y in self.vals_map.items()])
 
     def size(self):
         """ Get the size of this parameter space, i.e. the product of the dimension sizes.
@@ -633,6 +633,8 @@ class _ParameterSpaceIter():
             self.cursor += 1
             return param_map
 
+        __next__ = next
+
 
 
 
@@ -8,7 +8,8 @@ import numpy as np
 from scipy.stats import norm
 
 from clintrials.common import empiric, logistic, inverse_empiric, inverse_logistic
-from clintrials.dosefinding.crm import CRM
+from clintrials.dosefinding import simulate_dose_finding_trial
+from clintrials.dosefinding.crm import CRM, simulate_crm_trial_batch
 
 
 def setup_func():
@@ -127,6 +128,324 @@ def test_CRM_bayes_again():
     # These are verifiable in R
 
 
+def test_toxicity_likelihood_from_counts():
+    # The count-based likelihood kernel should match the patient-by-patient product of likelihood factors.
+    from clintrials.dosefinding.crm import _toxicity_likelihood, _compound_toxicity_likelihood
+    toxs = [0, 1, 0, 1, 0, 0, 1, 0]
+    z = np.linspace(-3, 3, 25)
+    for F, inverse_F in [(empiric, inverse_empiric), (logistic, inverse_logistic)]:
+        labels = [inverse_F(p, a0=3) for p in [0.1, 0.25, 0.4]]
+        doses = [labels[i] for i in [0, 1, 1, 2, 1, 0, 2, 2]]
+        l = np.ones_like(z)
+        for dose, tox in zip(doses, toxs):
+            l *= _toxicity_likelihood(F, 3, z, dose, tox)
+        assert np.all(np.abs(_compound_toxicity_likelihood(F, 3, z, doses, toxs) - l) < 1e-12)
+        assert np.all(np.abs(_compound_toxicity_likelihood(F, 3, z, doses, toxs, log=True) - np.log(l)) < 1e-9)
+
+
+def test_CRM_bayes_posterior_grid():
+    # The cached log-posterior grid used in quick mode should agree with adaptive quadrature at every update,
+    # and should not underflow in a long trial.
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+    doses = [3, 5, 5, 3, 4, 4, 5, 5, 5, 5, 5, 4, 4, 4, 4, 4, 4, 4, 4, 4]
+    toxicity_events = [0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 1, 1, 0, 0, 0, 0, 0, 1, 0, 0]
+    for plugin_mean in [True, False]:
+        crm_quad = CRM(prior, 0.25, 3, max_size=200, F_func=logistic, inverse_F=inverse_logistic,
+                       use_quick_integration=False, plugin_mean=plugin_mean)
+        crm_grid = CRM(prior, 0.25, 3, max_size=200, F_func=logistic, inverse_F=inverse_logistic,
+                       use_quick_integration=True, plugin_mean=plugin_mean)
+        for dose, tox in zip(doses, toxicity_events):
+            assert crm_quad.update([(dose, tox)]) == crm_grid.update([(dose, tox)])
+            assert abs(crm_quad.beta_hat - crm_grid.beta_hat) < 1e-6
+            assert abs(crm_quad.beta_var - crm_grid.beta_var) < 1e-6
+            assert np.all(np.abs(np.array(crm_quad.prob_tox()) - np.array(crm_grid.prob_tox())) < 1e-6)
+
+        crm_grid.update([(4, 0)] * 120 + [(4, 1)] * 40)
+        assert np.isfinite(crm_grid.beta_hat) and crm_grid.beta_var > 0
+
+        crm_grid.reset()
+        assert crm_grid.update([(dose, tox) for dose, tox in zip(doses, toxicity_events)]) == crm_quad.next_dose()
+        assert abs(crm_quad.beta_hat - crm_grid.beta_hat) < 1e-6
+
+
+def test_CRM_bayes_gauss_hermite():
+    # Gauss-Hermite quadrature should agree with adaptive quadrature at every update and report a small error.
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+    doses = [3, 5, 5, 3, 4, 4, 5, 5, 5, 5, 5, 4, 4, 4, 4, 4, 4, 4, 4, 4]
+    toxicity_events = [0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 1, 1, 0, 0, 0, 0, 0, 1, 0, 0]
+    for F, inverse_F in [(empiric, inverse_empiric), (logistic, inverse_logistic)]:
+        for plugin_mean in [True, False]:
+            crm_quad = CRM(prior, 0.25, 3, max_size=20, F_func=F, inverse_F=inverse_F,
+                           use_quick_integration=False, plugin_mean=plugin_mean)
+            crm_gh = CRM(prior, 0.25, 3, max_size=20, F_func=F, inverse_F=inverse_F,
+                         integration_method='gauss_hermite', plugin_mean=plugin_mean)
+            for dose, tox in zip(doses, toxicity_events):
+                assert crm_quad.update([(dose, tox)]) == crm_gh.update([(dose, tox)])
+                assert abs(crm_quad.beta_hat - crm_gh.beta_hat) < 1e-5
+                assert abs(crm_quad.beta_var - crm_gh.beta_var) < 1e-5
+                assert np.all(np.abs(np.array(crm_quad.prob_tox()) - np.array(crm_gh.prob_tox())) < 1e-5)
+                assert crm_gh.integration_error < 1e-5
+
+
+def test_simulate_crm_trial_batch():
+    # Batched simulation should match trial-by-trial simulation on the same patients.
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+    design_kwargs = [
+        {},
+        {'F_func': logistic, 'inverse_F': inverse_logistic, 'plugin_mean': False},
+        {'coherency_threshold': 0.3, 'avoid_skipping_untried_escalation': True,
+         'avoid_skipping_untried_deescalation': True},
+        {'lowest_dose_too_toxic_hurdle': 0.3, 'lowest_dose_too_toxic_certainty': 0.8},
+        {'termination_func': lambda trial: trial.treated_at_dose(trial.next_dose()) >= 9},
+        {'method': 'mle', 'F_func': logistic, 'inverse_F': inverse_logistic, 'coherency_threshold': 0.3},
+    ]
+    np.random.seed(123)
+    tolerances = np.random.uniform(size=(20, 24))
+    for kwargs in design_kwargs:
+        for true_toxicities in [[0.1, 0.2, 0.3, 0.5, 0.6], [0.5, 0.6, 0.7, 0.8, 0.9]]:
+            for cohort_size in [1, 3]:
+                design = CRM(prior, 0.25, 3, 24, use_quick_integration=True, **kwargs)
+                sims = simulate_crm_trial_batch(design, true_toxicities, 20, tolerances=tolerances,
+                                                cohort_size=cohort_size)
+                for j in range(20):
+                    sim = simulate_dose_finding_trial(design, true_toxicities, tolerances=tolerances[j],
+                                                      cohort_size=cohort_size)
+                    assert sims[j] == sim
+
+
+def test_simulate_crm_trial_batch_integration_method():
+    # The batch simulator integrates on the trapezium grid, so Bayes designs that integrate otherwise are refused.
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+    for integration_method in ['quad', 'gauss_hermite']:
+        design = CRM(prior, 0.25, 3, 24, integration_method=integration_method)
+        try:
+            simulate_crm_trial_batch(design, [0.1, 0.2, 0.3, 0.5, 0.6], 5)
+            assert False
+        except ValueError:
+            pass
+
+
+def test_CRM_prob_tox_exceeds():
+    # Deterministic tail probabilities should be reproducible and agree with the sampled estimates they replace.
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+    for F, inverse_F in [(empiric, inverse_empiric), (logistic, inverse_logistic)]:
+        trial = CRM(prior, 0.25, 3, 30, F_func=F, inverse_F=inverse_F, use_quick_integration=True)
+        trial.update([(3, 0), (3, 0), (3, 1), (4, 0), (4, 1), (4, 1)])
+        p = trial.prob_tox_exceeds(0.3)
+        assert np.all(p == trial.prob_tox_exceeds(0.3))
+        assert np.all(np.abs(p - trial.prob_tox_exceeds(0.3, n=10**6, sample=True)) < 0.005)
+        assert np.all(np.diff(p) >= 0)
+        assert np.all(np.abs(p - trial.prob_tox_exceeds(0.3, exact_posterior=True)) < 0.1)
+
+
+def test_beta_hat_mle_batch():
+    # Newton-Raphson should find the maximum of the likelihood, with variance equal to the inverse curvature there.
+    from clintrials.dosefinding.crm import _get_beta_hat_mle_batch, _toxicity_log_likelihood_from_counts
+    np.random.seed(42)
+    num_treated = np.random.randint(0, 6, size=(50, 5))
+    num_toxes = np.random.binomial(num_treated, [0.1, 0.2, 0.3, 0.4, 0.5])
+    for F, inverse_F in [(empiric, inverse_empiric), (logistic, inverse_logistic)]:
+        labels = [inverse_F(p, a0=3) for p in [0.05, 0.12, 0.25, 0.40, 0.55]]
+        beta_hats, beta_vars = _get_beta_hat_mle_batch(F, 3, labels, num_treated, num_toxes,
+                                                       beta0=np.random.normal(size=50))
+        for n, t, beta_hat, beta_var in zip(num_treated, num_toxes, beta_hats, beta_vars):
+            if t.sum() == 0 or t.sum() == n.sum():
+                assert np.isnan(beta_hat) and np.isnan(beta_var)
+            else:
+                l = lambda b: _toxicity_log_likelihood_from_counts(F, 3, b, labels, n, t)
+                h = 1e-4
+                assert l(beta_hat) >= max(l(beta_hat - h), l(beta_hat + h))
+                assert abs(beta_var * (2 * l(beta_hat) - l(beta_hat - h) - l(beta_hat + h)) / h ** 2 - 1) < 1e-3
+
+
+def test_post_tox_bayes_all_doses():
+    # The whole toxicity curve in one pass should match the dose-by-dose integrals.
+    from scipy.integrate import quad
+    from clintrials.dosefinding.crm import _get_post_tox_bayes
+    labels = [inverse_logistic(p, a0=3) for p in [0.05, 0.12, 0.25, 0.40, 0.55]]
+    doses_given = [labels[i - 1] for i in [1, 1, 2, 2, 3, 3, 4]]
+    toxs = [0, 0, 0, 1, 0, 1, 1]
+    beta_pdf = norm(0, np.sqrt(1.34)).pdf
+    lik = lambda t: np.prod([logistic(x, 3, t) if y else 1 - logistic(x, 3, t) for x, y in zip(doses_given, toxs)])
+    denom = quad(lambda t: beta_pdf(t) * lik(t), -np.inf, np.inf)[0]
+    expected = [quad(lambda t: logistic(x, 3, t) * beta_pdf(t) * lik(t), -np.inf, np.inf)[0] / denom for x in labels]
+    for method in ['quad', 'trapezium', 'gauss_hermite']:
+        post_tox = _get_post_tox_bayes(logistic, 3, labels, doses_given, toxs, beta_pdf, integration_method=method)
+        assert len(post_tox) == len(labels)
+        assert np.all(np.abs(np.array(post_tox) - expected) < 1e-4)
+
+
+def test_CRM_dtps_memoized():
+    # DTPs that evaluate each sufficient-statistic state once should match those that replay every path.
+    import json
+    from clintrials.dosefinding import dose_transition_pathways
+    from clintrials.dosefinding.crm import crm_dtp_detail
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+    trial = CRM(prior, 0.25, 3, 30, F_func=empiric, inverse_F=inverse_empiric, use_quick_integration=True,
+                avoid_skipping_untried_escalation=True, coherency_threshold=0.3)
+    updates = []
+    update = trial.update
+    trial.update = lambda cases, **kwargs: updates.append(cases) or update(cases, **kwargs)
+    dtps = dose_transition_pathways(trial, 3, [2, 2, 2, 2], custom_output_func=crm_dtp_detail)
+    num_memoized = len(updates)
+    dtps_replayed = dose_transition_pathways(trial, 3, [2, 2, 2, 2], custom_output_func=crm_dtp_detail,
+                                             memoize=False)
+    assert json.dumps(dtps) == json.dumps(dtps_replayed)
+    assert len(updates) - num_memoized == 3 + 9 + 27 + 81
+    assert num_memoized < 3 + 9 + 27 + 81
+
+
+def test_CRM_dtps_memoized_outputs_not_shared():
+    # Nodes that reach the same state should get their own copies of the custom output.
+    from clintrials.dosefinding import dose_transition_pathways
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+    trial = CRM(prior, 0.25, 3, 30, F_func=empiric, inverse_F=inverse_empiric, use_quick_integration=True)
+    dtps = dose_transition_pathways(trial, 3, [2, 2, 2], custom_output_func=lambda t: {'p': list(t.prob_tox())})
+    outputs = [z['p'] for x in dtps for y in x['Next'] for z in [y] + y.get('Next', [])]
+    assert len(set(id(p) for p in outputs)) == len(outputs)
+    expected = [list(p) for p in outputs]
+    outputs[0].append(1.0)
+    assert [list(p) for p in outputs[1:]] == expected[1:]
+
+
+def test_CRM_dtps_principle_escalation_not_memoized():
+    # Decisions of a principle_escalation_func may depend on the order of patients, so every node is replayed.
+    import json
+    from clintrials.dosefinding import dose_transition_pathways, dose_transition_pathway_rows
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+
+    def escalate_until_toxicity(cases):
+        if any(tox for dose, tox in cases):
+            return None
+        return min(cases[-1][0] + 1, 5)
+
+    trial = CRM(prior, 0.25, 1, 30, F_func=empiric, inverse_F=inverse_empiric, use_quick_integration=True,
+                principle_escalation_func=escalate_until_toxicity)
+    updates = []
+    update = trial.update
+    trial.update = lambda cases, **kwargs: updates.append(cases) or update(cases, **kwargs)
+    dtps = dose_transition_pathways(trial, 1, [2, 2, 2, 2])
+    assert len(updates) == 3 + 9 + 27 + 81
+    assert json.dumps(dtps) == json.dumps(dose_transition_pathways(trial, 1, [2, 2, 2, 2], memoize=False))
+    del updates[:]
+    assert len(list(dose_transition_pathway_rows(trial, 1, [2, 2, 2, 2]))) == 81
+    assert len(updates) == 3 + 9 + 27 + 81
+
+
+def test_CRM_dtp_rows():
+    # Streamed DTP rows should match the table flattened from the nested pathways.
+    from clintrials.dosefinding import (dose_transition_pathways, dtps_to_pandas, dose_transition_pathway_rows,
+                                        dtp_rows_to_pandas, dtp_columns)
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+    trial = CRM(prior, 0.25, 3, 30, F_func=empiric, inverse_F=inverse_empiric, use_quick_integration=True)
+    df = dtps_to_pandas(dose_transition_pathways(trial, 3, [3, 3, 3]))
+    rows = dose_transition_pathway_rows(trial, 3, [3, 3, 3])
+    assert df.equals(dtp_rows_to_pandas(rows, dtp_columns(3)))
+    label = lambda x: 'Dose %s' % x
+    df = dtps_to_pandas(dose_transition_pathways(trial, 3, [3, 3, 3]), dose_label_func=label)
+    rows = dose_transition_pathway_rows(trial, 3, [3, 3, 3], dose_label_func=label)
+    assert df.equals(dtp_rows_to_pandas(rows, dtp_columns(3)))
+
+
+def test_CRM_fork():
+    # A forked trial updated with new cases should match a trial that replays all cases, leaving the parent unchanged.
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+    for kwargs in [{'use_quick_integration': True}, {'method': 'mle'}]:
+        trial = CRM(prior, 0.25, 3, 30, F_func=empiric, inverse_F=inverse_empiric, **kwargs)
+        trial.update([(3, 0), (3, 0), (3, 1)])
+        state = trial.snapshot()
+        fork = trial.fork()
+        fork.update([(2, 0), (2, 1)])
+
+        replay = CRM(prior, 0.25, 3, 30, F_func=empiric, inverse_F=inverse_empiric, **kwargs)
+        replay.update([(3, 0), (3, 0), (3, 1)])
+        replay.update([(2, 0), (2, 1)])
+        assert fork.next_dose() == replay.next_dose()
+        assert np.all(np.abs(np.array(fork.prob_tox()) - replay.prob_tox()) < 1e-6)
+        assert trial.size() == 3
+
+        trial.update([(4, 1), (4, 1)])
+        trial.restore(state)
+        assert trial.size() == 3
+        assert trial.snapshot()['post_tox'] == state['post_tox']
+
+
+def test_CRM_update_with_array():
+    # Updating with an (n x 2) array should match updating with a list of tuples, and keep per-dose counts.
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+    cases = [(3, 0), (3, 0), (3, 1), (2, 0), (2, 1)]
+    trial1 = CRM(prior, 0.25, 3, 30, F_func=empiric, inverse_F=inverse_empiric, use_quick_integration=True)
+    trial1.update(cases)
+    trial2 = CRM(prior, 0.25, 3, 30, F_func=empiric, inverse_F=inverse_empiric, use_quick_integration=True)
+    trial2.update(np.array(cases))
+    assert trial1.next_dose() == trial2.next_dose()
+    assert trial1.doses() == trial2.doses() == [3, 3, 3, 2, 2]
+    assert [trial2.treated_at_dose(i) for i in range(1, 6)] == [0, 2, 3, 0, 0]
+    assert [trial2.toxicities_at_dose(i) for i in range(1, 6)] == [0, 1, 1, 0, 0]
+    assert trial2.maximum_dose_given() == 3 and trial2.minimum_dose_given() == 2
+
+
+def test_simulate_dose_finding_trials_batch():
+    # The batch engine should match simulating each set of patients in turn, for batched and non-batched designs.
+    from clintrials.dosefinding import ThreePlusThree, simulate_dose_finding_trials, simulate_dose_finding_trials_batch
+    prior = [0.05, 0.12, 0.25, 0.40, 0.55]
+    true_toxicities = [0.1, 0.2, 0.3, 0.45, 0.6]
+    design_map = {
+        'CRM': CRM(prior, 0.25, 3, 30, F_func=empiric, inverse_F=inverse_empiric, use_quick_integration=True),
+        'MLE': CRM(prior, 0.25, 3, 30, F_func=logistic, inverse_F=inverse_logistic, method='mle',
+                   beta_prior=norm(0, 1.34)),
+        '3+3': ThreePlusThree(5),
+    }
+    np.random.seed(1)
+    tolerances = np.random.uniform(size=(20, 30, 3))
+    sims = simulate_dose_finding_trials_batch(design_map, true_toxicities, tolerances=tolerances, cohort_size=3)
+    assert len(sims) == 20
+    for i, sim in enumerate(sims):
+        assert sim == simulate_dose_finding_trials(design_map, true_toxicities, tolerances=tolerances[i, :, 0],
+                                                   cohort_size=3)
+
+
+def test_CRM_exact_operating_characteristics():
+    # Compare to a weighted enumeration of every interval between true toxicities in which each tolerance could fall.
+    from itertools import product
+    from clintrials.dosefinding import DoseFindingStateDAG, simulate_dose_finding_trial
+    from clintrials.dosefinding import summarise_operating_characteristics
+    design = CRM([0.1, 0.25, 0.4], 0.25, 1, 6, use_quick_integration=True, lowest_dose_too_toxic_hurdle=0.4,
+                 lowest_dose_too_toxic_certainty=0.8, coherency_threshold=0.3)
+    true_toxicities = [0.15, 0.3, 0.5]
+    edges = np.concatenate([[0], np.sort(true_toxicities), [1]])
+    mids, widths = (edges[:-1] + edges[1:]) / 2, np.diff(edges)
+    rec, patients, statuses = np.zeros(4), np.zeros(3), {}
+    for bins in product(range(len(mids)), repeat=6):
+        weight = np.prod(widths[list(bins)])
+        sim = simulate_dose_finding_trial(design, true_toxicities, tolerances=mids[list(bins)], cohort_size=2,
+                                          calculate_optimal_decision=0)
+        rec[sim['RecommendedDose']] += weight
+        statuses[sim['TrialStatus']] = statuses.get(sim['TrialStatus'], 0) + weight
+        for dose in sim['Doses']:
+            patients[dose-1] += weight
+
+    dag = DoseFindingStateDAG(design, cohort_size=2)
+    ocs = dag.operating_characteristics(true_toxicities)
+    assert np.allclose(ocs['RecommendationProbability'], rec)
+    assert np.allclose(ocs['ExpectedPatients'], patients)
+    assert sorted(ocs['TrialStatusProbability']) == sorted(statuses)
+    for status, prob in statuses.items():
+        assert np.isclose(ocs['TrialStatusProbability'][status], prob)
+
+    # The same graph serves many scenarios at once
+    scenarios = np.array([true_toxicities, [0.05, 0.1, 0.25], [0.5, 0.6, 0.7]])
+    batch_ocs = dag.operating_characteristics(scenarios)
+    assert np.allclose(batch_ocs['RecommendationProbability'][0], rec)
+    assert np.allclose(batch_ocs['RecommendationProbability'].sum(axis=1), 1)
+
+    df_doses, df_statuses = summarise_operating_characteristics(ocs)
+    assert np.allclose(df_doses['Rec%'].loc[range(4)], rec)
+    assert np.allclose(df_doses['MeanPat'].loc[range(1, 4)], patients)
+    assert np.isclose(df_statuses['%'].sum(), 1)
+
+
 # TODO: tests of full Bayes CRM, verified against bcrm in R
 
 
+
@@ -0,0 +1,57 @@
+__author__ = 'Kristian Brock'
+__contact__ = 'kristian.brock@gmail.com'
+
+import io
+
+import numpy as np
+
+from clintrials.common import empiric, inverse_empiric
+from clintrials.dosefinding import ThreePlusThree, simulate_dose_finding_trial
+from clintrials.dosefinding.crm import CRM
+from clintrials.dosefinding.decisiontable import compile_decision_table, DecisionTable
+
+
+def test_decision_table_simulate_matches_design():
+    designs = [
+        (ThreePlusThree(4), 3, [0.1, 0.2, 0.35, 0.5]),
+        (CRM([0.05, 0.12, 0.25, 0.40, 0.55], 0.25, 1, 12, F_func=empiric, inverse_F=inverse_empiric,
+             use_quick_integration=True, lowest_dose_too_toxic_hurdle=0.35, lowest_dose_too_toxic_certainty=0.8),
+         2, [0.1, 0.2, 0.3, 0.45, 0.6]),
+    ]
+    np.random.seed(4)
+    for design, cohort_size, true_toxicities in designs:
+        table = compile_decision_table(design, cohort_size=cohort_size)
+        tolerances = np.random.uniform(size=(100, design.max_size()))
+        sims = table.simulate(true_toxicities, tolerances=tolerances)
+        for i, sim in enumerate(sims):
+            assert sim == simulate_dose_finding_trial(design, true_toxicities, tolerances=tolerances[i],
+                                                      cohort_size=cohort_size, calculate_optimal_decision=0)
+
+
+def test_decision_table_save_and_load():
+    table = compile_decision_table(ThreePlusThree(3), cohort_size=3)
+
+    for key in [None, b'protocol key']:
+        f = io.BytesIO()
+        table.save(f, key=key)
+        f.seek(0)
+        loaded = DecisionTable.load(f, key=key)
+        assert loaded.digest(key) == table.digest(key)
+        assert loaded.metadata == table.metadata
+        assert np.array_equal(loaded.children, table.children)
+
+    # A table signed with one key does not verify with another
+    f = io.BytesIO()
+    table.save(f, key=b'protocol key')
+    f.seek(0)
+    try:
+        DecisionTable.load(f, key=b'another key')
+        assert False
+    except ValueError:
+        pass
+
+    # Nor does a table whose decisions have been altered
+    tampered = DecisionTable(table.dose.copy(), table.has_more, table.status, table.num_patients, table.children,
+                             table.metadata)
+    tampered.dose[-1] += 1
+    assert tampered.digest() != table.digest()
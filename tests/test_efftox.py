@@ -367,3 +367,135 @@ def test_thall2014_efftox_v2():
     # 0.994051,     0.974491,     0.733143,     0.150137,    0.0162891]
     # 0.992878,     0.968902,     0.700709,     0.166045,     0.015269
     # 0.99071,     0.970019,      0.73017,     0.153644,    0.0195214
+
+
+def test_efftox_dtps_parallel():
+    # Seeded DTPs computed on a process pool should be identical to those computed serially.
+    import json
+    from clintrials.dosefinding.efficacytoxicity import dose_transition_pathways
+    efftox_priors = [
+        norm(loc=-7.9593, scale=3.5487),
+        norm(loc=1.5482, scale=3.5018),
+        norm(loc=0.7367, scale=2.5423),
+        norm(loc=3.4181, scale=2.4406),
+        norm(loc=0.0, scale=0.2),
+        norm(loc=0.0, scale=1.0),
+        ]
+    metric = LpNormCurve(0.5, 0.65, 0.7, 0.25)
+    et = EffTox([1, 2, 4, 6.6, 10], efftox_priors, 0.3, 0.5, 0.1, 0.1, metric, 39, 1)
+    dtps = dose_transition_pathways(et, 1, [2, 2], n=1000, seed=123)
+    assert json.dumps(dtps) == json.dumps(dose_transition_pathways(et, 1, [2, 2], n=1000, seed=123, memoize=False))
+    assert json.dumps(dtps) == json.dumps(dose_transition_pathways(et, 1, [2, 2], n=1000, seed=123, n_jobs=2))
+
+
+def test_efftox_dtps_seed_keeps_caller_streams():
+    # Seeded DTPs should not disturb the random streams of the caller.
+    import random
+    from clintrials.dosefinding.efficacytoxicity import dose_transition_pathways
+    efftox_priors = [
+        norm(loc=-7.9593, scale=3.5487),
+        norm(loc=1.5482, scale=3.5018),
+        norm(loc=0.7367, scale=2.5423),
+        norm(loc=3.4181, scale=2.4406),
+        norm(loc=0.0, scale=0.2),
+        norm(loc=0.0, scale=1.0),
+        ]
+    metric = LpNormCurve(0.5, 0.65, 0.7, 0.25)
+    et = EffTox([1, 2, 4, 6.6, 10], efftox_priors, 0.3, 0.5, 0.1, 0.1, metric, 39, 1)
+    np.random.seed(0)
+    random.seed(0)
+    expected = (np.random.rand(), random.random())
+    np.random.seed(0)
+    random.seed(0)
+    dose_transition_pathways(et, 1, [2], n=1000, seed=7)
+    assert (np.random.rand(), random.random()) == expected
+
+
+def test_efftox_dtp_rows():
+    # Streamed DTP rows should match the paths flattened from the nested pathways, and write to CSV and pandas.
+    import os, tempfile
+    from clintrials.dosefinding import dtp_columns, dtp_rows_to_csv, dtp_rows_to_pandas
+    from clintrials.dosefinding.efficacytoxicity import dose_transition_pathways, dose_transition_pathway_rows, get_path
+    efftox_priors = [
+        norm(loc=-7.9593, scale=3.5487),
+        norm(loc=1.5482, scale=3.5018),
+        norm(loc=0.7367, scale=2.5423),
+        norm(loc=3.4181, scale=2.4406),
+        norm(loc=0.0, scale=0.2),
+        norm(loc=0.0, scale=1.0),
+        ]
+    metric = LpNormCurve(0.5, 0.65, 0.7, 0.25)
+    et = EffTox([1, 2, 4, 6.6, 10], efftox_priors, 0.3, 0.5, 0.1, 0.1, metric, 39, 1)
+
+    def flatten(dtps, pre=[]):
+        rows = []
+        for x in dtps:
+            row = pre + [get_path(x, dose_label_func=lambda d: ''), str(x['RecommendedDose'])]
+            rows.extend(flatten(x['Next'], row) if 'Next' in x else [row])
+        return rows
+
+    expected = flatten(dose_transition_pathways(et, 1, [2, 2], n=1000, seed=123))
+    rows = list(dose_transition_pathway_rows(et, 1, [2, 2], n=1000, seed=123))
+    assert len(rows) == 10 * 10
+    assert rows == expected
+
+    columns = dtp_columns(2, 'Outcomes')
+    df = dtp_rows_to_pandas(rows, columns)
+    assert list(df.columns) == columns and df.values.tolist() == expected
+    path = os.path.join(tempfile.mkdtemp(), 'dtps.csv')
+    assert dtp_rows_to_csv(rows, path, columns) == len(rows)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == ','.join(columns)
+    assert lines[1:] == [','.join(str(y) for y in x) for x in expected]
+
+
+def test_efftox_fork():
+    # A forked trial should carry its parent's posterior and not disturb the parent when updated.
+    efftox_priors = [
+        norm(loc=-7.9593, scale=3.5487),
+        norm(loc=1.5482, scale=3.5018),
+        norm(loc=0.7367, scale=2.5423),
+        norm(loc=3.4181, scale=2.4406),
+        norm(loc=0.0, scale=0.2),
+        norm(loc=0.0, scale=1.0),
+        ]
+    metric = LpNormCurve(0.5, 0.65, 0.7, 0.25)
+    et = EffTox([1, 2, 4, 6.6, 10], efftox_priors, 0.3, 0.5, 0.1, 0.1, metric, 39, 1)
+    et.update([(1, 0, 0), (1, 0, 1), (1, 0, 0)], n=1000)
+    utility = et.utility
+    fork = et.fork()
+    assert np.all(fork.utility == utility) and fork.admissable_set() == et.admissable_set()
+
+    np.random.seed(123)
+    fork.update([(2, 1, 1), (2, 0, 1)], n=1000)
+    np.random.seed(123)
+    replay = EffTox([1, 2, 4, 6.6, 10], efftox_priors, 0.3, 0.5, 0.1, 0.1, metric, 39, 1)
+    replay.update([(1, 0, 0), (1, 0, 1), (1, 0, 0), (2, 1, 1), (2, 0, 1)], n=1000)
+    assert fork.next_dose() == replay.next_dose()
+    assert np.all(fork.utility == replay.utility)
+    assert et.size() == 3 and np.all(et.utility == utility)
+
+
+def test_efftox_trials_batch_optimal_decisions():
+    # Fully-informed curves and optimal decisions from the batch engine should match those made sim-by-sim.
+    from clintrials.dosefinding.efficacytoxicity import simulate_trials, simulate_trials_batch
+    efftox_priors = [
+        norm(loc=-7.9593, scale=3.5487),
+        norm(loc=1.5482, scale=3.5018),
+        norm(loc=0.7367, scale=2.5423),
+        norm(loc=3.4181, scale=2.4406),
+        norm(loc=0.0, scale=0.2),
+        norm(loc=0.0, scale=1.0),
+        ]
+    metric = LpNormCurve(0.5, 0.65, 0.7, 0.25)
+    design_map = {'EffTox': EffTox([1, 2, 4, 6.6, 10], efftox_priors, 0.3, 0.5, 0.1, 0.1, metric, 39, 1)}
+    true_toxicities, true_efficacies = [0.05, 0.1, 0.2, 0.35, 0.5], [0.2, 0.35, 0.5, 0.6, 0.65]
+    np.random.seed(2)
+    tolerances = np.random.uniform(size=(10, 39, 3))
+    for psi in [1.0, 2.5]:
+        sims = simulate_trials_batch(design_map, true_toxicities, true_efficacies, tox_eff_odds_ratio=psi,
+                                     tolerances=tolerances, conduct_trial=0)
+        for i, sim in enumerate(sims):
+            assert sim == simulate_trials(design_map, true_toxicities, true_efficacies, tox_eff_odds_ratio=psi,
+                                          tolerances=tolerances[i], conduct_trial=0)
@@ -0,0 +1,41 @@
+__author__ = 'Kristian Brock'
+__contact__ = 'kristian.brock@gmail.com'
+
+import numpy as np
+
+from clintrials.dosefinding import exact_operating_characteristics, simulate_dose_finding_trial
+from clintrials.dosefinding.interval import BOIN, MTPI2, simulate_interval_trial_batch, ESCALATE, DEESCALATE
+
+
+def test_BOIN_decision_table():
+    # Liu & Yuan's boundaries for a target of 0.3, by number treated: (escalate if tox <=, de-escalate if tox >=,
+    # eliminate if tox >=)
+    published = {3: (0, 2, 3), 6: (1, 3, 4), 9: (2, 4, 5), 12: (2, 5, 7)}
+    decisions, eliminate = BOIN(0.3, 1, 5, 30).decision_table()
+    for n, (esc, deesc, elim) in published.items():
+        tox = np.arange(n + 1)
+        assert np.all((decisions[n, :n + 1] == ESCALATE) == (tox <= esc))
+        assert np.all((decisions[n, :n + 1] == DEESCALATE) == (tox >= deesc))
+        assert np.all(eliminate[n, :n + 1] == (tox >= elim))
+
+
+def test_interval_trial_batch():
+    true_toxicities = [0.05, 0.15, 0.3, 0.45, 0.6]
+    np.random.seed(6)
+    for design in [BOIN(0.3, 1, 5, 30), MTPI2(0.25, 2, 5, 24, n_earlystop=12)]:
+        for cohort_size in [1, 3]:
+            tolerances = np.random.uniform(size=(100, 30))
+            sims = simulate_interval_trial_batch(design, true_toxicities, 100, tolerances=tolerances,
+                                                 cohort_size=cohort_size)
+            for i, sim in enumerate(sims):
+                assert sim == simulate_dose_finding_trial(design, true_toxicities, tolerances=tolerances[i],
+                                                          cohort_size=cohort_size)
+
+
+def test_interval_exact_operating_characteristics():
+    # Trials that run into an overly toxic lowest dose stop with no dose selected
+    ocs = exact_operating_characteristics(BOIN(0.3, 1, 3, 12), [[0.6, 0.7, 0.8], [0.05, 0.3, 0.5]], cohort_size=3)
+    assert np.allclose(ocs['RecommendationProbability'].sum(axis=1), 1)
+    assert np.allclose(ocs['RecommendationProbability'][:, 0], ocs['TrialStatusProbability'][-1])
+    assert ocs['RecommendationProbability'][0, 0] > 0.5
+    assert np.argmax(ocs['RecommendationProbability'][1]) == 2
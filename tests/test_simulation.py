@@ -0,0 +1,397 @@
+__author__ = 'Kristian Brock'
+__contact__ = 'kristian.brock@gmail.com'
+
+""" Tests of the clintrials.simulation module. """
+
+from functools import partial
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
+
+import numpy as np
+
+from clintrials.dosefinding import ThreePlusThree, simulate_dose_finding_trial, summarise_dose_finding_sims
+from clintrials.simulation import run_sims, sim_parameter_space, go_fetch_json_sims, iter_json_sims, JsonLinesWriter
+from clintrials.simulation import filter_sims, index_sims, summarise_sims, SimulationResults
+from clintrials.simulation import fetch_partition_and_aggregate, partition_and_aggregate, map_reduce_files
+from clintrials.simulation import reduce_product_of_two_files_by_summing
+from clintrials.util import ParameterSpace
+
+
+def _noisy_sim(mu=0, **kwargs):
+    return {'mu': mu, 'x': float(np.random.normal(mu)), 'u': random.random()}
+
+
+def test_run_sims_parallel():
+    # Seeded simulations should not depend on the number of workers, and should come back in order.
+    serial = run_sims(_noisy_sim, n1=2, n2=5, seed=123, mu=1)
+    parallel = run_sims(_noisy_sim, n1=2, n2=5, n_jobs=2, seed=123, mu=1)
+    chunked = run_sims(_noisy_sim, n1=2, n2=5, n_jobs=3, seed=123, chunk_size=1, mu=1)
+    assert len(serial) == 10
+    assert serial == parallel == chunked
+    assert len(set(x['x'] for x in serial)) == 10
+
+
+def test_sim_parameter_space_parallel():
+    ps = ParameterSpace()
+    ps.add('mu', [0, 10, 20])
+    serial = sim_parameter_space(_noisy_sim, ps, n1=2, seed=7)
+    parallel = sim_parameter_space(_noisy_sim, ps, n1=2, n_jobs=2, seed=7)
+    assert serial == parallel
+    assert [x['mu'] for x in parallel] == [0, 10, 20, 0, 10, 20]
+
+
+def test_run_sims_json_lines():
+    # Each batch should be appended to a JSON Lines file, readable whether compressed or not.
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for file_name in ['sims.jsonl', 'sims.jsonl.gz']:
+            path = os.path.join(tmp_dir, file_name)
+            sims = run_sims(_noisy_sim, n1=3, n2=4, out_file=path, seed=1)
+            assert list(iter_json_sims(path)) == sims
+        assert len(go_fetch_json_sims(os.path.join(tmp_dir, 'sims.jsonl*'))) == 24
+
+        path = os.path.join(tmp_dir, 'more.jsonl.gz')
+        with JsonLinesWriter(path, background=True) as writer:
+            sims1 = run_sims(_noisy_sim, n1=2, n2=3, out_file=writer, seed=2)
+            sims2 = run_sims(_noisy_sim, n1=1, n2=3, out_file=writer, seed=3)
+        assert writer.num_written == 9
+        assert list(iter_json_sims(path)) == sims1 + sims2
+
+        # A batch torn by an interrupted write should not hide the batches before it
+        path = os.path.join(tmp_dir, 'torn.jsonl')
+        with JsonLinesWriter(path) as writer:
+            writer.write_batch(sims1)
+        with open(path, 'a') as f:
+            f.write('{"mu": 1, "x"')
+        assert list(iter_json_sims(path)) == sims1
+        with open(path, 'rb') as f, gzip.open(path + '.gz', 'wb') as gz:
+            gz.write(f.read()[:-3])
+        assert len(list(iter_json_sims(path + '.gz'))) == len(sims1)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+class _Interrupted(Exception):
+    pass
+
+
+_calls_before_interruption = [-1]
+
+
+def _interruptible_sim(mu=0, **kwargs):
+    if _calls_before_interruption[0] == 0:
+        raise _Interrupted()
+    _calls_before_interruption[0] -= 1
+    return _noisy_sim(mu)
+
+
+def test_sim_parameter_space_resume():
+    # A run interrupted mid-batch and resumed should give the same output as an uninterrupted run.
+    ps = ParameterSpace()
+    ps.add('mu', [0, 10, 20])
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for file_name, seed in [('sims.jsonl.gz', 11), ('sims.json', 11), ('sims.jsonl', None)]:
+            path = os.path.join(tmp_dir, file_name)
+            np.random.seed(5)
+            random.seed(5)
+            expected = sim_parameter_space(_noisy_sim, ps, n1=4, n2=2, out_file=path, seed=seed)
+            with open(path, 'rb') as f:
+                expected_bytes = f.read()
+            os.remove(path)
+
+            np.random.seed(5)
+            random.seed(5)
+            _calls_before_interruption[0] = 5
+            try:
+                sim_parameter_space(_interruptible_sim, ps, n1=4, n2=2, out_file=path, seed=seed, resume=True)
+                assert False
+            except _Interrupted:
+                pass
+            np.random.seed(1)
+            random.seed(1)
+            _calls_before_interruption[0] = -1
+            sims = sim_parameter_space(_interruptible_sim, ps, n1=4, n2=2, out_file=path, seed=seed, resume=True)
+            assert sims == expected
+            assert [x['mu'] for x in sims] == [0, 10, 20, 0, 10, 20, 0, 10]
+            with open(path, 'rb') as f:
+                assert f.read() == expected_bytes
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_run_sims_resume_checks_run():
+    # A checkpoint should only be resumed by the run that wrote it, and should be removed once that run completes.
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'sims.json')
+        _calls_before_interruption[0] = 3
+        try:
+            run_sims(_interruptible_sim, n1=3, n2=2, out_file=path, seed=1, resume=True, mu=0)
+            assert False
+        except _Interrupted:
+            pass
+        _calls_before_interruption[0] = -1
+        for kwargs in [{'seed': 99, 'mu': 0}, {'seed': 1, 'mu': 100}]:
+            try:
+                run_sims(_interruptible_sim, n1=3, n2=2, out_file=path, resume=True, **kwargs)
+                assert False
+            except ValueError:
+                pass
+        sims = run_sims(_interruptible_sim, n1=3, n2=2, out_file=path, seed=1, resume=True, mu=0)
+        assert sims == run_sims(_interruptible_sim, n1=3, n2=2, seed=1, mu=0)
+        assert list(iter_json_sims(path)) == sims
+        assert sorted(os.listdir(tmp_dir)) == ['sims.json']
+
+        # Once complete, the file is not resumed by another run
+        sims = run_sims(_interruptible_sim, n1=1, n2=2, out_file=path, seed=99, resume=True, mu=100)
+        assert [x['mu'] for x in list(iter_json_sims(path))] == [100, 100]
+
+        # A run without resume removes a stale checkpoint
+        _calls_before_interruption[0] = 3
+        try:
+            run_sims(_interruptible_sim, n1=3, n2=2, out_file=path, seed=1, resume=True, mu=0)
+            assert False
+        except _Interrupted:
+            pass
+        _calls_before_interruption[0] = -1
+        run_sims(_interruptible_sim, n1=1, n2=2, out_file=path, seed=1, mu=0)
+        assert sorted(os.listdir(tmp_dir)) == ['sims.json']
+
+        # Sims that cannot be saved stop a resumable run
+        try:
+            run_sims(_noisy_sim, n1=1, n2=2, out_file=os.path.join(tmp_dir, 'missing', 'sims.json'), resume=True)
+            assert False
+        except (IOError, OSError):
+            pass
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _three_plus_three_sim(scenario=0):
+    true_toxicities = [[0.05, 0.1, 0.2, 0.35, 0.5], [0.2, 0.3, 0.4, 0.5, 0.6]][scenario]
+    sim = {'Scenario': scenario, 'Scheme': (1, 2) if scenario else (3, 4)}
+    sim['3+3'] = simulate_dose_finding_trial(ThreePlusThree(5), true_toxicities, cohort_size=3,
+                                             calculate_optimal_decision=0)
+    if scenario:
+        sim['Note'] = 'Toxic'
+    return sim
+
+
+def test_simulation_results():
+    # The columnar store should round-trip the dict form and give the same summaries.
+    ps = ParameterSpace()
+    ps.add('scenario', [0, 1])
+    sims = json.loads(json.dumps(sim_parameter_space(_three_plus_three_sim, ps, n1=25, seed=13)))
+    results = SimulationResults.from_sims(sims, chunk_size=7)
+    assert len(results) == 50
+    assert results.to_sims() == sims
+    assert results['3+3']['Doses'].values.dtype.itemsize == 1
+    assert results['3+3']['RecommendedDose'].tolist() == [x['3+3']['RecommendedDose'] for x in sims]
+    assert results.present('Note').sum() == len(results.filter({'Note': 'Toxic'})) == 25
+
+    for filter in [{}, {'Scenario': 1}, {'Scheme': (3, 4)}]:
+        assert filter_sims(results, filter).to_sims() == filter_sims(sims, filter)
+        expected = summarise_dose_finding_sims(sims, '3+3', 5, filter=filter)
+        actual = summarise_dose_finding_sims(results, '3+3', 5, filter=filter)
+        assert expected[0].equals(actual[0])
+        assert expected[1].equals(actual[1])
+        assert all(np.array_equal(x, y) for x, y in zip(expected[2:], actual[2:]))
+
+    ps = ParameterSpace()
+    ps.add('Scenario', [0, 1])
+    func_map = {'N': lambda x, p: len(x)}
+    assert summarise_sims(results, ps, func_map).equals(summarise_sims(sims, ps, func_map))
+
+
+def test_simulation_results_round_trip():
+    # Values should keep their types, however the sims are chunked, and empty dicts should be kept.
+    sims = [{'a': 1, 'b': 2, 'p': {}, 'q': {'r': 1}}, {'a': 1.5, 'b': 3, 'p': {}, 'q': {}},
+            {'a': 2.5, 'b': 4.5, 'p': {'s': True}, 'q': {'r': 2}}]
+    for chunk_size in [1, 2, 3]:
+        results = SimulationResults.from_sims(sims, chunk_size=chunk_size)
+        round_trip = results.to_sims()
+        assert round_trip == sims
+        assert [type(x['a']) for x in round_trip] == [int, float, float]
+        assert [type(x['b']) for x in round_trip] == [int, int, float]
+        assert [json.dumps(x, sort_keys=True) for x in round_trip] == [json.dumps(x, sort_keys=True) for x in sims]
+        assert results.filter({'p': {}}).to_sims() == sims[:2]
+
+
+def test_index_sims():
+    # Partitioning via the index should match filtering once per parameter combination.
+    ps = ParameterSpace()
+    ps.add('scenario', [0, 1])
+    sims = json.loads(json.dumps(sim_parameter_space(_three_plus_three_sim, ps, n1=10, seed=17)))
+    results = SimulationResults.from_sims(sims)
+    for x in [sims, results]:
+        index = index_sims(x, ['Scenario', 'Scheme'])
+        assert sorted(index.keys()) == [(0, (3, 4)), (1, (1, 2))]
+        for (scenario, scheme), rows in index.items():
+            assert rows == [i for i, y in enumerate(sims) if y['Scenario'] == scenario and y['Scheme'] == list(scheme)]
+        assert list(index_sims(x, ['Note']).keys()) == [('Toxic', )]
+        assert len(index_sims(x, ['Note'])[('Toxic', )]) == 10
+
+    ps = ParameterSpace()
+    ps.add('Scenario', [0, 1, 2])
+    ps.add('Scheme', [(3, 4), (1, 2)])
+    func_map = {'N': lambda x, p: len(x), 'Rec': lambda x, p: np.mean([y['3+3']['RecommendedDose'] for y in x])}
+    df = summarise_sims(sims, ps, func_map)
+    assert df.index.tolist() == [(0, (3, 4)), (1, (1, 2))]
+    assert df.N.tolist() == [10, 10]
+    assert df.equals(summarise_sims(results, ps, {'N': lambda x, p: len(x),
+                                                  'Rec': lambda x, p: np.mean(x['3+3']['RecommendedDose'])}))
+
+
+def test_fetch_partition_and_aggregate_streaming():
+    # Sims streamed from a JSON array file should aggregate just as the list of sims does.
+    ps = ParameterSpace()
+    ps.add('scenario', [0, 1])
+    sims = json.loads(json.dumps(sim_parameter_space(_three_plus_three_sim, ps, n1=10, seed=19)))
+    ps = ParameterSpace()
+    ps.add('Scenario', [0, 1])
+    function_map = {'N': (lambda x: 1, lambda x, y: x + y),
+                    'Rec': (lambda x: x['3+3']['RecommendedDose'], lambda x, y: x + y)}
+    expected = {}
+    for scenario in [0, 1]:
+        these_sims = [x for x in sims if x['Scenario'] == scenario]
+        expected[(scenario, )] = {'N': len(these_sims), 'Rec': sum(x['3+3']['RecommendedDose'] for x in these_sims)}
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for file_name in ['sims.json', 'sims.json.gz']:
+            path = os.path.join(tmp_dir, file_name)
+            with (gzip.open(path, 'wt') if file_name.endswith('.gz') else open(path, 'w')) as f:
+                json.dump(sims, f, indent=1)
+            assert list(iter_json_sims(path)) == sims
+            out = fetch_partition_and_aggregate(path, ps, function_map)
+            assert dict((k, dict(v)) for k, v in out.items()) == expected
+        out = partition_and_aggregate(SimulationResults.from_sims(sims), ps, function_map)
+        assert dict((k, dict(v)) for k, v in out.items()) == expected
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _one(x):
+    return 1
+
+
+def _recommended_dose(x):
+    return x['3+3']['RecommendedDose']
+
+
+def _add(x, y):
+    return x + y
+
+
+def test_map_reduce_files_parallel():
+    # Shards mapped across processes and tree-reduced should match the serial reduction.
+    ps = ParameterSpace()
+    ps.add('scenario', [0, 1])
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(5):
+            path = os.path.join(tmp_dir, 'sims%s.jsonl' % i)
+            sim_parameter_space(_three_plus_three_sim, ps, n1=2, out_file=path, seed=i)
+            files.append(path)
+        ps = ParameterSpace()
+        ps.add('Scenario', [0, 1])
+        map_func = partial(fetch_partition_and_aggregate, ps=ps,
+                           function_map={'N': (_one, _add), 'Rec': (_recommended_dose, _add)})
+        serial = map_reduce_files(files, map_func, reduce_product_of_two_files_by_summing)
+        assert serial[(0, )]['N'] == serial[(1, )]['N'] == 10
+        for kwargs in [{'n_jobs': 2}, {'n_jobs': 3, 'files_per_task': 1}]:
+            parallel = map_reduce_files(files, map_func, reduce_product_of_two_files_by_summing, **kwargs)
+            assert parallel == serial
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _scaled_sim(sd=1, **kwargs):
+    return {'sd': sd, 'x': float(np.random.normal(0, sd))}
+
+
+def _x(sim):
+    return sim['x']
+
+
+def test_sim_parameter_space_precision():
+    # Each combination should stop once its target is met, so noisier combinations get more sims.
+    precision = {'x': (_x, 0.1)}
+    sims = run_sims(_scaled_sim, n1=100, n2=20, seed=3, precision=precision, min_sims=10, sd=0.5)
+    assert 20 <= len(sims) <= 60
+    assert np.std([x['x'] for x in sims], ddof=1) / np.sqrt(len(sims)) <= 0.1
+
+    ps = ParameterSpace()
+    ps.add('sd', [0.1, 0.5, 1])
+    sims = sim_parameter_space(_scaled_sim, ps, n1=100, n2=30, seed=4, precision={'x': (_x, 0.05)}, min_sims=10)
+    for sd in [0.1, 0.5, 1]:
+        x = [y['x'] for y in sims if y['sd'] == sd]
+        assert np.std(x, ddof=1) / np.sqrt(len(x)) <= 0.05
+    counts = [len([y for y in sims if y['sd'] == sd]) for sd in [0.1, 0.5, 1]]
+    assert counts[0] < counts[1] < counts[2]
+    assert counts[0] <= 20 and counts[2] >= 300
+
+    # A run interrupted mid-batch and resumed should stop where an uninterrupted run stops
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'sims.jsonl')
+        _calls_before_interruption[0] = 50
+        try:
+            sim_parameter_space(_interruptible_sim, ps, n1=100, n2=30, out_file=path, seed=4, precision=precision,
+                                resume=True)
+            assert False
+        except _Interrupted:
+            pass
+        _calls_before_interruption[0] = -1
+        resumed = sim_parameter_space(_interruptible_sim, ps, n1=100, n2=30, out_file=path, seed=4,
+                                      precision=precision, resume=True)
+        expected = sim_parameter_space(_interruptible_sim, ps, n1=100, n2=30, seed=4, precision=precision)
+        assert resumed == expected
+
+        # min_sims decides when combinations stop, so a checkpoint is not resumed with another value
+        os.remove(path)
+        _calls_before_interruption[0] = 50
+        try:
+            sim_parameter_space(_interruptible_sim, ps, n1=100, n2=30, out_file=path, seed=4, precision=precision,
+                                min_sims=10, resume=True)
+            assert False
+        except _Interrupted:
+            pass
+        _calls_before_interruption[0] = -1
+        try:
+            sim_parameter_space(_interruptible_sim, ps, n1=100, n2=30, out_file=path, seed=4, precision=precision,
+                                min_sims=20, resume=True)
+            assert False
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _hit_sim(p=0.5, **kwargs):
+    return {'p': p, 'hit': int(random.random() < p)}
+
+
+def _hit(sim):
+    return sim['hit']
+
+
+def test_sim_parameter_space_precision_proportions():
+    # A run of identical indicators should not stop a combination before its proportion has been estimated.
+    ps = ParameterSpace()
+    ps.add('p', [0.0, 0.5, 1.0])
+    precision = {'PCS': (_hit, 0.02)}
+    sims = sim_parameter_space(_hit_sim, ps, n1=1000, n2=10, seed=5, precision=precision, min_sims=2)
+    counts = [len([x for x in sims if x['p'] == p]) for p in [0.0, 0.5, 1.0]]
+    assert counts[0] >= 35 and counts[2] >= 35
+    assert counts[1] >= 0.9 * 0.5 * 0.5 / 0.02 ** 2
+
+    sims = sim_parameter_space(_hit_sim, ps, n1=1000, n2=10, seed=5, precision=precision)
+    counts = [len([x for x in sims if x['p'] == p]) for p in [0.0, 0.5, 1.0]]
+    assert counts[0] >= 100 and counts[2] >= 100
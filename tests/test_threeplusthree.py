@@ -1,4 +1,60 @@
 __author__ = 'Kristian Brock'
 __contact__ = 'kristian.brock@gmail.com'
 
-# TODO
\ No newline at end of file
+from itertools import product
+
+import numpy as np
+
+from clintrials.dosefinding import ThreePlusThree, SimpleToxicityCountingDoseEscalationTrial
+from clintrials.dosefinding import exact_operating_characteristics, simulate_dose_finding_trial
+
+
+def _enumerated_operating_characteristics(design, true_toxicities, num_patients, cohort_size):
+    # Each patient's tolerance falls in one of the intervals between sorted true toxicities, and the interval alone
+    # determines the patient's outcome at every dose, so enumerating intervals gives the exact characteristics.
+    edges = np.concatenate([[0], np.sort(true_toxicities), [1]])
+    mids, widths = (edges[:-1] + edges[1:]) / 2, np.diff(edges)
+    num_doses = len(true_toxicities)
+    rec, patients = np.zeros(num_doses + 1), np.zeros(num_doses)
+    for bins in product(range(len(mids)), repeat=num_patients):
+        weight = np.prod(widths[list(bins)])
+        sim = simulate_dose_finding_trial(design, true_toxicities, tolerances=mids[list(bins)],
+                                          cohort_size=cohort_size, calculate_optimal_decision=0)
+        rec[max(sim['RecommendedDose'], 0)] += weight
+        for dose in sim['Doses']:
+            patients[dose-1] += weight
+    return rec, patients
+
+
+def test_three_plus_three_exact_operating_characteristics():
+    true_toxicities = [0.2, 0.5]
+    ocs = exact_operating_characteristics(ThreePlusThree(2), true_toxicities)
+    rec, patients = _enumerated_operating_characteristics(ThreePlusThree(2), true_toxicities, 12, 3)
+    assert np.allclose(ocs['RecommendationProbability'], rec)
+    assert np.allclose(ocs['ExpectedPatients'], patients)
+    assert np.isclose(ocs['ExpectedSampleSize'], patients.sum())
+    assert np.allclose(ocs['ExpectedToxicities'], [3 * 0.2 * (1 + 3 * 0.2 * 0.8 ** 2),
+                                                  ocs['ExpectedPatients'][1] * 0.5])
+
+
+def test_toxicity_counting_exact_operating_characteristics():
+    # Seven patients in cohorts of two, so the last cohort is truncated.
+    design = SimpleToxicityCountingDoseEscalationTrial(first_dose=2, num_doses=4, max_size=7, max_toxicities=2)
+    true_toxicities = [0.1, 0.3, 0.4, 0.6]
+    ocs = exact_operating_characteristics(design, true_toxicities, cohort_size=2)
+    rec, patients = _enumerated_operating_characteristics(design, true_toxicities, 7, 2)
+    assert np.allclose(ocs['RecommendationProbability'], rec)
+    assert np.allclose(ocs['ExpectedPatients'], patients)
+
+
+def test_exact_operating_characteristics_vectorised():
+    scenarios = np.array([[0.05, 0.1, 0.2, 0.3], [0.1, 0.25, 0.4, 0.55], [0.3, 0.45, 0.6, 0.7]])
+    ocs = exact_operating_characteristics(ThreePlusThree(4), scenarios)
+    assert ocs['RecommendationProbability'].shape == (3, 5)
+    assert np.allclose(ocs['RecommendationProbability'].sum(axis=1), 1)
+    for i, scenario in enumerate(scenarios):
+        ocs_i = exact_operating_characteristics(ThreePlusThree(4), scenario)
+        for key in ['RecommendationProbability', 'ExpectedPatients', 'ExpectedToxicities', 'ExpectedSampleSize']:
+            assert np.allclose(ocs[key][i], ocs_i[key])
+        for status, prob in ocs_i['TrialStatusProbability'].items():
+            assert np.isclose(ocs['TrialStatusProbability'][status][i], prob)
@@ -120,3 +120,68 @@ def test_wages_tait_2():
     assert trial.dose_efficacy_upper_bound(next_dose) - 0.7772219 < 0.00001
 
     # The exact values above were taken from Nolan's implementation in R.
+
+
+def test_wages_tait_gauss_hermite():
+
+    # Gauss-Hermite quadrature should reproduce the values in test_wages_tait_1, taken from Nolan's implementation in R.
+    tox_prior = [0.01, 0.08, 0.15, 0.22, 0.29, 0.36]
+    tox_cutoff = 0.33
+    eff_cutoff = 0.05
+    tox_target = 0.30
+
+    skeletons = [
+        [0.60, 0.50, 0.40, 0.30, 0.20, 0.10],
+        [0.50, 0.60, 0.50, 0.40, 0.30, 0.20],
+        [0.40, 0.50, 0.60, 0.50, 0.40, 0.30],
+        [0.30, 0.40, 0.50, 0.60, 0.50, 0.40],
+        [0.20, 0.30, 0.40, 0.50, 0.60, 0.50],
+        [0.10, 0.20, 0.30, 0.40, 0.50, 0.60],
+        [0.20, 0.30, 0.40, 0.50, 0.60, 0.60],
+        [0.30, 0.40, 0.50, 0.60, 0.60, 0.60],
+        [0.40, 0.50, 0.60, 0.60, 0.60, 0.60],
+        [0.50, 0.60, 0.60, 0.60, 0.60, 0.60],
+        [0.60, 0.60, 0.60, 0.60, 0.60, 0.60],
+    ]
+
+    trial = WagesTait(skeletons, tox_prior, tox_target, tox_cutoff, eff_cutoff, 1, 64, 16,
+                      integration_method='gauss_hermite')
+
+    cases = [
+        (1,1,0), (1,0,0), (1,0,0),
+        (2,0,0), (2,0,0), (2,0,1),
+        (3,1,1), (3,0,1),
+    ]
+
+    trial.update(cases)
+    assert np.all(np.abs(trial.post_tox_probs - np.array([0.1376486, 0.3126617, 0.4095831, 0.4856057, 0.5506505,
+                                                          0.6086650])) < 0.001)
+    assert np.all(np.abs(trial.post_eff_probs - np.array([0.2479070, 0.3639813, 0.4615474, 0.5497718, 0.6321674,
+                                                          0.7105235])) < 0.00001)
+    assert np.all(np.abs(trial.w - np.array([0.01347890, 0.03951504, 0.12006585, 0.11798287, 0.11764227, 0.12346595,
+                                      0.11764227, 0.11798287, 0.12006585, 0.07073296, 0.04142517])) < 0.00001)
+    assert trial.most_likely_model_index == 5
+
+
+def test_wages_tait_fork():
+    # A forked trial, including its toxicity model, should be independent of its parent.
+    tox_prior = [0.01, 0.08, 0.15, 0.22, 0.29, 0.36]
+    skeletons = [
+        [0.60, 0.50, 0.40, 0.30, 0.20, 0.10],
+        [0.40, 0.50, 0.60, 0.50, 0.40, 0.30],
+        [0.10, 0.20, 0.30, 0.40, 0.50, 0.60],
+    ]
+    cases = [(1, 1, 0), (1, 0, 0), (1, 0, 0), (2, 0, 0), (2, 0, 0), (2, 0, 1)]
+    more_cases = [(3, 1, 1), (3, 0, 1), (3, 0, 0)]
+
+    trial = WagesTait(skeletons, tox_prior, 0.30, 0.33, 0.05, 1, 64, 0, use_quick_integration=True)
+    trial.update(cases)
+    fork = trial.fork()
+    fork.update(more_cases)
+
+    replay = WagesTait(skeletons, tox_prior, 0.30, 0.33, 0.05, 1, 64, 0, use_quick_integration=True)
+    replay.update(cases + more_cases)
+    assert fork.next_dose() == replay.next_dose()
+    assert np.all(np.abs(fork.post_tox_probs - replay.post_tox_probs) < 1e-6)
+    assert np.all(np.abs(fork.post_eff_probs - replay.post_eff_probs) < 1e-6)
+    assert trial.size() == 6 and trial.crm.size() == 6
@@ -127,4 +127,35 @@ def test_watu_2():
                   < 0.01)  # This is subject to random variation (estimation error) so varies a bit
 
     assert np.all(np.abs(trial.utility - np.array([ 0.18320154, -0.11034328, -0.26984169, -0.39399425, -0.61068672,
-                                                    -0.81190408])) < 0.00001)
\ No newline at end of file
+                                                    -0.81190408])) < 0.00001)
+
+
+def test_watu_fork():
+    # A trial restored from a snapshot should recover its state and its toxicity model.
+    tox_prior = [0.01, 0.08, 0.15, 0.22, 0.29, 0.36]
+    skeletons = [
+        [0.60, 0.50, 0.40, 0.30, 0.20, 0.10],
+        [0.40, 0.50, 0.60, 0.50, 0.40, 0.30],
+        [0.10, 0.20, 0.30, 0.40, 0.50, 0.60],
+    ]
+    metric = LpNormCurve(0.05, 0.4, 0.25, 0.15)
+    cases = [(1, 1, 0), (1, 0, 0), (1, 0, 0), (2, 0, 0), (2, 0, 0), (2, 0, 1)]
+    more_cases = [(3, 1, 1), (3, 0, 1), (3, 0, 0)]
+
+    trial = WATU(skeletons, tox_prior, 0.30, 0.33, 0.05, metric, 1, 64, 0, use_quick_integration=True)
+    trial.update(cases)
+    state = trial.snapshot()
+    next_dose, post_tox_probs = trial.next_dose(), trial.post_tox_probs
+    fork = trial.fork()
+    fork.update(more_cases)
+
+    replay = WATU(skeletons, tox_prior, 0.30, 0.33, 0.05, metric, 1, 64, 0, use_quick_integration=True)
+    replay.update(cases + more_cases)
+    assert fork.next_dose() == replay.next_dose()
+    assert np.all(np.abs(fork.post_eff_probs - replay.post_eff_probs) < 1e-6)
+
+    trial.update(more_cases)
+    trial.restore(state)
+    assert trial.size() == 6 and trial.crm.size() == 6
+    assert trial.next_dose() == next_dose
+    assert np.all(trial.post_tox_probs == post_tox_probs)